@@ -0,0 +1,362 @@
+"""
+准入控制
+
+放在聊天页面与分析器之间，避免突发流量（或某个用户连续发送）把上游打到限流、所有人一起失败：
+    - 单会话令牌桶：限制每个会话的发送频率，超出时立即提示稍后再试
+    - 全局令牌桶 + 并发上限：控制发往上游的请求速率和同时生成的回复数
+    - 公平队列：超出并发上限的请求按会话轮转排队（每个会话轮流放行一个），
+      不会因为某个会话排了多条而让其他会话一直等待
+    - 削峰：队列已满或排队超过最长等待时间时，直接返回友好提示，而不是让所有请求一起变慢
+
+排队期间可以查询当前排队位置，聊天页面据此显示"前面还有 N 位"。
+异步调用方（api_server）使用 Ticket.wait_async()，在事件循环中轮询，不占用线程。
+
+环境变量:
+    TCM_ADMISSION: off 关闭准入控制（默认开启）
+    TCM_MAX_CONCURRENT_REPLIES: 同时生成的回复数上限，默认8
+    TCM_QUEUE_MAX: 排队请求数上限，默认64
+    TCM_QUEUE_MAX_WAIT: 最长排队时间（秒），默认30
+    TCM_GLOBAL_RATE: 全局每秒放行的请求数，默认5（0为不限）
+    TCM_GLOBAL_BURST: 全局令牌桶容量，默认10
+    TCM_SESSION_RATE: 每个会话每秒允许发送的消息数，默认0.2（0为不限）
+    TCM_SESSION_BURST: 每个会话允许的连续发送数，默认3
+
+启用共享状态（shared_state，TCM_STATE_BACKEND）时，全局令牌桶由所有副本共享，
+TCM_GLOBAL_RATE 是所有副本合计的速率；会话令牌桶仍在本地（一个会话的WebSocket连接固定在一个副本上）。
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import metrics
+import shared_state
+from rate_limit import TokenBucket
+
+DEFAULT_MAX_CONCURRENT = 8
+DEFAULT_MAX_QUEUE = 64
+DEFAULT_MAX_WAIT = 30.0
+DEFAULT_GLOBAL_RATE = 5.0
+DEFAULT_GLOBAL_BURST = 10
+DEFAULT_SESSION_RATE = 0.2
+DEFAULT_SESSION_BURST = 3
+DEFAULT_MAX_SESSIONS = 10000
+
+
+class AdmissionRejected(Exception):
+    """请求未被放行"""
+
+    def __init__(self, reason, message, retry_after=None):
+        """
+        参数:
+            reason: session_rate / queue_full / timeout
+            message: 可以直接展示给用户的提示
+            retry_after: 建议的重试间隔（秒）
+        """
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """一次排队请求；放行后占用一个并发名额，结束时调用 release()（或用作上下文管理器）"""
+
+    __slots__ = ("controller", "session_id", "enqueued", "granted", "released")
+
+    def __init__(self, controller, session_id):
+        self.controller = controller
+        self.session_id = session_id
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.released = False
+
+    def position(self):
+        """当前排队位置（1表示下一个放行），已放行时返回0"""
+        return self.controller.position(self)
+
+    def wait(self, on_position=None):
+        """
+        等待放行
+
+        参数:
+            on_position: 可选的回调 on_position(位置)，排队位置变化时调用
+
+        异常:
+            AdmissionRejected: 超过最长排队时间
+        """
+        self.controller.wait(self, on_position)
+        return self
+
+    async def wait_async(self):
+        """wait() 的asyncio版本；等待期间被取消时让出位置或名额"""
+        await self.controller.wait_async(self)
+        return self
+
+    def release(self):
+        self.controller.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class AdmissionController:
+    """令牌桶限流 + 按会话轮转的公平队列"""
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT, max_queue=DEFAULT_MAX_QUEUE,
+                 max_wait=DEFAULT_MAX_WAIT, global_rate=DEFAULT_GLOBAL_RATE, global_burst=DEFAULT_GLOBAL_BURST,
+                 session_rate=DEFAULT_SESSION_RATE, session_burst=DEFAULT_SESSION_BURST,
+                 max_sessions=DEFAULT_MAX_SESSIONS, poll_interval=0.25, state=None):
+        """
+        参数:
+            max_concurrent: 同时生成的回复数上限
+            max_queue: 排队请求数上限，超出时直接拒绝
+            max_wait: 最长排队时间（秒）
+            global_rate: 全局每秒放行的请求数，0为不限
+            global_burst: 全局令牌桶容量
+            session_rate: 每个会话每秒允许发送的消息数，0为不限
+            session_burst: 每个会话允许的连续发送数
+            max_sessions: 最多保留令牌桶的会话数，超出时淘汰最久未发送的会话
+            poll_interval: 等待全局令牌时的轮询间隔（秒）
+            state: 可选的 shared_state.SharedState，提供时全局令牌桶在各副本间共享
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        if global_rate <= 0:
+            self.global_bucket = None
+        elif state is not None:
+            self.global_bucket = shared_state.SharedTokenBucket(state, "admission:global", global_rate, global_burst)
+        else:
+            self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.max_sessions = max_sessions
+        self.poll_interval = poll_interval
+
+        self._cond = threading.Condition()
+        self._session_buckets = OrderedDict()
+        self._queues = OrderedDict()   # 会话ID -> 排队中的Ticket；顺序即轮转顺序
+        self._queued = 0
+        self._active = 0
+
+    # ==================== 提交与放行 ====================
+
+    def submit(self, session_id):
+        """
+        提交一次请求并排队
+
+        返回:
+            Ticket（可能已经放行）
+
+        异常:
+            AdmissionRejected: 会话发送过快或队列已满
+        """
+        with self._cond:
+            if self._queued >= self.max_queue:
+                metrics.ADMISSION.inc(outcome="queue_full")
+                raise AdmissionRejected("queue_full", "当前咨询的人数较多，请稍等片刻再发送。",
+                                        retry_after=self.max_wait)
+
+            bucket = self._session_bucket(session_id)
+            if bucket is not None and not bucket.try_acquire():
+                retry_after = bucket.wait_time()
+                metrics.ADMISSION.inc(outcome="session_rate")
+                raise AdmissionRejected("session_rate",
+                                        f"您发送得有点快，请 {math.ceil(retry_after)} 秒后再试。", retry_after)
+
+            ticket = Ticket(self, session_id)
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            self._queued += 1
+            self._dispatch()
+        return ticket
+
+    def acquire(self, session_id, on_position=None):
+        """submit() 并等待放行"""
+        return self.submit(session_id).wait(on_position)
+
+    def _session_bucket(self, session_id):
+        if self.session_rate <= 0:
+            return None
+        bucket = self._session_buckets.get(session_id)
+        if bucket is None:
+            bucket = self._session_buckets[session_id] = TokenBucket(self.session_rate, self.session_burst)
+            while len(self._session_buckets) > self.max_sessions:
+                self._session_buckets.popitem(last=False)
+        else:
+            self._session_buckets.move_to_end(session_id)
+        return bucket
+
+    def _dispatch(self):
+        """在并发名额和全局令牌允许的范围内，按会话轮转放行排队的请求（需持有锁）"""
+        granted = False
+        while self._queues and self._active < self.max_concurrent:
+            if self.global_bucket is not None and not self.global_bucket.try_acquire():
+                break
+            session_id, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            if queue:
+                # 该会话还有排队的请求，轮到队尾
+                self._queues.move_to_end(session_id)
+            else:
+                del self._queues[session_id]
+            self._queued -= 1
+            self._active += 1
+            ticket.granted = True
+            granted = True
+            metrics.ADMISSION.inc(outcome="admitted")
+            metrics.ADMISSION_WAIT.observe(time.monotonic() - ticket.enqueued)
+        if granted:
+            self._cond.notify_all()
+
+    def _poll(self, ticket):
+        """
+        调度一次（需持有锁）
+
+        返回:
+            已放行时返回None，否则返回剩余的排队时间（秒）
+
+        异常:
+            AdmissionRejected: 超过最长排队时间
+        """
+        self._dispatch()
+        if ticket.granted:
+            return None
+        remaining = ticket.enqueued + self.max_wait - time.monotonic()
+        if remaining <= 0:
+            self._remove(ticket)
+            metrics.ADMISSION.inc(outcome="timeout")
+            raise AdmissionRejected("timeout", "排队时间过长，请稍后再试。", retry_after=self.max_wait)
+        return remaining
+
+    def wait(self, ticket, on_position=None):
+        """等待 ticket 放行，参见 Ticket.wait()"""
+        last_position = None
+        try:
+            while True:
+                with self._cond:
+                    remaining = self._poll(ticket)
+                    if remaining is None:
+                        return
+                    position = self._position(ticket)
+
+                # 回调在锁外执行（可能涉及界面更新）
+                if on_position is not None and position != last_position:
+                    on_position(position)
+                    last_position = position
+
+                with self._cond:
+                    if not ticket.granted:
+                        self._cond.wait(min(remaining, self.poll_interval))
+        except AdmissionRejected:
+            raise
+        except BaseException:
+            # 调用方中途离开（如页面重新执行）时让出位置或名额
+            self.release(ticket)
+            raise
+
+    async def wait_async(self, ticket):
+        """等待 ticket 放行，参见 Ticket.wait_async()"""
+        try:
+            while True:
+                with self._cond:
+                    remaining = self._poll(ticket)
+                if remaining is None:
+                    return
+                await asyncio.sleep(min(remaining, self.poll_interval))
+        except AdmissionRejected:
+            raise
+        except BaseException:
+            # 客户端断开时让出位置或名额
+            self.release(ticket)
+            raise
+
+    def release(self, ticket):
+        """归还并发名额；尚未放行的请求则从队列中移除"""
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted:
+                self._active -= 1
+                self._dispatch()
+                self._cond.notify_all()
+            else:
+                self._remove(ticket)
+
+    def _remove(self, ticket):
+        queue = self._queues.get(ticket.session_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            self._queued -= 1
+            if not queue:
+                del self._queues[ticket.session_id]
+        ticket.released = True
+
+    # ==================== 查询 ====================
+
+    def position(self, ticket):
+        with self._cond:
+            return self._position(ticket)
+
+    def _position(self, ticket):
+        """
+        按轮转顺序估算排队位置：同一会话中排在前面的请求，
+        加上其他会话在轮到本请求之前会被放行的请求
+        """
+        if ticket.granted:
+            return 0
+        queue = self._queues.get(ticket.session_id)
+        if queue is None or ticket not in queue:
+            return 0
+        index = queue.index(ticket)
+        ahead = index
+        before = True
+        for session_id, other in self._queues.items():
+            if session_id == ticket.session_id:
+                before = False
+                continue
+            ahead += min(len(other), index + (1 if before else 0))
+        return ahead + 1
+
+    def stats(self):
+        with self._cond:
+            return {"active": self._active, "queued": self._queued, "waiting_sessions": len(self._queues)}
+
+
+def controller_from_env():
+    """根据环境变量创建准入控制器，关闭时返回None"""
+    if os.getenv("TCM_ADMISSION", "on").strip().lower() in ("0", "off", "false"):
+        return None
+    return AdmissionController(
+        max_concurrent=int(os.getenv("TCM_MAX_CONCURRENT_REPLIES", DEFAULT_MAX_CONCURRENT)),
+        max_queue=int(os.getenv("TCM_QUEUE_MAX", DEFAULT_MAX_QUEUE)),
+        max_wait=float(os.getenv("TCM_QUEUE_MAX_WAIT", DEFAULT_MAX_WAIT)),
+        global_rate=float(os.getenv("TCM_GLOBAL_RATE", DEFAULT_GLOBAL_RATE)),
+        global_burst=float(os.getenv("TCM_GLOBAL_BURST", DEFAULT_GLOBAL_BURST)),
+        session_rate=float(os.getenv("TCM_SESSION_RATE", DEFAULT_SESSION_RATE)),
+        session_burst=float(os.getenv("TCM_SESSION_BURST", DEFAULT_SESSION_BURST)),
+        state=shared_state.get_state(),
+    )
+
+
+# 进程级共享的准入控制器
+_controller = None
+_controller_loaded = False
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    """获取所有会话共享的准入控制器（线程安全，首次调用时创建；关闭时返回None）"""
+    global _controller, _controller_loaded
+    if not _controller_loaded:
+        with _controller_lock:
+            if not _controller_loaded:
+                _controller = controller_from_env()
+                _controller_loaded = True
+    return _controller
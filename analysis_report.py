@@ -0,0 +1,143 @@
+"""
+分节分析报告
+
+analyze() 把整份报告作为一次2000 token的长回复顺序生成，耗时随全文长度增长。
+分节报告先单独完成辨证分析，再以辨证结论为共同上下文并行生成各节建议，
+端到端耗时约为 辨证 + 最长的一节，而不是全部章节之和。
+
+生成过程以 SectionDelta 事件流的形式返回（每节一个槽位，各节的文本块交错到达），
+AnalysisReport 收集事件得到按节组织的结果。
+
+环境变量:
+    TCM_REPORT_MAX_PARALLEL: 同时生成的章节数上限，默认5（即全部并行）
+"""
+import os
+
+DIAGNOSIS = "diagnosis"
+DEFAULT_MAX_PARALLEL = 5
+
+
+class SectionSpec:
+    """报告中的一节"""
+
+    __slots__ = ("key", "title", "max_tokens")
+
+    def __init__(self, key, title, max_tokens):
+        self.key = key
+        self.title = title
+        self.max_tokens = max_tokens
+
+
+# 第一步：辨证分析（其余各节的共同上下文）
+DIAGNOSIS_SECTION = SectionSpec(DIAGNOSIS, "中医辨证分析", 600)
+
+# 第二步：并行生成的各节建议（按报告中的顺序）
+ADVICE_SECTIONS = (
+    SectionSpec("diet", "饮食调理", 600),
+    SectionSpec("lifestyle", "生活起居", 450),
+    SectionSpec("exercise", "运动养生", 450),
+    SectionSpec("other", "其他调理", 450),
+    SectionSpec("reminders", "重要提醒", 400),
+)
+
+SECTIONS = (DIAGNOSIS_SECTION,) + ADVICE_SECTIONS
+
+
+class SectionDelta:
+    """生成过程中的一个事件：某一节的新文本块，或该节结束"""
+
+    __slots__ = ("key", "text", "done", "error")
+
+    def __init__(self, key, text="", done=False, error=None):
+        """
+        参数:
+            key: 章节键（SectionSpec.key）
+            text: 新到达的文本块
+            done: 该节是否已经结束
+            error: 该节失败时的 resilience.LLMError，其余章节不受影响
+        """
+        self.key = key
+        self.text = text
+        self.done = done
+        self.error = error
+
+    def __repr__(self):
+        return f"SectionDelta({self.key!r}, {self.text!r}, done={self.done})"
+
+
+class SectionResult:
+    """一节的生成结果"""
+
+    __slots__ = ("key", "title", "parts", "status", "error")
+
+    def __init__(self, spec):
+        self.key = spec.key
+        self.title = spec.title
+        self.parts = []
+        self.status = "pending"   # pending / streaming / ok / error
+        self.error = None
+
+    @property
+    def content(self):
+        return "".join(self.parts)
+
+    def to_dict(self):
+        return {"key": self.key, "title": self.title, "status": self.status, "content": self.content,
+                "error": str(self.error) if self.error is not None else None}
+
+
+class AnalysisReport:
+    """按节组织的分析报告"""
+
+    def __init__(self, sections=SECTIONS):
+        self.sections = {spec.key: SectionResult(spec) for spec in sections}
+
+    def __getitem__(self, key):
+        return self.sections[key]
+
+    def __iter__(self):
+        return iter(self.sections.values())
+
+    @property
+    def diagnosis(self):
+        return self.sections[DIAGNOSIS]
+
+    @property
+    def complete(self):
+        """所有章节都已成功生成"""
+        return all(section.status == "ok" for section in self)
+
+    def apply(self, delta):
+        """收集一个 SectionDelta 事件"""
+        section = self.sections[delta.key]
+        if delta.text:
+            section.parts.append(delta.text)
+            section.status = "streaming"
+        if delta.done:
+            section.status = "error" if delta.error is not None else "ok"
+            section.error = delta.error
+
+    @classmethod
+    def collect(cls, deltas):
+        """消费整个事件流并返回报告"""
+        report = cls()
+        for delta in deltas:
+            report.apply(delta)
+        return report
+
+    def to_markdown(self):
+        """渲染为与 analyze() 相近的单个markdown文本（失败的章节给出提示）"""
+        blocks = []
+        for section in self:
+            content = section.content.strip()
+            if section.status == "error" and not content:
+                content = f"*本节生成失败：{section.error}*"
+            blocks.append(f"### {section.title}\n\n{content}")
+        return "\n\n".join(blocks)
+
+    def to_dict(self):
+        return {"complete": self.complete, "sections": [section.to_dict() for section in self]}
+
+
+def max_parallel_from_env():
+    return max(int(os.getenv("TCM_REPORT_MAX_PARALLEL", DEFAULT_MAX_PARALLEL)), 1)
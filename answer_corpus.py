@@ -0,0 +1,324 @@
+"""
+预生成回复语料
+
+聊天页面的快速选择按钮只有六个常见症状，年龄段和性别的组合也很有限，这些首轮提问的回复可以离线预先生成。
+语料以紧凑的只读文件保存，服务时以内存映射方式打开，匹配的首轮提问直接回放，不调用模型。
+
+每条回复带有版本戳（模型名 + 所用系统提示词模板的指纹，知识库提示词还包括知识库版本）：
+提示词、知识库或模型变化后，版本戳不再一致的回复不会被使用；重新运行生成任务时只重新生成这些回复。
+
+文件布局（小端）：
+    文件头      魔数、条目数、索引表偏移、元数据偏移与长度
+    索引表      每条 (键偏移, 键长度, 回复偏移, 回复长度, 版本戳)，按键排序，查找时二分
+    数据区      键、回复（UTF-8）与元数据（JSON）
+
+用法:
+    python -m answer_corpus build                       # 生成或增量更新语料
+    python -m answer_corpus build --workers 4 --rate 2
+    python -m answer_corpus stats
+
+环境变量:
+    TCM_CORPUS: off 关闭预生成回复（默认开启，语料文件不存在时自动跳过）
+    TCM_CORPUS_PATH: 语料文件路径，默认 answer_corpus.bin（进程启动后首次使用时打开，更新语料后需重启）
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import response_cache
+
+DEFAULT_PATH = "answer_corpus.bin"
+DEFAULT_WORKERS = 4
+DEFAULT_RATE = 2.0
+
+MAGIC = b"TCMANS\x00\x01"
+HEADER = struct.Struct("<8sIIII")
+ENTRY = struct.Struct("<IIII16s")
+
+# 预生成的年龄段：(年龄段, 生成时传给分析器的年龄)；提示词中写成"30-44岁"，回复不会出现具体年龄
+PROFILE_AGES = (("未提供", "未提供"),) + tuple(
+    (label, label[:-1]) for _, label in response_cache.AGE_BUCKETS
+) + (("75岁以上", "75+"),)
+
+
+def corpus_key(text, bucket, gender):
+    """语料键：规整后的提问 + 年龄段 + 性别"""
+    return "\x1f".join((" ".join(text.split()), bucket, gender))
+
+
+def make_stamp(model, fingerprint):
+    """回复的版本戳，随模型（ModelRouter.model_key，即可能生成回复的所有模型）和提示词指纹变化"""
+    return hashlib.sha256(f"{model}\x00{fingerprint}".encode("utf-8")).digest()[:16]
+
+
+class AnswerCorpus:
+    """内存映射的预生成回复（只读，线程安全）"""
+
+    def __init__(self, buffer, mapping=None):
+        """
+        参数:
+            buffer: 语料文件内容（bytes 或 mmap）
+            mapping: 需要在 close() 时关闭的mmap，可选
+        """
+        magic, count, index_off, meta_off, meta_len = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("不是预生成回复语料文件")
+        self._buf = buffer
+        self._mapping = mapping
+        self._count = count
+        self._index_off = index_off
+        self.meta = json.loads(bytes(buffer[meta_off:meta_off + meta_len]).decode("utf-8"))
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, index):
+        return ENTRY.unpack_from(self._buf, self._index_off + index * ENTRY.size)
+
+    def _key(self, index):
+        key_off, key_len, _, _, _ = self._entry(index)
+        return bytes(self._buf[key_off:key_off + key_len])
+
+    def _find(self, key):
+        target = key.encode("utf-8")
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self._count and self._key(lo) == target else None
+
+    def get(self, key):
+        """按键读取，返回 (版本戳, 回复)，不存在时返回None"""
+        index = self._find(key)
+        if index is None:
+            return None
+        _, _, text_off, text_len, stamp = self._entry(index)
+        return stamp, bytes(self._buf[text_off:text_off + text_len]).decode("utf-8")
+
+    def contains(self, text, age, gender):
+        """是否收录了该首轮提问（不检查版本戳，用于在创建分析器之前快速判断）"""
+        return self._find(corpus_key(text, response_cache.age_bucket(age), gender)) is not None
+
+    def lookup(self, text, age, gender, stamp):
+        """
+        查找首轮提问的预生成回复
+
+        参数:
+            stamp: 当前请求的版本戳（make_stamp），与语料不一致时不返回
+
+        返回:
+            回复文本，未收录或已过期时返回None
+        """
+        found = self.get(corpus_key(text, response_cache.age_bucket(age), gender))
+        if found is None:
+            return None
+        if found[0] != stamp:
+            metrics.CORPUS.inc(outcome="stale")
+            return None
+        metrics.CORPUS.inc(outcome="hit")
+        return found[1]
+
+    def items(self):
+        """逐条返回 (键, 版本戳, 回复)"""
+        for index in range(self._count):
+            key_off, key_len, text_off, text_len, stamp = self._entry(index)
+            yield (bytes(self._buf[key_off:key_off + key_len]).decode("utf-8"), stamp,
+                   bytes(self._buf[text_off:text_off + text_len]).decode("utf-8"))
+
+    def close(self):
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+
+def open_corpus(path):
+    """以内存映射方式打开语料文件，不存在时返回None"""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            return None
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return AnswerCorpus(mapping, mapping)
+
+
+def write_corpus(path, entries, meta=None):
+    """
+    写入语料文件（先写临时文件再替换，正在映射旧文件的进程不受影响）
+
+    参数:
+        entries: {键: (版本戳, 回复)}
+        meta: 可选的元数据
+    """
+    keys = sorted(entries, key=lambda k: k.encode("utf-8"))
+    blob = bytearray()
+    index = []
+    data_off = HEADER.size + ENTRY.size * len(keys)
+    for key in keys:
+        stamp, text = entries[key]
+        key_bytes = key.encode("utf-8")
+        text_bytes = text.encode("utf-8")
+        key_off = data_off + len(blob)
+        blob += key_bytes
+        text_off = data_off + len(blob)
+        blob += text_bytes
+        index.append(ENTRY.pack(key_off, len(key_bytes), text_off, len(text_bytes), stamp))
+    meta_bytes = json.dumps(meta or {}, ensure_ascii=False).encode("utf-8")
+    meta_off = data_off + len(blob)
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(keys), HEADER.size, meta_off, len(meta_bytes)))
+        f.write(b"".join(index))
+        f.write(blob)
+        f.write(meta_bytes)
+    os.replace(tmp, path)
+
+
+# ==================== 生成 ====================
+
+def build(path=DEFAULT_PATH, complaints=None, analyzer=None, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE,
+          progress=None):
+    """
+    生成或增量更新语料：版本戳未变的回复直接保留，其余的重新生成
+
+    参数:
+        path: 语料文件路径（已存在时增量更新）
+        complaints: 首轮提问列表，默认为聊天页面的快速选择症状
+        analyzer: 可选的分析器，默认创建不使用任何缓存的 TCMAnalyzer
+        workers: 并发线程数
+        rate: 每秒最多发起的请求数
+        progress: 可选回调 progress(summary)，每完成一条调用一次
+
+    返回:
+        {"reused": 保留数, "generated": 生成数, "error": 失败数, "skipped": 危险信号等不需要生成的提问数}
+    """
+    from rate_limit import TokenBucket
+    import ui_assets
+
+    if complaints is None:
+        complaints = [text for _, text in ui_assets.COMMON_ISSUES]
+    if analyzer is None:
+        from llm_service import TCMAnalyzer
+        analyzer = TCMAnalyzer(cache=None, semantic_cache=None, summarizer=None)
+        analyzer.single_flight = None
+    # 生成时不能读取语料本身
+    analyzer.corpus = None
+
+    existing = open_corpus(path)
+    entries = {}
+    jobs = []
+    summary = {"reused": 0, "generated": 0, "error": 0, "skipped": 0}
+    for text in complaints:
+        for bucket, age in PROFILE_AGES:
+            for gender in ui_assets.GENDER_OPTIONS:
+                messages = [{"role": "user", "content": text}]
+                request = analyzer._prepare_chat(messages, age, gender)
+                if request.triage is not None and request.triage.urgent:
+                    summary["skipped"] += 1
+                    continue
+                key = corpus_key(text, bucket, gender)
+                stamp = make_stamp(request.models, request.fingerprint)
+                found = existing.get(key) if existing is not None else None
+                if found is not None and found[0] == stamp:
+                    entries[key] = found
+                    summary["reused"] += 1
+                else:
+                    jobs.append((key, stamp, messages, age, gender))
+    if existing is not None:
+        existing.close()
+
+    bucket = TokenBucket(rate)
+    lock = threading.Lock()
+
+    def generate(job):
+        key, stamp, messages, age, gender = job
+        bucket.acquire()
+        try:
+            reply = "".join(analyzer.chat_streaming(messages, age, gender))
+        except Exception:
+            outcome = "error"
+        else:
+            outcome = "generated"
+        with lock:
+            if outcome == "generated":
+                entries[key] = (stamp, reply)
+            summary[outcome] += 1
+            if progress is not None:
+                progress(dict(summary))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(generate, jobs))
+
+    write_corpus(path, entries, {"model": analyzer.model, "generated_at": time.strftime("%Y-%m-%d %H:%M:%S")})
+    return summary
+
+
+# ==================== 服务 ====================
+
+def corpus_enabled():
+    return os.getenv("TCM_CORPUS", "on").strip().lower() not in ("0", "off", "false")
+
+
+# 进程级共享的语料
+_corpus = None
+_corpus_loaded = False
+_corpus_lock = threading.Lock()
+
+
+def get_corpus():
+    """获取进程内共享的语料（线程安全，首次调用时打开；关闭或文件不存在时返回None）"""
+    global _corpus, _corpus_loaded
+    if not _corpus_loaded:
+        with _corpus_lock:
+            if not _corpus_loaded:
+                if corpus_enabled():
+                    _corpus = open_corpus(os.getenv("TCM_CORPUS_PATH", DEFAULT_PATH))
+                _corpus_loaded = True
+    return _corpus
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="预生成回复语料")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_parser = sub.add_parser("build", help="生成或增量更新语料")
+    build_parser.add_argument("--output", default=os.getenv("TCM_CORPUS_PATH", DEFAULT_PATH))
+    build_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="并发线程数")
+    build_parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="每秒最多发起的请求数")
+    stats_parser = sub.add_parser("stats", help="查看语料")
+    stats_parser.add_argument("--path", default=os.getenv("TCM_CORPUS_PATH", DEFAULT_PATH))
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        def progress(summary):
+            print(f"\r已生成 {summary['generated']}，失败 {summary['error']}", end="", flush=True)
+
+        started = time.perf_counter()
+        summary = build(args.output, workers=args.workers, rate=args.rate, progress=progress)
+        print(f"\n保留 {summary['reused']}，生成 {summary['generated']}，失败 {summary['error']}，"
+              f"跳过 {summary['skipped']}（{time.perf_counter() - started:.1f}s）")
+        return
+
+    corpus = open_corpus(args.path)
+    if corpus is None:
+        print(f"{args.path} 不存在")
+        return
+    print(f"条目数: {len(corpus)}  文件大小: {os.path.getsize(args.path)} 字节  元数据: {corpus.meta}")
+    for key, stamp, text in corpus.items():
+        print(f"{stamp.hex()}  {key.replace(chr(0x1f), ' | ')}  {len(text)}字")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+无界面的流式HTTP服务
+
+与Streamlit界面并行运行，供移动端和合作方集成调用。基于 Starlette + uvicorn（Streamlit已依赖二者），
+每个工作进程在自己的事件循环中持有一个 AsyncTCMAnalyzer，请求直接进入异步引擎，
+没有Streamlit的脚本重新执行和websocket开销。
+
+接口（请求体均为JSON，回复以Server-Sent Events流式返回）:
+    POST /v1/chat      {"messages": [{"role": "user", "content": "..."}], "profile": {"age": 35, "gender": "女"}}
+                       完整的对话历史由调用方提供；病例摘要按会话保存在各工作进程内，不对外开放
+    POST /v1/analyze   {"symptoms": "...", "profile": {"age": 35, "gender": "女", "duration": "1-3天"}}
+    POST /v1/report    请求体同 /v1/analyze，分节报告，每个事件带章节键
+    GET  /healthz      存活检查
+    GET  /metrics      Prometheus文本格式的指标（处理该请求的工作进程）
+
+三个流式接口在调用分析器之前经过准入控制（admission，与界面使用相同的配置），
+按客户端地址区分调用方（请求头中的API Key未经校验，不用于区分）；
+未放行时返回 429 和 Retry-After，响应体为 {"error": "...", "reason": "session_rate/queue_full/timeout"}。
+
+SSE事件:
+    event: delta    data: {"text": "..."}                          （/v1/report 额外带 "section"）
+    event: section  data: {"section": "...", "error": null}        （/v1/report 某一节结束）
+    event: done     data: {}
+    event: error    data: {"type": "LLMRateLimitError", "message": "...", "retryable": true}
+
+用法:
+    python -m api_server --host 0.0.0.0 --port 8000 --workers 4
+
+环境变量:
+    TCM_API_WORKERS: 工作进程数，默认为CPU核数
+    其余配置（OPENAI_API_KEY、TCM_BACKENDS、TCM_MAX_INFLIGHT 等）与界面相同
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+import admission
+import metrics
+import resilience
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # 关闭反向代理的缓冲
+}
+
+ROLES = ("user", "assistant")
+MAX_MESSAGES = 200
+MAX_CONTENT_CHARS = 20000
+
+
+class BadRequest(Exception):
+    """请求体不合法"""
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _error_event(error):
+    if not isinstance(error, resilience.LLMError):
+        error = resilience.translate_error(error)
+    return _sse("error", {"type": type(error).__name__, "message": str(error), "retryable": error.retryable,
+                          "retry_after": error.retry_after})
+
+
+# ==================== 请求解析 ====================
+
+async def _json_body(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        raise BadRequest("请求体不是合法的JSON")
+    if not isinstance(body, dict):
+        raise BadRequest("请求体必须是JSON对象")
+    return body
+
+
+def _profile(body, fields):
+    """读取 profile 中提供了的字段（未提供的使用分析器的默认值）"""
+    profile = body.get("profile") or {}
+    if not isinstance(profile, dict):
+        raise BadRequest("profile 必须是对象")
+    kwargs = {}
+    for name in fields:
+        value = profile.get(name)
+        if value is None:
+            continue
+        if name == "age":
+            if not isinstance(value, int) or not 0 < value <= 120:
+                raise BadRequest("profile.age 必须是1-120的整数")
+        elif not isinstance(value, str):
+            raise BadRequest(f"profile.{name} 必须是字符串")
+        kwargs[name] = value
+    return kwargs
+
+
+def _messages(body):
+    messages = body.get("messages")
+    if not isinstance(messages, list) or not messages:
+        raise BadRequest("messages 必须是非空数组")
+    if len(messages) > MAX_MESSAGES:
+        raise BadRequest(f"messages 最多 {MAX_MESSAGES} 条")
+    cleaned = []
+    for message in messages:
+        if not isinstance(message, dict) or message.get("role") not in ROLES:
+            raise BadRequest("每条消息必须包含 role（user/assistant）")
+        content = message.get("content")
+        if not isinstance(content, str) or not content.strip():
+            raise BadRequest("每条消息必须包含非空的 content")
+        if len(content) > MAX_CONTENT_CHARS:
+            raise BadRequest(f"单条消息最多 {MAX_CONTENT_CHARS} 个字符")
+        cleaned.append({"role": message["role"], "content": content})
+    if cleaned[-1]["role"] != "user":
+        raise BadRequest("最后一条消息必须来自用户")
+    return cleaned
+
+
+def _symptoms(body):
+    symptoms = body.get("symptoms")
+    if not isinstance(symptoms, str) or not symptoms.strip():
+        raise BadRequest("symptoms 必须是非空字符串")
+    if len(symptoms) > MAX_CONTENT_CHARS:
+        raise BadRequest(f"symptoms 最多 {MAX_CONTENT_CHARS} 个字符")
+    return symptoms.strip()
+
+
+# ==================== 流式回复 ====================
+
+async def _text_events(chunks):
+    """
+    把文本块流转换为SSE事件；出错时以 error 事件结束（响应头已经发出，无法再改状态码）
+
+    客户端断开时Starlette取消本协程，离开 async with 块即关闭分析器的流和上游HTTP响应
+    """
+    try:
+        async with chunks:
+            async for text in chunks:
+                yield _sse("delta", {"text": text})
+        yield _sse("done", {})
+    except Exception as e:
+        yield _error_event(e)
+
+
+async def _report_events(deltas):
+    try:
+        async with deltas:
+            async for delta in deltas:
+                if delta.text:
+                    yield _sse("delta", {"section": delta.key, "text": delta.text})
+                if delta.done:
+                    yield _sse("section", {"section": delta.key,
+                                           "error": str(delta.error) if delta.error is not None else None})
+        yield _sse("done", {})
+    except Exception as e:
+        yield _error_event(e)
+
+
+async def _released(events, ticket):
+    """回复结束（或客户端断开）时归还并发名额"""
+    try:
+        async for event in events:
+            yield event
+    finally:
+        ticket.release()
+
+
+def _stream(events, ticket=None):
+    if ticket is None:
+        return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS)
+    # 响应在开始迭代之前就被取消时生成器不会执行 finally，由后台任务兜底（release 可重复调用）
+    return StreamingResponse(_released(events, ticket), media_type="text/event-stream", headers=SSE_HEADERS,
+                             background=BackgroundTask(ticket.release))
+
+
+# ==================== 准入控制 ====================
+
+def _client_key(request):
+    """
+    准入控制中的调用方：客户端地址
+
+    本服务不校验 X-API-Key / Authorization，调用方可以随意更换请求头，按请求头区分会绕过限流
+    """
+    return "ip:" + (request.client.host if request.client is not None else "unknown")
+
+
+async def _admit(request):
+    """
+    排队等待生成名额
+
+    返回:
+        admission.Ticket；未启用准入控制时返回None
+
+    异常:
+        admission.AdmissionRejected: 调用方发送过快、队列已满或排队超时
+    """
+    controller = admission.get_controller()
+    if controller is None:
+        return None
+    return await controller.submit(_client_key(request)).wait_async()
+
+
+def _rejected(error):
+    retry_after = math.ceil(error.retry_after) if error.retry_after else 1
+    return JSONResponse({"error": error.message, "reason": error.reason}, status_code=429,
+                        headers={"Retry-After": str(retry_after)})
+
+
+def _endpoint(handler):
+    """统一处理请求体错误，请求体合法后经过准入控制再开始流式回复"""
+    async def endpoint(request):
+        try:
+            events = await handler(request, request.app.state.analyzer)
+            ticket = await _admit(request)
+        except BadRequest as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        except admission.AdmissionRejected as e:
+            return _rejected(e)
+        return _stream(events, ticket)
+    return endpoint
+
+
+async def chat(request, analyzer):
+    body = await _json_body(request)
+    messages = _messages(body)
+    kwargs = _profile(body, ("age", "gender"))
+    return _text_events(analyzer.chat_streaming(messages, **kwargs))
+
+
+async def analyze(request, analyzer):
+    body = await _json_body(request)
+    symptoms = _symptoms(body)
+    kwargs = _profile(body, ("age", "gender", "duration"))
+    return _text_events(analyzer.analyze_streaming(symptoms, **kwargs))
+
+
+async def report(request, analyzer):
+    body = await _json_body(request)
+    symptoms = _symptoms(body)
+    kwargs = _profile(body, ("age", "gender", "duration"))
+    return _report_events(analyzer.analyze_report_streaming(symptoms, **kwargs))
+
+
+async def healthz(request):
+    analyzer = request.app.state.analyzer
+    return JSONResponse({"status": "ok", "pid": os.getpid(), "inflight": analyzer.inflight})
+
+
+async def prometheus(request):
+    return PlainTextResponse(metrics.export_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # 每个工作进程在自己的事件循环中创建异步引擎
+    from async_llm_service import AsyncTCMAnalyzer
+    app.state.analyzer = AsyncTCMAnalyzer()
+    try:
+        yield
+    finally:
+        await app.state.analyzer.aclose()
+
+
+def create_app():
+    return Starlette(
+        routes=[
+            Route("/v1/chat", _endpoint(chat), methods=["POST"]),
+            Route("/v1/analyze", _endpoint(analyze), methods=["POST"]),
+            Route("/v1/report", _endpoint(report), methods=["POST"]),
+            Route("/healthz", healthz),
+            Route("/metrics", prometheus),
+        ],
+        lifespan=lifespan,
+    )
+
+
+app = create_app()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="中医智能小助手流式HTTP服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("TCM_API_WORKERS", os.cpu_count() or 1)),
+                        help="工作进程数，默认为CPU核数")
+    parser.add_argument("--log-level", default="warning")
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    # 多进程时 uvicorn 需要以导入路径加载应用
+    uvicorn.run("api_server:app", host=args.host, port=args.port, workers=args.workers,
+                log_level=args.log_level, access_log=False)
+
+
+if __name__ == "__main__":
+    main()
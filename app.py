@@ -1,7 +1,15 @@
 import streamlit as st
-import os
-import time
-from llm_service import TCMAnalyzer
+import contextlib
+import admission
+import answer_corpus
+import metrics
+import profiling
+import ui_assets
+from conversation_store import get_store
+from stream_renderer import StreamRenderer
+
+# 开启剖析（TCM_PROFILE）时记录本次运行的耗时，未开启时为空操作
+rerun_profile = profiling.start_rerun()
 
 # 页面配置
 st.set_page_config(
@@ -11,92 +19,43 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+# 对话记录保存在共享的对话存储中，session_state 只保存会话ID
+store = get_store()
+
+
+def start_new_session():
+    """开始新对话，并把会话ID写入URL以便刷新后恢复"""
+    st.session_state.session_id = store.new_session()
+    st.session_state.awaiting_reply = False
+    st.session_state.report_reply = False
+    st.query_params["session"] = st.session_state.session_id
+
+
 # 初始化session state
 if 'page' not in st.session_state:
-    st.session_state.page = 'welcome'
-if 'chat_history' not in st.session_state:
-    st.session_state.chat_history = []
-if 'show_welcome_message' not in st.session_state:
-    st.session_state.show_welcome_message = True
+    # 通过URL中的会话ID恢复之前的对话
+    resume_id = st.query_params.get("session")
+    if resume_id and store.turn_count(resume_id) > 0:
+        st.session_state.page = 'chat'
+        st.session_state.session_id = resume_id
+        st.session_state.awaiting_reply = False
+        st.session_state.report_reply = False
+    else:
+        st.session_state.page = 'welcome'
+if 'session_id' not in st.session_state:
+    start_new_session()
 if 'user_info' not in st.session_state:
     st.session_state.user_info = {'age': None, 'gender': '不方便透露'}
 
 # 自定义CSS样式
-st.markdown("""
-<style>
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-    header {visibility: hidden;}
-
-    /* 移动端优化 */
-    html, body {
-        overflow-x: hidden;
-    }
-
-    .block-container {
-        padding-top: 1rem;
-        padding-bottom: 0rem;
-        max-width: 800px;
-    }
-
-    /* 优化按钮样式 */
-    .stButton button {
-        border-radius: 8px;
-        transition: all 0.3s ease;
-    }
-
-    .stButton button:hover {
-        transform: translateY(-2px);
-        box-shadow: 0 4px 12px rgba(0,0,0,0.15);
-    }
-
-    /* 优化聊天消息样式 */
-    .stChatMessage {
-        border-radius: 12px;
-        margin-bottom: 8px;
-    }
-
-    /* 优化输入框样式 - 移除sticky定位 */
-    .stChatInput {
-        border-radius: 12px;
-    }
-
-</style>
-""", unsafe_allow_html=True)
+st.markdown(ui_assets.APP_CSS, unsafe_allow_html=True)
 
 # ==================== 欢迎页面 ====================
 def show_welcome_page():
-    st.markdown("""
-    <div style="text-align: center; margin-top: 8vh;">
-        <h1 style="font-size: 48px; margin-bottom: 20px;
-                   background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                   -webkit-background-clip: text;
-                   -webkit-text-fill-color: transparent;
-                   font-weight: 700;">
-            🌿 中医智能小助手
-        </h1>
-        <p style="font-size: 18px; color: #666; margin-bottom: 50px; line-height: 1.6;">
-            结合传统中医智慧与现代AI技术<br>为您提供个性化养生建议
-        </p>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(ui_assets.WELCOME_HERO_HTML, unsafe_allow_html=True)
 
     # 功能特色 - 卡片式布局
-    st.markdown("""
-    <div style="text-align: center; margin: 40px auto; max-width: 600px;">
-        <div style="background: linear-gradient(135deg, #f5f7fa 0%, #c3cfe2 100%);
-                    border-radius: 16px;
-                    padding: 30px;
-                    box-shadow: 0 8px 24px rgba(0,0,0,0.12);">
-            <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 20px; text-align: center;">
-                <div><span style="font-size: 24px;">🤖</span><br><strong>AI智能分析</strong></div>
-                <div><span style="font-size: 24px;">🎯</span><br><strong>精准辨证</strong></div>
-                <div><span style="font-size: 24px;">💊</span><br><strong>养生建议</strong></div>
-                <div><span style="font-size: 24px;">🔒</span><br><strong>隐私保护</strong></div>
-            </div>
-        </div>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(ui_assets.FEATURES_HTML, unsafe_allow_html=True)
 
     st.markdown("<br>", unsafe_allow_html=True)
     st.info("⚠️ **免责声明**：本产品仅为 AI 技术演示，内容仅供参考，不能替代专业医疗诊断。")
@@ -106,14 +65,9 @@ def show_welcome_page():
     with col2:
         if st.button("🩺 开始问诊", type="primary", use_container_width=True, key="enter_chat"):
             st.session_state.page = 'chat'
-            st.session_state.show_welcome_message = True
             st.rerun()
 
-    st.markdown("""
-    <div style="text-align: center; color: #999; font-size: 13px; margin-top: 60px;">
-        © 2025 中医智能小助手 v1.6 | Powered by Claude AI
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(ui_assets.FOOTER_HTML, unsafe_allow_html=True)
 
 # ==================== 对话页面 ====================
 def show_chat_page():
@@ -121,52 +75,60 @@ def show_chat_page():
     col1, col2, col3 = st.columns([1, 3, 1])
     with col1:
         if st.button("← 返回", key="back_btn"):
-            if len(st.session_state.chat_history) > 1:
+            if store.turn_count(st.session_state.session_id) > 0:
                 st.session_state.page = 'confirm_exit'
                 st.rerun()
             else:
                 # 返回首页时清除状态
                 st.session_state.page = 'welcome'
-                st.session_state.chat_history = []
-                st.session_state.show_welcome_message = True
+                start_new_session()
                 st.rerun()
     with col2:
         st.markdown("<h3 style='text-align: center; color: #667eea; margin: 0;'>🌿 中医智能小助手</h3>",
                    unsafe_allow_html=True)
     with col3:
         if st.button("🔄 新对话", key="new_chat"):
-            st.session_state.chat_history = []
-            st.session_state.show_welcome_message = True
+            start_new_session()
             st.rerun()
 
     st.markdown("---")
 
-    # 首次进入显示欢迎消息
-    if st.session_state.show_welcome_message:
-        st.session_state.show_welcome_message = False
-        welcome_msg = {
-            'role': 'assistant',
-            'content': "您好！我是您的中医智能小助手 🌿\n\n我可以帮您从中医角度分析身体症状，提供个性化养生建议。\n\n请告诉我您的症状或健康问题："
-        }
-        st.session_state.chat_history.append(welcome_msg)
+    session_id = st.session_state.session_id
+    # 内存中只保留最近若干轮，更早的记录在对话存储的磁盘部分
+    history = store.recent(session_id)
 
     # 对话历史容器 - 使用更小的高度以确保下方元素可见
     chat_container = st.container(height=350)
 
     with chat_container:
-        for idx, message in enumerate(st.session_state.chat_history):
-            with st.chat_message(message['role'], avatar="🌿" if message['role'] == 'assistant' else "👤"):
-                # 如果是最后一条消息且内容为"正在分析中..."，在此处进行流式输出
-                if idx == len(st.session_state.chat_history) - 1 and message['content'] == "正在分析中...":
-                    # 在聊天框内直接进行流式输出
-                    full_response = get_ai_response_streaming()
-                    # 更新chat_history
-                    st.session_state.chat_history[-1] = {
-                        'role': 'assistant',
-                        'content': full_response
-                    }
-                else:
+        with rerun_profile.section("history"):
+            with st.chat_message('assistant', avatar="🌿"):
+                st.markdown(ui_assets.WELCOME_MESSAGE)
+            for message in history:
+                with st.chat_message(message['role'], avatar="🌿" if message['role'] == 'assistant' else "👤"):
                     st.markdown(message['content'])
+        # 用户刚发送消息时，在聊天框内直接进行流式输出
+        if st.session_state.awaiting_reply:
+            with st.chat_message('assistant', avatar="🌿"):
+                # 快速选择的首轮提问命中预生成语料时直接显示，不排队、不调用模型
+                precomputed = None if st.session_state.report_reply else get_precomputed_reply(history)
+                if precomputed is not None:
+                    st.markdown(precomputed)
+                    st.session_state.awaiting_reply = False
+                    store.append(session_id, 'assistant', precomputed)
+                else:
+                    # 点击后Streamlit中止本次运行，生成函数随即关闭上游请求并保存已生成的部分（新对话、返回同理）
+                    st.button("⏹ 停止生成", key="stop_reply")
+                    ticket = wait_for_admission(session_id)
+                    if ticket is not None:
+                        with ticket, rerun_profile.section(profiling.REPLY_SECTION):
+                            if st.session_state.report_reply:
+                                full_response = get_ai_report_streaming(history[-1]['content'])
+                            else:
+                                full_response = get_ai_response_streaming(history)
+                        st.session_state.awaiting_reply = False
+                        st.session_state.report_reply = False
+                        store.append(session_id, 'assistant', full_response)
 
     # 用户信息（折叠）- 放在快速选择之前避免UI重复
     with st.expander("📋 个人信息（可选）", expanded=False):
@@ -175,17 +137,12 @@ def show_chat_page():
         col1, col2 = st.columns(2)
 
         with col1:
-            # 年龄选择 - 使用selectbox避免默认值问题
-            age_options = ["未提供"] + list(range(1, 121))
-
-            if st.session_state.user_info['age'] is None:
-                default_age_index = 0  # "未提供"
-            else:
-                default_age_index = age_options.index(st.session_state.user_info['age'])
+            # 年龄选择 - 使用selectbox避免默认值问题（选项下标即年龄，0为"未提供"）
+            default_age_index = st.session_state.user_info['age'] or 0
 
             age_selection = st.selectbox(
                 "年龄",
-                options=age_options,
+                options=ui_assets.AGE_OPTIONS,
                 index=default_age_index,
                 key="user_age"
             )
@@ -200,40 +157,26 @@ def show_chat_page():
             # 性别选择
             gender = st.selectbox(
                 "性别",
-                ["不方便透露", "男", "女"],
-                index=["不方便透露", "男", "女"].index(st.session_state.user_info['gender']),
+                ui_assets.GENDER_OPTIONS,
+                index=ui_assets.GENDER_OPTIONS.index(st.session_state.user_info['gender']),
                 key="user_gender"
             )
             st.session_state.user_info['gender'] = gender
 
     # 常见症状快速选择（仅在只有欢迎消息时显示）
-    if len(st.session_state.chat_history) == 1:
+    first_turn = store.turn_count(session_id) == 0
+    if first_turn:
+        st.toggle("📑 分节报告（先辨证，再同时生成各项调理建议）", key="report_mode")
         st.markdown("**💡 常见症状快速选择：**")
-        common_issues = [
-            "😴 疲劳乏力、精神不振",
-            "🌙 失眠多梦、睡眠质量差",
-            "🍽️ 消化不良、胃胀腹胀",
-            "🤕 头痛头晕",
-            "😰 焦虑心烦、情绪低落",
-            "🦴 腰酸背痛、关节疼痛"
-        ]
-
         cols = st.columns(2)  # 改为2列，更适合移动端
-        for idx, issue in enumerate(common_issues):
+        for idx, (issue, clean_issue) in enumerate(ui_assets.COMMON_ISSUES):
             col_idx = idx % 2
             with cols[col_idx]:
                 if st.button(issue, key=f"quick_{idx}", use_container_width=True):
-                    # 移除emoji，只保留症状文字
-                    clean_issue = issue.split(' ', 1)[1] if ' ' in issue else issue
                     # 立即添加用户消息并显示
-                    st.session_state.chat_history.append({
-                        'role': 'user',
-                        'content': clean_issue
-                    })
-                    st.session_state.chat_history.append({
-                        'role': 'assistant',
-                        'content': "正在分析中..."
-                    })
+                    store.append(session_id, 'user', clean_issue)
+                    st.session_state.awaiting_reply = True
+                    st.session_state.report_reply = st.session_state.report_mode
                     st.rerun()
 
     # 输入框
@@ -242,50 +185,145 @@ def show_chat_page():
     # 处理发送
     if user_input and user_input.strip():
         # 立即添加用户消息
-        st.session_state.chat_history.append({
-            'role': 'user',
-            'content': user_input.strip()
-        })
-        st.session_state.chat_history.append({
-            'role': 'assistant',
-            'content': "正在分析中..."
-        })
+        store.append(session_id, 'user', user_input.strip())
+        st.session_state.awaiting_reply = True
+        st.session_state.report_reply = first_turn and st.session_state.get('report_mode', False)
         st.rerun()
 
-def get_ai_response_streaming():
+def wait_for_admission(session_id):
+    """
+    排队等待生成名额，排队期间显示前面还有几位
+
+    返回:
+        admission.Ticket（回复结束后需释放）；未启用准入控制时返回一个空的上下文；
+        被拒绝时显示提示并返回None，用户消息保留，可以稍后重新发送
+    """
+    controller = admission.get_controller()
+    if controller is None:
+        return contextlib.nullcontext()
+
+    status = st.empty()
+    try:
+        ticket = controller.submit(session_id)
+        ticket.wait(on_position=lambda position: status.caption(
+            f"⏳ 当前咨询的人数较多，您前面还有 {position - 1} 位，请稍候…" if position > 1
+            else "⏳ 马上就轮到您了…"))
+    except admission.AdmissionRejected as e:
+        status.warning(e.message)
+        if st.button("🔁 重新发送", key="retry_reply"):
+            st.rerun()
+        return None
+    status.empty()
+    return ticket
+
+def get_precomputed_reply(messages):
+    """首轮提问的预生成回复，未收录或已过期时返回None"""
+    corpus = answer_corpus.get_corpus()
+    if corpus is None or len(messages) != 1:
+        return None
+    age = st.session_state.user_info['age'] if st.session_state.user_info['age'] is not None else "未提供"
+    gender = st.session_state.user_info['gender']
+    # 先在语料中确认收录了该提问，未收录时不必为此导入分析器
+    if not corpus.contains(messages[0]['content'], age, gender):
+        return None
+    from llm_service import get_analyzer
+    return get_analyzer().precomputed_reply(messages, age=age, gender=gender)
+
+def save_stopped_reply(partial):
+    """
+    回复被中途停止（停止生成、新对话或返回）时调用：结束等待回复的状态，
+    已生成的部分加上说明保存到对话记录，后续追问以此为上下文；尚未生成任何内容时只保留用户消息
+    """
+    st.session_state.awaiting_reply = False
+    st.session_state.report_reply = False
+    if partial.strip():
+        store.append(st.session_state.session_id, 'assistant', partial + ui_assets.STOPPED_NOTE)
+
+def get_ai_response_streaming(messages):
     """在聊天框内流式获取并显示AI回复"""
     try:
-        analyzer = TCMAnalyzer()
-
-        # 构建对话上下文（排除"正在分析中..."）
-        messages = []
-        for msg in st.session_state.chat_history[:-1]:  # 排除最后的"正在分析中..."
-            if msg['role'] in ['user', 'assistant']:
-                if not ('我是您的中医智能小助手' in msg['content']):
-                    messages.append(msg)
+        # 首次回复时才导入分析器（及其依赖的openai等），不拖慢页面冷启动
+        from llm_service import get_analyzer
+        analyzer = get_analyzer()
 
         # 获取用户信息 - 如果未提供则传递字符串"未提供"
         age = st.session_state.user_info['age'] if st.session_state.user_info['age'] is not None else "未提供"
         gender = st.session_state.user_info['gender']
 
-        # 在当前位置创建占位符进行流式显示
-        text_placeholder = st.empty()
-        full_response = ""
+        # 在当前位置创建占位符进行流式显示（按时间/字符预算节流刷新）
+        renderer = StreamRenderer(st.empty())
+
+        # 流式获取AI回复并实时显示，结束后移除光标；离开with块时（包括被中止）立即关闭上游请求
+        try:
+            with analyzer.chat_streaming(
+                messages=messages,  # 由分析器按token预算裁剪历史，较早的轮次以病例摘要代替
+                age=age,
+                gender=gender,
+                session_id=st.session_state.session_id
+            ) as stream:
+                full_response = renderer.render(stream)
+        except Exception:
+            raise
+        except BaseException:
+            # 点击停止生成、新对话或返回时Streamlit中止本次运行，保留已生成的部分
+            save_stopped_reply(renderer.text)
+            raise
+
+        # 记录本次回复的渲染帧数与首帧耗时，便于观察websocket流量和端到端延迟
+        st.session_state.last_render_stats = renderer.stats()
+        metrics.record_render(renderer.started, renderer.first_frame_at, renderer.frames)
+
+        return full_response
+
+    except Exception as e:
+        error_msg = f"抱歉，分析过程中出现错误：{str(e)}\n\n请检查网络连接或稍后重试。"
+        st.error(error_msg)
+        return error_msg
 
-        # 流式获取AI回复并实时显示
-        for chunk in analyzer.chat_streaming(
-            messages=messages[-6:],  # 只保留最近6轮对话
-            age=age,
-            gender=gender
-        ):
-            full_response += chunk
-            text_placeholder.markdown(full_response + "▌")  # 添加光标效果
-            time.sleep(0.02)  # 打字效果延迟
+def get_ai_report_streaming(symptoms):
+    """首轮提问时分节生成报告：每节一个占位符，各节建议并行流式显示"""
+    try:
+        from analysis_report import SECTIONS, AnalysisReport
+        from llm_service import get_analyzer
+        analyzer = get_analyzer()
 
-        # 移除光标，显示最终结果
-        text_placeholder.markdown(full_response)
+        age = st.session_state.user_info['age'] if st.session_state.user_info['age'] is not None else "未提供"
+        gender = st.session_state.user_info['gender']
 
-        return full_response
+        # 每节一个槽位，哪一节先生成完就先显示
+        renderers = {}
+        for spec in SECTIONS:
+            st.markdown(f"**{spec.title}**")
+            renderers[spec.key] = StreamRenderer(st.empty())
+            renderers[spec.key].placeholder.caption("⏳ 等待生成…")
+
+        report = AnalysisReport()
+        try:
+            with analyzer.analyze_report_streaming(symptoms, age=age, gender=gender, duration="未说明") as deltas:
+                for delta in deltas:
+                    report.apply(delta)
+                    renderer = renderers[delta.key]
+                    renderer.write(delta.text)
+                    if delta.done:
+                        if delta.error is not None:
+                            renderer.placeholder.warning(f"本节生成失败：{delta.error}")
+                        else:
+                            renderer.finish()
+        except Exception:
+            raise
+        except BaseException:
+            # 中途停止时只保存已有内容的章节
+            save_stopped_reply("\n\n".join(f"### {section.title}\n\n{section.content.strip()}"
+                                            for section in report if section.content.strip()))
+            raise
+
+        first = renderers[SECTIONS[0].key]
+        st.session_state.last_render_stats = {"frames": sum(r.frames for r in renderers.values()),
+                                              "sections": len(renderers)}
+        metrics.record_render(first.started, first.first_frame_at, sum(r.frames for r in renderers.values()))
+
+        # 保存到对话记录的是完整的markdown，后续追问以此为上下文
+        return report.to_markdown()
 
     except Exception as e:
         error_msg = f"抱歉，分析过程中出现错误：{str(e)}\n\n请检查网络连接或稍后重试。"
@@ -303,8 +341,8 @@ def show_confirm_exit():
     with col1:
         if st.button("✅ 确认返回", type="primary", use_container_width=True):
             st.session_state.page = 'welcome'
-            st.session_state.chat_history = []
-            st.session_state.show_welcome_message = True
+            store.delete(st.session_state.session_id)
+            start_new_session()
             st.rerun()
     with col3:
         if st.button("❌ 取消", use_container_width=True):
@@ -313,12 +351,15 @@ def show_confirm_exit():
 
 # ==================== 主程序 ====================
 def main():
-    if st.session_state.page == 'welcome':
-        show_welcome_page()
-    elif st.session_state.page == 'chat':
-        show_chat_page()
-    elif st.session_state.page == 'confirm_exit':
-        show_confirm_exit()
+    page = st.session_state.page
+    # 剖析时按页面和对话消息数汇总本次运行与页面函数的耗时
+    with rerun_profile.page(page, lambda: store.turn_count(st.session_state.session_id)):
+        if page == 'welcome':
+            show_welcome_page()
+        elif page == 'chat':
+            show_chat_page()
+        elif page == 'confirm_exit':
+            show_confirm_exit()
 
 if __name__ == "__main__":
     main()
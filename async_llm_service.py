@@ -0,0 +1,507 @@
+"""
+异步中医分析器
+
+基于 AsyncOpenAI 的 asyncio 版本分析器：所有上游请求在同一个事件循环中并发执行，
+由信号量限制同时在途的请求数。Streamlit 等同步调用方通过 SyncAnalyzerAdapter
+使用，调用接口与 TCMAnalyzer 保持一致。
+
+多轮对话的提示词构建（分诊、摘要、token计数）和缓存读写是同步的CPU/IO操作，
+在线程池中执行，不阻塞同一事件循环上其他请求的流式输出。
+"""
+import asyncio
+import atexit
+import contextlib
+import functools
+import os
+import queue
+import threading
+import time
+
+import cancellation
+import client_pool
+import config
+import knowledge_base
+import metrics
+import model_router
+import prompts
+import resilience
+import response_cache
+import single_flight
+from analysis_report import ADVICE_SECTIONS, DIAGNOSIS, DIAGNOSIS_SECTION, AnalysisReport, SectionDelta
+from llm_service import _DEFAULT, BaseAnalyzer
+
+# 默认最多同时在途的上游请求数
+DEFAULT_MAX_INFLIGHT = 32
+
+
+class AsyncTCMAnalyzer(BaseAnalyzer):
+    """中医智能分析器（asyncio版本）"""
+
+    def __init__(self, client=None, cache=_DEFAULT, context_window=None, max_inflight=None,
+                 retry_policy=None, semantic_cache=_DEFAULT, summarizer=_DEFAULT, router=None):
+        """
+        参数:
+            client: 可选的AsyncOpenAI客户端，传入时只使用该客户端（不做多后端路由）
+            cache: 可选的ResponseCache，默认按环境变量创建，传入None则不缓存
+            context_window: 可选的ContextWindow，控制多轮对话的提示词token预算
+            max_inflight: 同时在途的上游请求上限，默认读取 TCM_MAX_INFLIGHT
+            retry_policy: 可选的RetryPolicy，控制超时、重试与对冲请求
+            semantic_cache: 可选的SemanticCache，首轮提问的语义近似缓存，默认按环境变量创建
+            summarizer: 可选的RollingSummarizer，长对话的滚动摘要，默认按环境变量创建
+            router: 可选的ModelRouter（后端为AsyncOpenAI客户端），默认按 TCM_BACKENDS 创建
+
+        注意: 异步客户端与信号量绑定在首次使用的事件循环上，实例不要跨事件循环共享。
+        """
+        if router is None:
+            if client is not None:
+                router = model_router.ModelRouter([model_router.Backend("default", client)])
+            else:
+                router = model_router.router_from_env(_create_async_client, config.api_key)
+        if max_inflight is None:
+            max_inflight = int(os.getenv("TCM_MAX_INFLIGHT", DEFAULT_MAX_INFLIGHT))
+
+        super().__init__(router, cache, context_window, retry_policy, semantic_cache, summarizer)
+        self.max_inflight = max_inflight
+        self._semaphore = asyncio.Semaphore(max_inflight)
+        self._inflight = 0
+        self._fold_tasks = set()
+        self.single_flight = (single_flight.AsyncSingleFlight() if single_flight.single_flight_enabled()
+                              else None)
+
+    def _start_fold(self, job):
+        """在事件循环中后台整理病例摘要，不占用当前回复的时间"""
+        task = asyncio.get_running_loop().create_task(self._run_fold(job))
+        # 保留引用，避免任务在完成前被回收
+        self._fold_tasks.add(task)
+        task.add_done_callback(self._fold_tasks.discard)
+
+    async def _run_fold(self, job):
+        kwargs = self._fold_request_kwargs(job)
+        tracker = metrics.CallTracker("summarize", self.model, self._estimate_prompt_tokens(kwargs["messages"]))
+        plan = self.router.plan("followup", tracker)
+        try:
+            async with self._upstream_slot():
+                response = await resilience.acall_with_retry(lambda: plan.acall(**kwargs), self.retry_policy)
+        except Exception:
+            tracker.finish("error")
+            self.summarizer.abort(job)
+            return
+        if response.usage is not None:
+            tracker.set_usage(response.usage)
+        tracker.finish()
+        self.summarizer.complete(job, response.choices[0].message.content)
+
+    @contextlib.asynccontextmanager
+    async def _upstream_slot(self):
+        """占用一个并发名额直到离开 async with 块"""
+        async with self._semaphore:
+            self._inflight += 1
+            try:
+                yield
+            finally:
+                self._inflight -= 1
+
+    async def _offload(self, func, *args):
+        """在线程池中执行同步函数（兼容Python 3.8，不使用 asyncio.to_thread）"""
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+    async def _offload_prepare_chat(self, messages, age, gender, session_id):
+        """
+        在线程池中构建对话请求
+
+        调用方在构建期间被取消时，线程仍会执行完毕；此时由回调释放 prepare() 占用的摘要整理，
+        否则该会话一直处于整理中，不会再整理
+        """
+        future = asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self._prepare_chat, messages, age, gender, session_id))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(self._abort_orphaned_fold)
+            raise
+
+    def _abort_orphaned_fold(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        if future.result().fold_job is not None:
+            self.summarizer.abort(future.result().fold_job)
+
+    @property
+    def inflight(self):
+        """当前在途的上游请求数"""
+        return self._inflight
+
+    async def analyze(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
+        """
+        执行中医分析
+
+        参数:
+            symptoms: 症状描述
+            age: 年龄
+            gender: 性别
+            duration: 症状持续时间
+
+        返回:
+            分析结果文本
+        """
+        try:
+            messages = self._build_analysis_messages(symptoms, age, gender, duration)
+
+            tracker = metrics.CallTracker("analyze", self.model, self._estimate_prompt_tokens(messages))
+            plan = self.router.plan("analysis", tracker)
+
+            try:
+                async with self._upstream_slot():
+                    response = await resilience.acall_with_retry(
+                        lambda: plan.acall(
+                            messages=messages,
+                            temperature=0.7,
+                            max_tokens=2000,
+                            timeout=self.retry_policy.request_timeout_config(),
+                        ),
+                        self.retry_policy,
+                    )
+            except Exception:
+                tracker.finish("error")
+                raise
+
+            if response.usage is not None:
+                tracker.set_usage(response.usage)
+            tracker.finish()
+            return response.choices[0].message.content
+
+        except resilience.LLMError:
+            raise
+        except Exception as e:
+            raise resilience.translate_error(e) from e
+
+    @cancellation.aclosing_stream
+    async def analyze_streaming(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
+        """
+        流式执行中医分析
+
+        返回:
+            cancellation.AsyncClosingStream，逐步返回分析结果；提前 aclose() 或离开 async with 块时立即关闭上游HTTP响应
+        """
+        try:
+            messages = self._build_analysis_messages(symptoms, age, gender, duration)
+            stream = self._astream_completion("analyze_streaming", messages, max_tokens=2000)
+            try:
+                async for text in stream:
+                    yield text
+            finally:
+                await stream.aclose()
+
+        except resilience.LLMError:
+            raise
+        except Exception as e:
+            raise resilience.translate_error(e) from e
+
+    async def _astream_completion(self, method, messages, max_tokens, kind="analysis"):
+        """流式调用一次模型（占用一个并发名额直到流结束）"""
+        tracker = metrics.CallTracker(method, self.model, self._estimate_prompt_tokens(messages), max_tokens)
+        plan = self.router.plan(kind, tracker)
+
+        async with self._upstream_slot():
+            stream = resilience.aresilient_stream(
+                lambda: plan.aopen_stream(
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=max_tokens,
+                    stream=True,
+                    timeout=self.retry_policy.stream_timeout(),
+                    **metrics.usage_kwargs(),
+                ),
+                self.retry_policy,
+                on_chunk=tracker.on_chunk,
+            )
+            chunks = metrics.atrack_stream(tracker, stream)
+            try:
+                async for text in chunks:
+                    yield text
+            finally:
+                await chunks.aclose()
+
+    async def analyze_report(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
+        """
+        生成分节分析报告：先辨证，再并行生成各节建议
+
+        返回:
+            analysis_report.AnalysisReport
+        """
+        report = AnalysisReport()
+        async for delta in self.analyze_report_streaming(symptoms, age, gender, duration):
+            report.apply(delta)
+        return report
+
+    @cancellation.aclosing_stream
+    async def analyze_report_streaming(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
+        """
+        流式生成分节分析报告
+
+        返回:
+            cancellation.AsyncClosingStream，逐步返回 analysis_report.SectionDelta（各节建议并行生成，文本块交错到达）
+        """
+        started = time.perf_counter()
+        try:
+            parts = []
+            messages = prompts.report_diagnosis_messages(symptoms, age, gender, duration)
+            stream = self._astream_completion("report_diagnosis", messages, DIAGNOSIS_SECTION.max_tokens)
+            try:
+                async for text in stream:
+                    parts.append(text)
+                    yield SectionDelta(DIAGNOSIS, text)
+            finally:
+                await stream.aclose()
+            yield SectionDelta(DIAGNOSIS, done=True)
+        except resilience.LLMError:
+            raise
+        except Exception as e:
+            raise resilience.translate_error(e) from e
+        diagnosis = "".join(parts)
+
+        events = asyncio.Queue()
+        limit = asyncio.Semaphore(self.report_max_parallel)
+
+        async def generate(spec):
+            messages = self._report_section_messages(spec, symptoms, age, gender, duration, diagnosis)
+            async with limit:
+                try:
+                    async for text in self._astream_completion("report_section", messages, spec.max_tokens):
+                        events.put_nowait(SectionDelta(spec.key, text))
+                    events.put_nowait(SectionDelta(spec.key, done=True))
+                except Exception as e:
+                    events.put_nowait(SectionDelta(spec.key, done=True, error=resilience.translate_error(e)))
+
+        loop = asyncio.get_running_loop()
+        tasks = [loop.create_task(generate(spec)) for spec in ADVICE_SECTIONS]
+        try:
+            remaining = len(ADVICE_SECTIONS)
+            while remaining:
+                delta = await events.get()
+                remaining -= delta.done
+                yield delta
+            metrics.REPORT_DURATION.observe(time.perf_counter() - started, model=self.model)
+        finally:
+            # 调用方提前关闭时取消尚未完成的章节
+            for task in tasks:
+                task.cancel()
+
+    @cancellation.aclosing_stream
+    async def chat_streaming(self, messages, age="未提供", gender="不方便透露", session_id=None):
+        """
+        多轮对话流式输出
+
+        参数:
+            messages: 对话历史 [{"role": "user/assistant", "content": "..."}]
+            age: 年龄（可以是数字或"未提供"）
+            gender: 性别
+            session_id: 可选的会话ID，提供时较早的轮次以病例摘要代替
+
+        返回:
+            cancellation.AsyncClosingStream，逐步返回AI回复；提前 aclose() 或离开 async with 块时立即关闭上游HTTP响应
+        """
+        request = None
+        try:
+            request = await self._offload_prepare_chat(messages, age, gender, session_id)
+            api_messages = request.messages
+            # 危险信号直接以模板回复，不调用模型
+            if request.triage is not None and request.triage.urgent:
+                for chunk in response_cache.replay(request.triage.reply()):
+                    yield chunk
+                return
+
+            tracker = metrics.CallTracker("chat_streaming", self.model, request.prompt_tokens, request.max_tokens)
+
+            # 命中缓存时直接回放，不占用并发名额
+            cached = await self._offload(self._lookup_reply, request, age, gender)
+            if cached is not None:
+                tracker.cache_hit = True
+                for chunk in metrics.track_stream(tracker, response_cache.replay(cached)):
+                    yield chunk
+                return
+
+            async def upstream():
+                parts = []
+                plan = self.router.plan(request.kind, tracker)
+                async with self._upstream_slot():
+                    stream = resilience.aresilient_stream(
+                        lambda: plan.aopen_stream(
+                            messages=api_messages,
+                            temperature=0.7,
+                            max_tokens=request.max_tokens,
+                            stream=True,
+                            timeout=self.retry_policy.stream_timeout(),
+                            **metrics.usage_kwargs(),
+                        ),
+                        self.retry_policy,
+                        on_chunk=tracker.on_chunk,
+                    )
+                    chunks = metrics.atrack_stream(tracker, stream)
+                    if request.knowledge is not None:
+                        chunks = knowledge_base.aexpand_stream(request.knowledge, chunks)
+                    try:
+                        async for text in chunks:
+                            parts.append(text)
+                            yield text
+                    finally:
+                        await chunks.aclose()
+
+                await self._offload(self._store_reply, request, age, gender, "".join(parts))
+
+            # 提示词完全相同的在途请求共享同一个上游流（合并者不占用并发名额）
+            stream = upstream() if self.single_flight is None else self.single_flight.stream(
+                request.flight_key, upstream)
+            try:
+                async for text in stream:
+                    yield text
+            finally:
+                await stream.aclose()
+
+        except resilience.LLMError:
+            raise
+        except Exception as e:
+            raise resilience.translate_error(e) from e
+        finally:
+            # 本轮回复结束后再整理摘要
+            if request is not None and request.fold_job is not None:
+                self._start_fold(request.fold_job)
+
+    async def aclose(self):
+        """关闭所有后端的HTTP连接"""
+        for backend in self.router.backends:
+            await backend.client.close()
+
+
+def _create_async_client(api_key, base_url):
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=client_pool.create_async_http_client(),
+        max_retries=0,  # 重试由resilience层负责
+    )
+
+
+# ==================== 同步适配 ====================
+
+class _LoopThread:
+    """在后台线程中运行的事件循环，所有同步调用共享"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="tcm-async-engine", daemon=True)
+        self.thread.start()
+
+    def run(self, coro):
+        """在后台循环中执行协程并等待结果"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    @cancellation.closing_stream
+    def iterate(self, agen):
+        """把异步生成器转换为同步的 cancellation.ClosingStream，关闭时取消后台任务"""
+        items = queue.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put((True, item))
+                items.put((True, done))
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                items.put((False, e))
+            finally:
+                await agen.aclose()
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                ok, item = items.get()
+                if not ok:
+                    raise item
+                if item is done:
+                    return
+                yield item
+        finally:
+            future.cancel()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+
+class SyncAnalyzerAdapter:
+    """以 TCMAnalyzer 的同步接口调用 AsyncTCMAnalyzer"""
+
+    def __init__(self, analyzer=None, loop_thread=None):
+        self._loop_thread = loop_thread or _LoopThread()
+        if analyzer is None:
+            # 在后台循环中创建，使异步客户端和信号量绑定到该循环
+            analyzer = self._loop_thread.run(_create_analyzer())
+        self.analyzer = analyzer
+
+    @property
+    def model(self):
+        return self.analyzer.model
+
+    @property
+    def router(self):
+        return self.analyzer.router
+
+    def analyze(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
+        return self._loop_thread.run(self.analyzer.analyze(symptoms, age, gender, duration))
+
+    def analyze_streaming(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
+        return self._loop_thread.iterate(self.analyzer.analyze_streaming(symptoms, age, gender, duration))
+
+    def analyze_report(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
+        return self._loop_thread.run(self.analyzer.analyze_report(symptoms, age, gender, duration))
+
+    def analyze_report_streaming(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
+        return self._loop_thread.iterate(self.analyzer.analyze_report_streaming(symptoms, age, gender, duration))
+
+    def precomputed_reply(self, messages, age="未提供", gender="不方便透露"):
+        return self.analyzer.precomputed_reply(messages, age, gender)
+
+    def chat_streaming(self, messages, age="未提供", gender="不方便透露", session_id=None):
+        return self._loop_thread.iterate(self.analyzer.chat_streaming(messages, age, gender, session_id))
+
+    def close(self):
+        """关闭异步客户端并停止后台事件循环"""
+        try:
+            self._loop_thread.run(self.analyzer.aclose())
+        finally:
+            self._loop_thread.stop()
+
+
+async def _create_analyzer():
+    return AsyncTCMAnalyzer()
+
+
+# 进程级共享的同步适配器
+_adapter = None
+_adapter_lock = threading.Lock()
+
+
+def get_sync_analyzer():
+    """获取所有会话共享的异步引擎同步适配器（线程安全，首次调用时创建）"""
+    global _adapter
+    if _adapter is None:
+        with _adapter_lock:
+            if _adapter is None:
+                _adapter = SyncAnalyzerAdapter()
+    return _adapter
+
+
+def shutdown():
+    """关闭共享的异步引擎（进程退出时自动调用）"""
+    global _adapter
+    with _adapter_lock:
+        adapter, _adapter = _adapter, None
+    if adapter is not None:
+        adapter.close()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,312 @@
+"""
+批量症状分析
+
+从CSV或JSONL文件流式读取问诊记录，通过有界线程池并发调用 TCMAnalyzer.analyze()，
+结果逐条追加写入JSONL。输出文件同时作为断点：重新运行时跳过已成功的记录。
+也可以通过服务商的Batch接口提交，成本更低但需等待（通常24小时内完成）。
+
+输入字段: id（可选，默认使用行号）、symptoms（必填）、age、gender、duration
+
+用法:
+    python -m batch_analyze run intake.csv results.jsonl --workers 8 --rate 5
+    python -m batch_analyze submit intake.csv --state batch_state.json
+    python -m batch_analyze collect results.jsonl --state batch_state.json
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limit import TokenBucket
+
+DEFAULT_WORKERS = 8
+DEFAULT_RATE = 5.0
+
+
+# ==================== 输入输出 ====================
+
+def _normalize_record(raw, line_number):
+    """整理一条输入记录，缺失字段使用 analyze() 的默认值"""
+    symptoms = (raw.get("symptoms") or "").strip()
+    record = {
+        "id": str(raw.get("id") or line_number),
+        "symptoms": symptoms,
+        "gender": raw.get("gender") or "不方便透露",
+        "duration": raw.get("duration") or "1-3天",
+    }
+    age = raw.get("age")
+    record["age"] = int(age) if str(age or "").strip().isdigit() else 30
+    return record
+
+
+def read_records(path):
+    """逐条读取CSV或JSONL记录（按扩展名判断格式），不会一次性载入整个文件"""
+    if path.lower().endswith(".csv"):
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            for line_number, row in enumerate(csv.DictReader(f), start=1):
+                yield _normalize_record(row, line_number)
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if line:
+                    yield _normalize_record(json.loads(line), line_number)
+
+
+def load_completed_ids(output_path):
+    """读取输出文件中已成功的记录ID（断点续跑）"""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                # 崩溃时可能留下写了一半的最后一行
+                continue
+            if item.get("status") == "ok":
+                completed.add(item["id"])
+    return completed
+
+
+class ResultWriter:
+    """线程安全的JSONL追加写入，每条结果写完立即刷新到磁盘"""
+
+    def __init__(self, path):
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, item):
+        line = json.dumps(item, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+# ==================== 在线批量分析 ====================
+
+def run_batch(input_path, output_path, analyzer=None, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE,
+              progress=None):
+    """
+    批量分析
+
+    参数:
+        input_path: CSV/JSONL输入文件
+        output_path: JSONL输出文件（已存在时续跑）
+        analyzer: 可选的分析器，默认使用共享的 TCMAnalyzer
+        workers: 并发线程数
+        rate: 每秒最多发起的请求数
+        progress: 可选回调 progress(summary)，每完成一条调用一次
+
+    返回:
+        {"ok": 成功数, "error": 失败数, "skipped": 跳过数}
+        结果写入失败的记录计入失败数（未写入输出文件，续跑时会重新分析）
+    """
+    if analyzer is None:
+        from llm_service import get_analyzer
+        analyzer = get_analyzer()
+
+    completed = load_completed_ids(output_path)
+    bucket = TokenBucket(rate)
+    writer = ResultWriter(output_path)
+    summary = {"ok": 0, "error": 0, "skipped": 0}
+    summary_lock = threading.Lock()
+    # 限制已提交但未完成的任务数，避免大文件一次性堆满内存
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def process(record):
+        try:
+            bucket.acquire()
+            started = time.perf_counter()
+            try:
+                result = analyzer.analyze(record["symptoms"], record["age"], record["gender"],
+                                          record["duration"])
+                item = {"id": record["id"], "status": "ok", "result": result}
+            except Exception as e:
+                item = {"id": record["id"], "status": "error", "error": str(e)}
+            item["elapsed"] = round(time.perf_counter() - started, 3)
+            status = item["status"]
+            try:
+                writer.write(item)
+            except Exception as e:
+                # 在线程池中抛出的异常没有人读取，必须在这里计入失败
+                status = "error"
+                print(f"记录 {record['id']} 的结果写入失败: {e}", file=sys.stderr)
+            # 所有计数（包括读取线程中的跳过数）都在同一把锁内更新
+            with summary_lock:
+                summary[status] += 1
+                if progress is not None:
+                    progress(dict(summary))
+        finally:
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for record in read_records(input_path):
+                if record["id"] in completed or not record["symptoms"]:
+                    with summary_lock:
+                        summary["skipped"] += 1
+                    continue
+                slots.acquire()
+                pool.submit(process, record)
+    finally:
+        writer.close()
+
+    return summary
+
+
+# ==================== 服务商Batch接口 ====================
+
+def _batch_request(analyzer, record):
+    return {
+        "custom_id": record["id"],
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": analyzer.model,
+            "messages": analyzer._build_analysis_messages(
+                record["symptoms"], record["age"], record["gender"], record["duration"]
+            ),
+            "temperature": 0.7,
+            "max_tokens": 2000,
+        },
+    }
+
+
+def submit_provider_batch(input_path, state_path, output_path=None, analyzer=None):
+    """
+    通过服务商Batch接口提交（跳过输出文件中已成功的记录）
+
+    返回:
+        batch ID，同时写入 state_path 供 collect 使用
+    """
+    if analyzer is None:
+        from llm_service import TCMAnalyzer
+        analyzer = TCMAnalyzer(cache=None)
+
+    completed = load_completed_ids(output_path) if output_path else set()
+    buffer = io.BytesIO()
+    count = 0
+    for record in read_records(input_path):
+        if record["id"] in completed or not record["symptoms"]:
+            continue
+        line = json.dumps(_batch_request(analyzer, record), ensure_ascii=False) + "\n"
+        buffer.write(line.encode("utf-8"))
+        count += 1
+
+    if count == 0:
+        raise ValueError("没有需要提交的记录")
+
+    uploaded = analyzer.client.files.create(file=("batch_input.jsonl", buffer.getvalue()), purpose="batch")
+    batch = analyzer.client.batches.create(
+        input_file_id=uploaded.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    with open(state_path, "w", encoding="utf-8") as f:
+        json.dump({"batch_id": batch.id, "input_file_id": uploaded.id, "records": count,
+                   "submitted_at": time.time()}, f, ensure_ascii=False, indent=2)
+    return batch.id
+
+
+def collect_provider_batch(state_path, output_path, analyzer=None):
+    """
+    下载已完成的Batch结果并追加写入输出文件
+
+    返回:
+        未完成时返回当前状态字符串；完成时返回 {"ok": .., "error": ..}
+    """
+    if analyzer is None:
+        from llm_service import TCMAnalyzer
+        analyzer = TCMAnalyzer(cache=None)
+
+    with open(state_path, encoding="utf-8") as f:
+        state = json.load(f)
+    batch = analyzer.client.batches.retrieve(state["batch_id"])
+    if batch.status != "completed":
+        return batch.status
+
+    summary = {"ok": 0, "error": 0}
+    writer = ResultWriter(output_path)
+    try:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = analyzer.client.files.content(file_id).text
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                if response.get("status_code") == 200:
+                    body = response["body"]
+                    item = {"id": entry["custom_id"], "status": "ok",
+                            "result": body["choices"][0]["message"]["content"]}
+                else:
+                    error = entry.get("error") or response.get("body")
+                    item = {"id": entry["custom_id"], "status": "error", "error": json.dumps(error, ensure_ascii=False)}
+                writer.write(item)
+                summary[item["status"]] += 1
+    finally:
+        writer.close()
+    return summary
+
+
+# ==================== 命令行 ====================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m batch_analyze", description="批量中医症状分析")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="在线并发分析")
+    run.add_argument("input", help="CSV或JSONL输入文件")
+    run.add_argument("output", help="JSONL输出文件（已存在时断点续跑）")
+    run.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="并发线程数")
+    run.add_argument("--rate", type=float, default=DEFAULT_RATE, help="每秒最多请求数")
+
+    submit = sub.add_parser("submit", help="通过服务商Batch接口提交")
+    submit.add_argument("input", help="CSV或JSONL输入文件")
+    submit.add_argument("--state", default="batch_state.json", help="保存batch ID的状态文件")
+    submit.add_argument("--output", help="已有的输出文件，其中成功的记录不再提交")
+
+    collect = sub.add_parser("collect", help="下载Batch结果")
+    collect.add_argument("output", help="JSONL输出文件")
+    collect.add_argument("--state", default="batch_state.json", help="submit生成的状态文件")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        def progress(summary):
+            done = summary["ok"] + summary["error"]
+            if done % 10 == 0:
+                print(f"已完成 {done}（成功 {summary['ok']}，失败 {summary['error']}）", file=sys.stderr)
+
+        summary = run_batch(args.input, args.output, workers=args.workers, rate=args.rate, progress=progress)
+        print(f"完成：成功 {summary['ok']}，失败 {summary['error']}，跳过 {summary['skipped']}")
+        return 1 if summary["error"] else 0
+
+    if args.command == "submit":
+        batch_id = submit_provider_batch(args.input, args.state, args.output)
+        print(f"已提交 batch {batch_id}，状态保存在 {args.state}")
+        return 0
+
+    result = collect_provider_batch(args.state, args.output)
+    if isinstance(result, str):
+        print(f"batch 尚未完成，当前状态：{result}")
+        return 2
+    print(f"已写入：成功 {result['ok']}，失败 {result['error']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""
+准入控制压测
+
+启动有容量上限的模拟服务（同时在途超过 --capacity 时返回429），让一批用户在短时间内同时提问，
+其中一个会话连续发送多条消息，比较两种方式：
+    direct     - 直接调用 chat_streaming()，超出上游容量的请求靠重试退避
+    admission  - 先经过 AdmissionController 排队，再调用 chat_streaming()
+
+报告成功/失败/削峰数量和成功请求的 p50/p95/p99 延迟（从提问到回复结束，含排队时间）。
+
+用法:
+    python -m benchmarks.admission_load
+    python -m benchmarks.admission_load --users 64 --capacity 8 --json
+"""
+import argparse
+import json
+import random
+import threading
+import time
+
+import client_pool
+import resilience
+from admission import AdmissionController, AdmissionRejected
+from benchmarks.run_benchmark import _percentile, start_mock_server
+from llm_service import TCMAnalyzer
+
+MODES = ("direct", "admission")
+
+
+def _arrivals(users, spread, spammer_messages, rng):
+    """返回 [(到达时间, 会话ID)]：每个用户一条消息，另有一个会话同时连发多条"""
+    arrivals = [(rng.uniform(0, spread), f"user-{i}") for i in range(users)]
+    arrivals += [(0.0, "spammer")] * spammer_messages
+    return sorted(arrivals)
+
+
+def run_mode(mode, analyzer, arrivals, controller=None):
+    results = []
+    lock = threading.Lock()
+    started = time.perf_counter()
+
+    def user(index, at, session_id):
+        delay = at - (time.perf_counter() - started)
+        if delay > 0:
+            time.sleep(delay)
+        begin = time.perf_counter()
+        messages = [{"role": "user", "content": f"第{index}位用户：最近总是失眠多梦，白天精神不振"}]
+        outcome = "ok"
+        ticket = None
+        try:
+            if controller is not None:
+                ticket = controller.acquire(session_id)
+            for _ in analyzer.chat_streaming(messages, age=35, gender="女"):
+                pass
+        except AdmissionRejected:
+            outcome = "shed"
+        except resilience.LLMError:
+            outcome = "failed"
+        finally:
+            if ticket is not None:
+                ticket.release()
+        with lock:
+            results.append({"session": session_id, "outcome": outcome, "latency": time.perf_counter() - begin})
+
+    threads = [threading.Thread(target=user, args=(i, at, sid)) for i, (at, sid) in enumerate(arrivals)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ok = [r["latency"] for r in results if r["outcome"] == "ok"]
+    spammer = [r for r in results if r["session"] == "spammer"]
+    return {
+        "mode": mode,
+        "requests": len(results),
+        "ok": len(ok),
+        "failed": sum(1 for r in results if r["outcome"] == "failed"),
+        "shed": sum(1 for r in results if r["outcome"] == "shed"),
+        "spammer_ok": sum(1 for r in spammer if r["outcome"] == "ok"),
+        "p50": _percentile(ok, 0.50) if ok else None,
+        "p95": _percentile(ok, 0.95) if ok else None,
+        "p99": _percentile(ok, 0.99) if ok else None,
+        "wall": time.perf_counter() - started,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="准入控制压测")
+    parser.add_argument("--users", type=int, default=48, help="同时提问的用户数（每人一条）")
+    parser.add_argument("--spread", type=float, default=1.0, help="用户到达的时间范围（秒）")
+    parser.add_argument("--spammer-messages", type=int, default=10, help="连发会话的消息数")
+    parser.add_argument("--capacity", type=int, default=8, help="模拟上游的并发容量")
+    parser.add_argument("--ttft", type=float, default=0.2, help="模拟首token延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="模拟生成速度")
+    parser.add_argument("--tokens", type=int, default=200, help="每次回复的token数")
+    parser.add_argument("--max-queue", type=int, default=40, help="准入控制的队列上限")
+    parser.add_argument("--max-wait", type=float, default=15.0, help="准入控制的最长排队时间（秒）")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args(argv)
+
+    arrivals = _arrivals(args.users, args.spread, args.spammer_messages, random.Random(0))
+    process, base_url = start_mock_server(args.ttft, args.tokens_per_second, args.tokens, args.capacity)
+    try:
+        client = client_pool.get_client("benchmark-key", base_url)
+        results = []
+        for mode in MODES:
+            # 每种方式使用新的分析器，避免路由健康状态互相影响；关闭缓存和请求合并
+            analyzer = TCMAnalyzer(client=client, cache=None, semantic_cache=None, summarizer=None)
+            analyzer.single_flight = None
+            controller = None
+            if mode == "admission":
+                controller = AdmissionController(max_concurrent=args.capacity, max_queue=args.max_queue,
+                                                 max_wait=args.max_wait, global_rate=0,
+                                                 session_rate=0.2, session_burst=3)
+            results.append(run_mode(mode, analyzer, arrivals, controller))
+    finally:
+        process.terminate()
+        process.wait(timeout=5)
+        client_pool.shutdown()
+
+    if args.json:
+        print(json.dumps({"config": vars(args), "results": results}, ensure_ascii=False, indent=2))
+        return
+
+    def fmt(value):
+        return f"{value:>8.2f}" if value is not None else f"{'-':>8}"
+
+    print(f"{'方式':<10}{'请求':>6}{'成功':>6}{'失败':>6}{'削峰':>6}{'连发成功':>8}"
+          f"{'p50(s)':>8}{'p95(s)':>8}{'p99(s)':>8}{'总耗时(s)':>10}")
+    for r in results:
+        print(f"{r['mode']:<10}{r['requests']:>8}{r['ok']:>8}{r['failed']:>8}{r['shed']:>8}{r['spammer_ok']:>10}"
+              f"{fmt(r['p50'])}{fmt(r['p95'])}{fmt(r['p99'])}{r['wall']:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
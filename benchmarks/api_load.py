@@ -0,0 +1,178 @@
+"""
+HTTP服务压测
+
+启动模拟服务和 api_server（多个工作进程），用一批并发客户端持续发送 /v1/chat 请求并读完SSE流，
+报告吞吐量（请求/秒）、延迟分位数以及服务端每个CPU核每秒处理的请求数。
+服务端CPU时间从 /proc 读取（uvicorn主进程及其所有工作进程），因此只支持Linux。
+
+每个请求的消息各不相同，并关闭回复缓存、请求合并、语义缓存、病例摘要、本地分诊和准入控制，
+测到的是每次都经过完整请求路径的开销。
+
+用法:
+    python -m benchmarks.api_load
+    python -m benchmarks.api_load --workers 4 --concurrency 64 --duration 10 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.run_benchmark import _free_port, _percentile, start_mock_server
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _process_tree_cpu(root_pid):
+    """root_pid 及其所有子孙进程累计的CPU时间（秒）"""
+    parents = {}
+    times = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # 进程名可能含空格，从最后一个右括号之后开始解析
+        fields = stat[stat.rindex(")") + 2:].split()
+        pid = int(entry)
+        parents[pid] = int(fields[1])
+        times[pid] = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    def in_tree(pid):
+        while pid > 1:
+            if pid == root_pid:
+                return True
+            pid = parents.get(pid, 0)
+        return False
+
+    return sum(cpu for pid, cpu in times.items() if in_tree(pid))
+
+
+def start_api_server(base_url, workers):
+    """以子进程方式启动 api_server，返回 (process, url)"""
+    port = _free_port()
+    env = dict(os.environ, OPENAI_API_KEY="benchmark-key", OPENAI_API_BASE=base_url,
+               TCM_CACHE_BACKEND="off", TCM_SINGLE_FLIGHT="off", TCM_SEMANTIC_CACHE="off",
+               TCM_SUMMARY="off", TCM_TRIAGE="off", TCM_ADMISSION="off")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "api_server", "--port", str(port), "--workers", str(workers)],
+        env=env, stdout=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            if httpx.get(f"{url}/healthz", timeout=2).status_code == 200:
+                return process, url
+        except (OSError, httpx.HTTPError):
+            pass
+        time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("HTTP服务启动失败")
+
+
+async def _drive(url, concurrency, duration):
+    latencies = []
+    errors = 0
+    counter = 0
+    stop_at = time.perf_counter() + duration
+
+    async def client_loop(client):
+        nonlocal errors, counter
+        while time.perf_counter() < stop_at:
+            counter += 1
+            body = {"messages": [{"role": "user", "content": f"第{counter}次提问：最近总是失眠多梦，白天精神不振"}],
+                    "profile": {"age": 35, "gender": "女"}}
+            begin = time.perf_counter()
+            try:
+                async with client.stream("POST", f"{url}/v1/chat", json=body) as response:
+                    ok = response.status_code == 200
+                    async for line in response.aiter_lines():
+                        if line.startswith("event: error"):
+                            ok = False
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - begin)
+            else:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+    return latencies, errors
+
+
+def run(url, server_pid, workers, concurrency, duration):
+    cpu_before = _process_tree_cpu(server_pid)
+    started = time.perf_counter()
+    latencies, errors = asyncio.run(_drive(url, concurrency, duration))
+    wall = time.perf_counter() - started
+    cpu = _process_tree_cpu(server_pid) - cpu_before
+
+    rps = len(latencies) / wall
+    return {
+        "workers": workers,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": rps,
+        "server_cpu_seconds": cpu,
+        "cores_used": cpu / wall,
+        "rps_per_core": len(latencies) / cpu if cpu > 0 else None,
+        "p50": _percentile(latencies, 0.50) if latencies else None,
+        "p99": _percentile(latencies, 0.99) if latencies else None,
+        "wall": wall,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP服务压测")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="api_server 工作进程数")
+    parser.add_argument("--concurrency", type=int, default=32, help="并发客户端数")
+    parser.add_argument("--duration", type=float, default=10.0, help="压测时长（秒）")
+    parser.add_argument("--ttft", type=float, default=0.05, help="模拟首token延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=2000.0, help="模拟生成速度")
+    parser.add_argument("--tokens", type=int, default=100, help="每次回复的token数")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args(argv)
+
+    mock, base_url = start_mock_server(args.ttft, args.tokens_per_second, args.tokens)
+    try:
+        server, url = start_api_server(base_url, args.workers)
+        try:
+            # 预热：每个工作进程建立上游连接
+            asyncio.run(_drive(url, args.workers * 2, 1.0))
+            result = run(url, server.pid, args.workers, args.concurrency, args.duration)
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+    finally:
+        mock.terminate()
+        mock.wait(timeout=5)
+
+    if args.json:
+        print(json.dumps({"config": vars(args), "result": result}, ensure_ascii=False, indent=2))
+        return
+
+    def fmt(value):
+        return f"{value:.3f}" if value is not None else "-"
+
+    print(f"工作进程: {result['workers']}  并发客户端: {result['concurrency']}  时长: {result['wall']:.1f}s")
+    print(f"成功请求: {result['requests']}  失败: {result['errors']}  吞吐量: {result['rps']:.1f} 请求/秒")
+    print(f"延迟 p50: {fmt(result['p50'])}s  p99: {fmt(result['p99'])}s")
+    print(f"服务端CPU: {result['server_cpu_seconds']:.2f}s（平均 {result['cores_used']:.2f} 核）  "
+          f"每核每秒: {fmt(result['rps_per_core'])} 请求")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+取消流式回复：关闭后多久断开上游连接
+
+在进程内启动模拟服务，每条路径读取若干文本块后停止，测量：
+    close_ms     调用 close() 本身的耗时
+    release_ms   从 close() 到模拟服务的处理线程结束（发现连接已断开）的时间
+    saved        metrics.CANCELLED_TOKENS 估算的少生成token数
+另有一行 abandoned：读取同样多的文本块后既不关闭也不释放引用（例如被异常回溯引用的生成器），
+上游会一直生成到结束，作为对照。
+
+用法:
+    python -m benchmarks.cancellation
+    python -m benchmarks.cancellation --tokens-per-second 50 --json
+"""
+import argparse
+import json
+import os
+import time
+
+import metrics
+from benchmarks import mock_server
+
+PATHS = ("chat", "chat_single_flight", "analyze", "report", "async_chat", "abandoned")
+
+MESSAGES = [{"role": "user", "content": "最近总是失眠多梦，白天精神不振"}]
+
+
+def _wait_released(config, timeout):
+    started = time.perf_counter()
+    while config.inflight and time.perf_counter() - started < timeout:
+        time.sleep(0.0005)
+    return (time.perf_counter() - started) * 1000
+
+
+def _saved_total():
+    return sum(value for _, value in metrics.CANCELLED_TOKENS.samples().items())
+
+
+def run_path(name, analyzers, config, read_chunks, timeout):
+    analyzer = analyzers["sync"]
+    if name == "chat":
+        stream = analyzers["direct"].chat_streaming(MESSAGES, age=35, gender="女")
+    elif name == "chat_single_flight":
+        stream = analyzer.chat_streaming(MESSAGES, age=35, gender="女")
+    elif name == "analyze":
+        stream = analyzer.analyze_streaming("最近总是失眠多梦，白天精神不振", age=35, gender="女")
+    elif name == "report":
+        stream = analyzer.analyze_report_streaming("最近总是失眠多梦，白天精神不振", age=35, gender="女")
+    elif name == "async_chat":
+        stream = analyzers["async"].chat_streaming(MESSAGES, age=35, gender="女")
+    else:
+        stream = analyzers["direct"].chat_streaming(MESSAGES, age=35, gender="女")
+
+    saved_before = _saved_total()
+    count = 0
+    for item in stream:
+        # 分节报告读到各节建议开始生成为止，此时多个上游请求同时在途
+        if name == "report" and item.key == "diagnosis":
+            continue
+        count += 1
+        if count >= read_chunks:
+            break
+    inflight = config.inflight
+
+    started = time.perf_counter()
+    if name != "abandoned":
+        stream.close()
+    close_ms = (time.perf_counter() - started) * 1000
+    release_ms = _wait_released(config, timeout)
+    result = {
+        "path": name,
+        "inflight": inflight,
+        "close_ms": close_ms,
+        "release_ms": release_ms,
+        "saved": _saved_total() - saved_before,
+    }
+    if name == "abandoned":
+        stream.close()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="取消流式回复的延迟")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="模拟生成速度")
+    parser.add_argument("--tokens", type=int, default=300, help="每次回复的token数")
+    parser.add_argument("--read", type=int, default=10, help="停止前读取的文本块数")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args(argv)
+
+    config = mock_server.MockConfig(ttft=0.05, tokens_per_second=args.tokens_per_second, tokens=args.tokens)
+    server, base_url = mock_server.start(config=config)
+    os.environ.update(OPENAI_API_KEY="benchmark-key", OPENAI_API_BASE=base_url, TCM_CACHE_BACKEND="off",
+                      TCM_SEMANTIC_CACHE="off", TCM_SUMMARY="off", TCM_CORPUS="off", TCM_SINGLE_FLIGHT="on")
+
+    from async_llm_service import SyncAnalyzerAdapter
+    from llm_service import TCMAnalyzer
+
+    direct = TCMAnalyzer()
+    direct.single_flight = None
+    analyzers = {"sync": TCMAnalyzer(), "direct": direct, "async": SyncAnalyzerAdapter()}
+    # 先完整生成一次，取消时按完整回复的平均长度估算少生成的token数
+    "".join(analyzers["direct"].chat_streaming(MESSAGES, age=35, gender="女"))
+
+    timeout = args.tokens / args.tokens_per_second + 5
+    try:
+        rows = [run_path(name, analyzers, config, args.read, timeout) for name in PATHS]
+    finally:
+        analyzers["async"].close()
+        server.shutdown()
+
+    if args.json:
+        print(json.dumps({"config": vars(args), "results": rows}, ensure_ascii=False, indent=2))
+        return
+
+    print(f"生成速度 {args.tokens_per_second:g} token/s，每次回复 {args.tokens} token，读取 {args.read} 块后停止")
+    print(f"{'路径':<20}{'在途请求':>8}{'close(ms)':>11}{'断开(ms)':>11}{'少生成token':>12}")
+    for row in rows:
+        print(f"{row['path']:<22}{row['inflight']:>8}{row['close_ms']:>11.2f}{row['release_ms']:>11.1f}"
+              f"{row['saved']:>12}")
+    print("断开 = 从 close() 到模拟服务发现连接已关闭；服务端要在之后的写入失败时才能发现，滞后一到两个token的间隔")
+
+
+if __name__ == "__main__":
+    main()
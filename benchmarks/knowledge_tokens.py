@@ -0,0 +1,119 @@
+"""
+本地知识库：加载与检索耗时、可节省的生成token数
+
+    - 加载：重新编译并写入索引文件（源数据变化后的首次加载），以及直接内存映射已有索引文件
+    - 检索：一次 candidates()（倒排查找 + 打分）的耗时
+    - token：对每条样例提问，按提示词要求的数量从候选条目中选择（食物4个、食疗方2个、穴位3个、功法1个），
+      比较模型只写条目编号与模型自己写出同样内容所需的生成token数
+
+用法:
+    python -m benchmarks.knowledge_tokens
+    python -m benchmarks.knowledge_tokens --json
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import knowledge_base
+import triage
+import ui_assets
+from context_window import count_tokens
+
+SAMPLES = tuple(text for _, text in ui_assets.COMMON_ISSUES) + (
+    "最近总是乏力气短，容易感冒，吃完饭胃胀，大便溏",
+    "晚上睡不着，多梦，口干，手脚心热，夜间出汗",
+    "怕冷，手脚冰凉，腰膝酸软，夜尿多",
+    "身体沉重，困倦，舌苔厚，大便黏",
+    "口苦口臭，脸上长痘，小便黄",
+    "痛经，经血有血块，面色晦暗",
+)
+
+# 每类选用的条目数（与 CHAT_KNOWLEDGE 的要求一致）
+SELECTION = {"food": 4, "recipe": 2, "acupoint": 3, "exercise": 1, "external": 1}
+
+
+def _timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - started) / repeat, result
+
+
+def measure_load(repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "kb.idx")
+
+        def cold():
+            if os.path.exists(path):
+                os.remove(path)
+            knowledge_base.load(path).close()
+
+        cold_seconds, _ = _timed(cold, repeat)
+        knowledge_base.load(path).close()
+        warm_seconds, _ = _timed(lambda: knowledge_base.load(path).close(), repeat)
+    return {"compile_ms": cold_seconds * 1000, "mmap_ms": warm_seconds * 1000}
+
+
+def measure_samples(kb, repeat):
+    rows = []
+    for text in SAMPLES:
+        result = triage.triage(text)
+        patterns = [name for name, _ in result.patterns]
+        symptoms = [term for _, terms in result.patterns for term in terms]
+        seconds, items = _timed(lambda: kb.candidates(patterns, symptoms), repeat)
+
+        chosen, counts = [], {}
+        for item in items:
+            if counts.get(item.kind, 0) < SELECTION.get(item.kind, 0):
+                counts[item.kind] = counts.get(item.kind, 0) + 1
+                chosen.append(item)
+        markers = "\n".join(f"- [[{item.id}]]" for item in chosen)
+        expanded = knowledge_base.expand(kb, markers)
+        rows.append({
+            "text": text,
+            "hint": result.pattern_hint(),
+            "items": len(chosen),
+            "lookup_us": seconds * 1e6,
+            "marker_tokens": count_tokens(markers) if chosen else 0,
+            "expanded_tokens": count_tokens(expanded) if chosen else 0,
+        })
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地知识库基准")
+    parser.add_argument("--repeat", type=int, default=200, help="每项测量的重复次数")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args(argv)
+
+    load = measure_load(max(args.repeat // 10, 1))
+    kb = knowledge_base.load()
+    rows = measure_samples(kb, args.repeat)
+    matched = [row for row in rows if row["items"]]
+    saved = sum(row["expanded_tokens"] - row["marker_tokens"] for row in matched)
+    summary = {
+        "items": len(kb),
+        "index_bytes": os.path.getsize(knowledge_base.DEFAULT_INDEX_PATH)
+        if os.path.exists(knowledge_base.DEFAULT_INDEX_PATH) else None,
+        **load,
+        "matched_samples": len(matched),
+        "avg_tokens_saved": saved / len(matched) if matched else 0,
+    }
+
+    if args.json:
+        print(json.dumps({"summary": summary, "samples": rows}, ensure_ascii=False, indent=2))
+        return
+
+    print(f"条目数: {summary['items']}  索引文件: {summary['index_bytes']} 字节")
+    print(f"加载: 重新编译 {load['compile_ms']:.2f} ms，内存映射已有索引 {load['mmap_ms']:.3f} ms")
+    print(f"{'提问':<24}{'条目':>4}{'检索(µs)':>10}{'编号token':>10}{'展开token':>10}  证型线索")
+    for row in rows:
+        print(f"{row['text'][:22]:<24}{row['items']:>4}{row['lookup_us']:>10.1f}"
+              f"{row['marker_tokens']:>10}{row['expanded_tokens']:>10}  {row['hint'] or '-'}")
+    print(f"有证型线索的 {len(matched)} 条提问平均每次少生成 {summary['avg_tokens_saved']:.0f} 个token")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+本地模拟的OpenAI兼容服务
+
+实现 /v1/chat/completions 的流式（SSE）与非流式响应，首token延迟和生成速度可配置，
+用于在无网络环境下测量应用自身的开销。
+
+设置 --capacity 后，同时在途的请求超过该数量时返回429，模拟上游限流。
+
+用法:
+    python -m benchmarks.mock_server --port 8765 --ttft 0.3 --tokens-per-second 50 --tokens 400
+    python -m benchmarks.mock_server --capacity 8
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 模拟回复使用的文本片段（约1个token一段）
+TOKENS = ["根据", "您的", "描述", "，", "属于", "脾", "气", "虚", "证", "。", "建议", "多吃",
+          "山药", "、", "小米", "，", "早睡", "早起", "，", "适当", "练习", "八段锦", "。\n"]
+
+
+class MockConfig:
+    """模拟服务配置"""
+
+    def __init__(self, ttft=0.3, tokens_per_second=50.0, tokens=400, capacity=0):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+        self.capacity = capacity  # 同时在途请求上限，0为不限
+        self.inflight = 0
+        self.lock = threading.Lock()
+
+    def try_enter(self):
+        with self.lock:
+            if self.capacity and self.inflight >= self.capacity:
+                return False
+            self.inflight += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.inflight -= 1
+
+
+def _chunk(index, content=None, usage=None, finish_reason=None):
+    choices = []
+    if usage is None:
+        delta = {} if content is None else {"content": content}
+        if index == 0:
+            delta["role"] = "assistant"
+        choices = [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    payload = {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "mock",
+        "choices": choices,
+    }
+    if usage is not None:
+        payload["usage"] = usage
+    return "data: " + json.dumps(payload, ensure_ascii=False) + "\n\n"
+
+
+def make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not config.try_enter():
+                data = json.dumps({"error": {"message": "Rate limit reached", "type": "rate_limit_error",
+                                             "code": "rate_limit_exceeded"}}).encode("utf-8")
+                self.send_response(429)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Retry-After", "1")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            try:
+                self._respond(body)
+            finally:
+                config.leave()
+
+        def _respond(self, body):
+            tokens = min(config.tokens, body.get("max_tokens") or config.tokens)
+            usage = {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens}
+
+            if not body.get("stream"):
+                time.sleep(config.ttft + tokens / config.tokens_per_second)
+                text = "".join(TOKENS[i % len(TOKENS)] for i in range(tokens))
+                data = json.dumps({
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": "mock",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                 "finish_reason": "stop"}],
+                    "usage": usage,
+                }, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def send(event):
+                data = event.encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+            try:
+                time.sleep(config.ttft)
+                interval = 1.0 / config.tokens_per_second
+                next_at = time.monotonic()
+                for i in range(tokens):
+                    send(_chunk(i, TOKENS[i % len(TOKENS)]))
+                    next_at += interval
+                    delay = next_at - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                send(_chunk(tokens, finish_reason="stop"))
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    send(_chunk(tokens, usage=usage))
+                send("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端提前关闭连接（取消请求）
+                pass
+
+    return Handler
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 512
+
+
+def start(host="127.0.0.1", port=0, config=None):
+    """
+    在后台线程启动模拟服务
+
+    返回:
+        (server, base_url)，调用 server.shutdown() 停止
+    """
+    server = _Server((host, port), make_handler(config or MockConfig()))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的OpenAI兼容流式服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft", type=float, default=0.3, help="首token延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="生成速度")
+    parser.add_argument("--tokens", type=int, default=400, help="每次回复的token数")
+    parser.add_argument("--capacity", type=int, default=0, help="同时在途请求上限，超出时返回429（0为不限）")
+    args = parser.parse_args()
+
+    config = MockConfig(args.ttft, args.tokens_per_second, args.tokens, args.capacity)
+    server = _Server((args.host, args.port), make_handler(config))
+    print(f"mock server listening on http://{args.host}:{server.server_address[1]}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+本地的Redis协议（RESP2）替代服务
+
+只实现 shared_state.RedisState 用到的命令，用于在没有Redis的环境中测试和压测共享状态：
+    PING / AUTH / SELECT / GET / SET（支持 EX / PX）/ DEL / INCRBYFLOAT / HINCRBYFLOAT / HGETALL / DBSIZE / FLUSHDB
+每批命令（一次读到的所有完整命令，即客户端的一次流水线）处理前可以加一段固定延迟，模拟跨机房的网络往返。
+
+用法:
+    python -m benchmarks.resp_server --port 6399
+    TCM_STATE_BACKEND=redis TCM_STATE_URL=redis://127.0.0.1:6399/0 streamlit run app.py
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class RespError(Exception):
+    pass
+
+
+class Store:
+    """所有连接共享的数据（不区分库编号）"""
+
+    def __init__(self, latency=0.0, password=None):
+        self.latency = latency
+        self.password = password
+        self.lock = threading.Lock()
+        self.values = {}    # 键 -> (值, 过期时间或None)
+        self.hashes = {}
+        self.commands = 0
+        self.batches = 0
+
+    def _get(self, key):
+        item = self.values.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.time():
+            del self.values[key]
+            return None
+        return value
+
+    def execute(self, args, session):
+        name = args[0].upper()
+        if self.password and not session.get("authed") and name not in (b"AUTH", b"PING"):
+            raise RespError("NOAUTH Authentication required.")
+        if name == b"PING":
+            return "PONG"
+        if name == b"AUTH":
+            if args[-1].decode() != self.password:
+                raise RespError("WRONGPASS invalid password")
+            session["authed"] = True
+            return "OK"
+        if name == b"SELECT":
+            return "OK"
+        with self.lock:
+            self.commands += 1
+            if name == b"GET":
+                return self._get(args[1])
+            if name == b"SET":
+                expires_at = None
+                if len(args) >= 5:
+                    unit = args[3].upper()
+                    amount = float(args[4])
+                    expires_at = time.time() + (amount / 1000 if unit == b"PX" else amount)
+                self.values[args[1]] = (args[2], expires_at)
+                return "OK"
+            if name == b"DEL":
+                removed = 0
+                for key in args[1:]:
+                    removed += (self.values.pop(key, None) is not None) + (self.hashes.pop(key, None) is not None)
+                return removed
+            if name == b"INCRBYFLOAT":
+                total = float(self._get(args[1]) or 0) + float(args[2])
+                self.values[args[1]] = (repr(total).encode(), None)
+                return repr(total).encode()
+            if name == b"HINCRBYFLOAT":
+                fields = self.hashes.setdefault(args[1], {})
+                total = float(fields.get(args[2], 0)) + float(args[3])
+                fields[args[2]] = repr(total).encode()
+                return fields[args[2]]
+            if name == b"HGETALL":
+                return [part for item in self.hashes.get(args[1], {}).items() for part in item]
+            if name == b"DBSIZE":
+                return len(self.values) + len(self.hashes)
+            if name == b"FLUSHDB":
+                self.values.clear()
+                self.hashes.clear()
+                return "OK"
+        raise RespError(f"ERR unknown command '{name.decode()}'")
+
+
+def _encode(value):
+    if isinstance(value, RespError):
+        return b"-%s\r\n" % str(value).encode()
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode()
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(_encode(item) for item in value)
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def _parse(buffer):
+    """从缓冲中解析出完整的命令，返回 (命令列表, 剩余的缓冲)"""
+    commands = []
+    while buffer:
+        if buffer[:1] != b"*":
+            raise RespError("ERR only RESP arrays are supported")
+        end = buffer.find(b"\r\n")
+        if end < 0:
+            break
+        count = int(buffer[1:end])
+        pos = end + 2
+        args = []
+        for _ in range(count):
+            end = buffer.find(b"\r\n", pos)
+            if end < 0:
+                return commands, buffer
+            length = int(buffer[pos + 1:end])
+            start = end + 2
+            if len(buffer) < start + length + 2:
+                return commands, buffer
+            args.append(buffer[start:start + length])
+            pos = start + length + 2
+        commands.append(args)
+        buffer = buffer[pos:]
+    return commands, buffer
+
+
+def make_handler(store):
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            session = {}
+            buffer = b""
+            while True:
+                data = self.request.recv(65536)
+                if not data:
+                    return
+                buffer += data
+                commands, buffer = _parse(buffer)
+                if not commands:
+                    continue
+                if store.latency:
+                    time.sleep(store.latency)
+                with store.lock:
+                    store.batches += 1
+                replies = []
+                for args in commands:
+                    try:
+                        replies.append(_encode(store.execute(args, session)))
+                    except (RespError, ValueError, IndexError) as e:
+                        replies.append(_encode(e if isinstance(e, RespError) else RespError(f"ERR {e}")))
+                self.request.sendall(b"".join(replies))
+    return Handler
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start(host="127.0.0.1", port=0, latency=0.0, password=None):
+    """
+    在后台线程启动替代服务
+
+    返回:
+        (server, url)，server.store 为共享的数据，调用 server.shutdown() 停止
+    """
+    store = Store(latency, password)
+    server = _Server((host, port), make_handler(store))
+    server.store = store
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    auth = f":{password}@" if password else ""
+    return server, f"redis://{auth}{host}:{server.server_address[1]}/0"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地的Redis协议替代服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--latency", type=float, default=0.0, help="每次网络往返增加的延迟（秒）")
+    parser.add_argument("--password", default=None)
+    args = parser.parse_args()
+
+    store = Store(args.latency, args.password)
+    server = _Server((args.host, args.port), make_handler(store))
+    print(f"resp server listening on redis://{args.host}:{server.server_address[1]}/0", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
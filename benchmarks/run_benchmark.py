@@ -0,0 +1,254 @@
+"""
+离线基准测试
+
+启动本地模拟服务（独立子进程，不计入本进程CPU），在递增的并发数下驱动：
+    chat     - TCMAnalyzer.chat_streaming()
+    analyze  - TCMAnalyzer.analyze_streaming()
+    render   - get_ai_response_streaming() 的渲染环节（chat_streaming + StreamRenderer）
+报告 p50/p95/p99 延迟、首token延迟、吞吐量，以及每次回复的CPU时间和内存分配峰值。
+
+用法:
+    python -m benchmarks.run_benchmark                   # 运行并与基线比较，退化时返回非零
+    python -m benchmarks.run_benchmark --save-baseline   # 运行并保存为新基线
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import client_pool
+from llm_service import TCMAnalyzer
+from stream_renderer import StreamRenderer
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+SCENARIOS = ("chat", "analyze", "render")
+
+SAMPLE_HISTORY = [{"role": "user", "content": "最近总是失眠多梦，白天精神不振，胃口也不太好"}]
+
+
+class _NullPlaceholder:
+    """代替 st.empty() 的占位符，只计数不渲染"""
+
+    def markdown(self, content):
+        pass
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock_server(ttft, tokens_per_second, tokens, capacity=0):
+    """以子进程方式启动模拟服务，返回 (process, base_url)"""
+    port = _free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.mock_server", "--port", str(port),
+         "--ttft", str(ttft), "--tokens-per-second", str(tokens_per_second), "--tokens", str(tokens),
+         "--capacity", str(capacity)],
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process, f"http://127.0.0.1:{port}/v1"
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("模拟服务启动失败")
+
+
+def _run_once(analyzer, scenario):
+    """执行一次回复，返回 (总耗时, 首token耗时)"""
+    started = time.perf_counter()
+    first = None
+
+    if scenario == "analyze":
+        chunks = analyzer.analyze_streaming("最近总是失眠多梦，白天精神不振", age=35, gender="女")
+    else:
+        chunks = analyzer.chat_streaming(SAMPLE_HISTORY, age=35, gender="女")
+
+    if scenario == "render":
+        renderer = StreamRenderer(_NullPlaceholder(), typing_delay=0)
+        for chunk in chunks:
+            if first is None:
+                first = time.perf_counter()
+            renderer.write(chunk)
+        renderer.finish()
+    else:
+        for _ in chunks:
+            if first is None:
+                first = time.perf_counter()
+
+    ended = time.perf_counter()
+    return ended - started, (first or ended) - started
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def run_level(analyzer, scenario, concurrency, requests):
+    """在指定并发下运行 requests 次回复，返回统计结果"""
+    latencies = []
+    ttfts = []
+    lock = threading.Lock()
+
+    def task(_):
+        latency, ttft = _run_once(analyzer, scenario)
+        with lock:
+            latencies.append(latency)
+            ttfts.append(ttft)
+
+    cpu_before = time.process_time()
+    wall_before = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(task, range(requests)))
+    wall = time.perf_counter() - wall_before
+    cpu = time.process_time() - cpu_before
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "p50": _percentile(latencies, 0.50),
+        "p95": _percentile(latencies, 0.95),
+        "p99": _percentile(latencies, 0.99),
+        "ttft_p50": _percentile(ttfts, 0.50),
+        "ttft_p95": _percentile(ttfts, 0.95),
+        "throughput": requests / wall,
+        "cpu_ms_per_reply": cpu * 1000 / requests,
+    }
+
+
+def measure_alloc_peak(analyzer, scenario):
+    """单次回复的Python内存分配峰值（KB）"""
+    tracemalloc.start()
+    try:
+        _run_once(analyzer, scenario)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024
+
+
+def compare(results, baseline, tolerance, cpu_floor_ms=2.0):
+    """
+    与基线比较，返回退化项列表
+
+    p95延迟或每次回复CPU时间超过基线 (1 + tolerance) 倍即视为退化；
+    CPU时间额外允许 cpu_floor_ms 的绝对误差，避免极小数值的抖动误报。
+    """
+    indexed = {(r["scenario"], r["concurrency"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        base = indexed.get((result["scenario"], result["concurrency"]))
+        if base is None:
+            continue
+        if result["p95"] > base["p95"] * (1 + tolerance):
+            regressions.append(
+                f"{result['scenario']}@{result['concurrency']}: p95 {result['p95']:.3f}s > 基线 {base['p95']:.3f}s"
+            )
+        limit = base["cpu_ms_per_reply"] * (1 + tolerance) + cpu_floor_ms
+        if result["cpu_ms_per_reply"] > limit:
+            regressions.append(
+                f"{result['scenario']}@{result['concurrency']}: CPU {result['cpu_ms_per_reply']:.2f}ms/回复 "
+                f"> 基线 {base['cpu_ms_per_reply']:.2f}ms"
+            )
+    return regressions
+
+
+def print_table(results):
+    header = (f"{'场景':<8}{'并发':>6}{'p50(s)':>9}{'p95(s)':>9}{'p99(s)':>9}"
+              f"{'TTFT p50':>10}{'吞吐(回复/s)':>14}{'CPU(ms/回复)':>14}{'内存峰值(KB)':>14}")
+    print(header)
+    for r in results:
+        print(f"{r['scenario']:<8}{r['concurrency']:>6}{r['p50']:>9.3f}{r['p95']:>9.3f}{r['p99']:>9.3f}"
+              f"{r['ttft_p50']:>10.3f}{r['throughput']:>14.2f}{r['cpu_ms_per_reply']:>14.2f}"
+              f"{r.get('alloc_peak_kb', 0):>14.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="中医智能小助手离线基准测试")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="逗号分隔: chat,analyze,render")
+    parser.add_argument("--concurrency", default="1,4,16", help="逗号分隔的并发数")
+    parser.add_argument("--requests", type=int, default=0, help="每个并发级别的请求数（默认并发数×4，至少8）")
+    parser.add_argument("--ttft", type=float, default=0.2, help="模拟首token延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="模拟生成速度")
+    parser.add_argument("--tokens", type=int, default=300, help="每次回复的token数")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基线文件路径")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基线")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允许的退化比例")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args(argv)
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    process, base_url = start_mock_server(args.ttft, args.tokens_per_second, args.tokens)
+    try:
+        client = client_pool.get_client("benchmark-key", base_url)
+        analyzer = TCMAnalyzer(client=client, cache=None)
+        # 所有请求都发送同一段对话，开启请求合并时并发请求共用一次上游调用，测不到每次回复的开销
+        analyzer.single_flight = None
+
+        # 预热：建立连接、加载分词器
+        _run_once(analyzer, "chat")
+
+        results = []
+        for scenario in scenarios:
+            alloc_peak = measure_alloc_peak(analyzer, scenario)
+            for concurrency in levels:
+                requests = args.requests or max(8, concurrency * 4)
+                result = run_level(analyzer, scenario, concurrency, requests)
+                result["alloc_peak_kb"] = alloc_peak
+                results.append(result)
+    finally:
+        process.terminate()
+        process.wait(timeout=5)
+        client_pool.shutdown()
+
+    config = {"ttft": args.ttft, "tokens_per_second": args.tokens_per_second, "tokens": args.tokens}
+    if args.json:
+        print(json.dumps({"config": config, "results": results}, ensure_ascii=False, indent=2))
+    else:
+        print_table(results)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "results": results}, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"基线已保存到 {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("未找到基线文件，跳过比较（使用 --save-baseline 生成）")
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("config") != config:
+        print("模拟服务参数与基线不同，跳过比较")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("性能退化：")
+        for item in regressions:
+            print("  - " + item)
+        return 1
+    print("与基线相比没有退化")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
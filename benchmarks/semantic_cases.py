@@ -0,0 +1,90 @@
+"""
+语义缓存的命中校准用例
+
+语义缓存复用的是另一个人的提问生成的回复：该命中的同义说法未命中只是多一次模型调用，
+不该命中的提问（不同症状、孕期/儿童等限定词不同）命中则会给出不适用的建议。
+这里收录同义和不同义的提问对，逐对核对是否命中，并给出同义对的最低相似度与不同义对的最高相似度，
+用于校准 TCM_SEMANTIC_THRESHOLD；有判错时返回非零。
+
+用法:
+    python -m benchmarks.semantic_cases
+    python -m benchmarks.semantic_cases --threshold 0.6
+"""
+import argparse
+import sys
+
+import semantic_cache
+
+PROFILE = ("bench-model", "chat", "30-44岁", "女")
+
+# (已缓存的提问, 新的提问, 是否应当命中)
+CASES = (
+    # 同一症状的不同说法
+    ("最近总是失眠", "晚上睡不着觉，多梦", True),
+    ("睡不着怎么办", "失眠怎么办", True),
+    ("最近老是没精神", "总觉得很累，提不起劲", True),
+    ("肚子胀怎么办", "胃胀气怎么调理", True),
+    ("头疼怎么办", "经常头痛怎么调理", True),
+    ("失眠多梦怎么调理", "晚上睡不好，老做梦", True),
+    ("没胃口", "最近吃不下饭", True),
+    ("最近总是头晕", "经常头昏", True),
+    # 不同的症状
+    ("失眠怎么办", "头痛怎么办", False),
+    ("失眠怎么办", "腰酸怎么办", False),
+    ("手脚冰凉怎么办", "手脚心发热怎么办", False),
+    ("怕冷怎么办", "怕热怎么办", False),
+    ("头晕乏力", "头痛乏力", False),
+    ("咳嗽有痰", "咳嗽无痰", False),
+    ("失眠怎么办", "失眠吃什么药", False),
+    # 在缓存提问的基础上新增症状（相似度可能超过阈值，由分句比对拒绝）
+    ("头痛头晕", "头痛头晕、视物模糊", False),
+    ("腰酸背痛", "腰酸背痛、尿频", False),
+    ("疲劳乏力、精神不振", "疲劳乏力、精神不振、体重下降", False),
+    ("最近总是头晕", "经常头昏眼花", False),
+    ("失眠怎么办", "失眠，还有心慌", False),
+    # 限定词不同
+    ("失眠怎么办", "孕妇失眠怎么办", False),
+    ("孕期失眠怎么办", "失眠怎么办", False),
+    ("头痛怎么办", "头痛发热怎么办", False),
+    ("咳嗽怎么办", "孩子咳嗽怎么办", False),
+    ("腹胀怎么办", "老人腹胀怎么办", False),
+    ("头痛怎么办", "头痛伴呕吐怎么办", False),
+    # 限定词相同
+    ("孕妇失眠怎么办", "怀孕后睡不着怎么办", True),
+)
+
+
+def run(threshold=semantic_cache.DEFAULT_THRESHOLD):
+    """返回 (判错的用例 [(已缓存, 新提问, 期望, 相似度)], 同义对最低相似度, 不同义对最高相似度)"""
+    failures = []
+    lowest_hit = 1.0
+    highest_miss = 0.0
+    for cached, query, expected in CASES:
+        cache = semantic_cache.SemanticCache(threshold=threshold, max_entries=4)
+        cache.add(cached, PROFILE, "回复")
+        value, score = cache.lookup(query, PROFILE)
+        if expected:
+            lowest_hit = min(lowest_hit, score)
+        else:
+            highest_miss = max(highest_miss, score)
+        if (value is not None) != expected:
+            failures.append((cached, query, expected, score))
+    return failures, lowest_hit, highest_miss
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="语义缓存命中校准")
+    parser.add_argument("--threshold", type=float, default=semantic_cache.DEFAULT_THRESHOLD, help="相似度阈值")
+    args = parser.parse_args(argv)
+
+    failures, lowest_hit, highest_miss = run(args.threshold)
+    for cached, query, expected, score in failures:
+        print(f"✗ {cached!r} → {query!r}: 期望{'命中' if expected else '未命中'}，相似度 {score:.3f}")
+    print(f"阈值 {args.threshold:g}：同义对最低相似度 {lowest_hit:.3f}，不同义对最高相似度 {highest_miss:.3f}"
+          f"（限定词不同的提问对不参与比较，相似度记为0；新增症状的提问对由分句比对拒绝，不受阈值约束）")
+    print(f"{len(CASES) - len(failures)}/{len(CASES)} 条用例通过")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+跨副本共享状态：请求路径上的开销与多副本限流的收敛
+
+    - 请求路径：每种后端上，回复缓存命中（本地一级缓存 / 共享后端）、写入缓存、令牌桶放行和用量累计的单次耗时，
+      与每次更新都直接写后端（不批量）的耗时对比
+    - 多副本：启动若干个副本进程共用一个全局令牌桶，各自尽快申请令牌，
+      比较所有副本合计放行的请求数与限流目标（rate × 时长 + 容量），以及各副本独立限流时的放行数；
+      同时核对共享用量累计是否等于各副本放行数之和
+
+Redis后端使用 benchmarks/resp_server.py 替代，可以用 --latency 模拟网络往返。
+
+用法:
+    python -m benchmarks.shared_state_replicas
+    python -m benchmarks.shared_state_replicas --replicas 4 --rate 20 --seconds 3 --latency 0.002 --json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+import shared_state
+from benchmarks import resp_server
+from rate_limit import TokenBucket
+from response_cache import ResponseCache, SharedBackend
+
+REPLY = "失眠多梦多与心脾两虚、阴虚火旺有关，" * 40
+
+
+def make_backend(kind, location):
+    if kind == "memory":
+        return shared_state.MemoryState()
+    if kind == "sqlite":
+        return shared_state.SQLiteState(location)
+    return shared_state.RedisState(location)
+
+
+def _per_op_us(fn, repeat):
+    started = time.perf_counter()
+    for i in range(repeat):
+        fn(i)
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def measure_request_path(kind, location, repeat, flush_ms):
+    state = shared_state.SharedState(make_backend(kind, location), prefix=f"bench{os.getpid()}:",
+                                     flush_interval=flush_ms / 1000)
+    cache = ResponseCache(SharedBackend(state, max_entries=repeat), ttl=600)
+    bucket = shared_state.SharedTokenBucket(state, "bench:path", rate=1e9, capacity=1e9)
+    record = {"model": "bench-model", "outcome": "ok", "cache_hit": False, "prompt_tokens": 800,
+              "completion_tokens": 400}
+
+    row = {"backend": kind}
+    row["cache_set_us"] = _per_op_us(lambda i: cache.set(f"k{i}", REPLY), repeat)
+    state.flush()
+    row["hit_local_us"] = _per_op_us(lambda i: cache.get(f"k{i}"), repeat)
+    cache.backend.local.clear()
+    row["hit_shared_us"] = _per_op_us(lambda i: cache.get(f"k{i}"), repeat)
+    row["bucket_us"] = _per_op_us(lambda i: bucket.try_acquire(), repeat)
+    row["usage_us"] = _per_op_us(lambda i: state.record_usage(record), repeat)
+    # 对照：每次更新都直接写后端
+    row["unbatched_set_us"] = _per_op_us(
+        lambda i: state.backend.apply({f"direct{i}": (REPLY, 600)}, {}, {}), repeat)
+    row["unbatched_incr_us"] = _per_op_us(
+        lambda i: state.backend.apply({}, {"direct:bucket": 1}, {}), repeat)
+    started = time.perf_counter()
+    state.flush()
+    row["flush_ms"] = (time.perf_counter() - started) * 1000
+    state.close()
+    return row
+
+
+def _replica(kind, location, shared, rate, burst, start_at, seconds, flush_ms, results):
+    state = shared_state.SharedState(make_backend(kind, location), prefix="replicas:",
+                                     flush_interval=flush_ms / 1000)
+    if shared:
+        bucket = shared_state.SharedTokenBucket(state, "admission:global", rate, burst)
+    else:
+        bucket = TokenBucket(rate, burst)
+    time.sleep(max(start_at - time.time(), 0))
+    admitted = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        if bucket.try_acquire():
+            admitted += 1
+            state.record_usage({"model": "bench-model", "outcome": "ok", "cache_hit": False,
+                                "prompt_tokens": 100, "completion_tokens": 50})
+        else:
+            time.sleep(0.002)
+    state.close()
+    results.put(admitted)
+
+
+def measure_replicas(kind, location, shared, args):
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    start_at = time.time() + 1.5
+    procs = [ctx.Process(target=_replica, args=(kind, location, shared, args.rate, args.burst, start_at,
+                                                args.seconds, args.flush_ms, results))
+             for _ in range(args.replicas)]
+    for proc in procs:
+        proc.start()
+    admitted = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    return admitted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="跨副本共享状态基准")
+    parser.add_argument("--repeat", type=int, default=2000, help="请求路径每项测量的次数")
+    parser.add_argument("--replicas", type=int, default=4, help="副本进程数")
+    parser.add_argument("--rate", type=float, default=20.0, help="全局令牌桶速率（所有副本合计）")
+    parser.add_argument("--burst", type=float, default=10.0, help="全局令牌桶容量")
+    parser.add_argument("--seconds", type=float, default=3.0, help="多副本测量时长")
+    parser.add_argument("--flush-ms", type=float, default=shared_state.DEFAULT_FLUSH_MS, help="批量写入间隔")
+    parser.add_argument("--latency", type=float, default=0.001, help="Redis替代服务每次往返的延迟（秒）")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args(argv)
+
+    server, url = resp_server.start(latency=args.latency)
+    with tempfile.TemporaryDirectory() as tmp:
+        locations = {"memory": None, "sqlite": os.path.join(tmp, "state.sqlite3"), "redis": url}
+        path_rows = [measure_request_path(kind, location, args.repeat, args.flush_ms)
+                     for kind, location in locations.items()]
+
+        target = args.rate * args.seconds + args.burst
+        replica_rows = []
+        for kind in ("sqlite", "redis"):
+            for shared in (False, True):
+                location = os.path.join(tmp, f"replicas-{shared:d}.sqlite3") if kind == "sqlite" else url
+                admitted = measure_replicas(kind, location, shared, args)
+                state = shared_state.SharedState(make_backend(kind, location), prefix="replicas:")
+                usage = state.usage_totals().get("bench-model", {}).get("requests", 0)
+                state.close()
+                replica_rows.append({"backend": kind, "shared_bucket": shared, "admitted": admitted,
+                                     "total": sum(admitted), "target": target, "usage_requests": usage})
+                server.store.values.clear()
+                server.store.hashes.clear()
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps({"config": vars(args), "request_path": path_rows, "replicas": replica_rows},
+                         ensure_ascii=False, indent=2))
+        return
+
+    print(f"请求路径（µs/次，批量写入间隔 {args.flush_ms:g} ms，Redis往返延迟 {args.latency * 1000:g} ms）")
+    print(f"{'后端':<8}{'写缓存':>8}{'本地命中':>10}{'共享命中':>10}{'令牌桶':>8}{'用量':>8}"
+          f"{'直写缓存':>10}{'直写计数':>10}{'批量写入(ms)':>14}")
+    for row in path_rows:
+        print(f"{row['backend']:<8}{row['cache_set_us']:>9.1f}{row['hit_local_us']:>12.1f}{row['hit_shared_us']:>12.1f}"
+              f"{row['bucket_us']:>10.1f}{row['usage_us']:>10.1f}{row['unbatched_set_us']:>12.1f}"
+              f"{row['unbatched_incr_us']:>12.1f}{row['flush_ms']:>16.2f}")
+    print(f"\n{args.replicas} 个副本，全局速率 {args.rate:g}/s，容量 {args.burst:g}，{args.seconds:g} 秒，"
+          f"目标放行 {target:.0f}")
+    print(f"{'后端':<8}{'令牌桶':<8}{'合计放行':>8}{'用量累计':>10}  各副本")
+    for row in replica_rows:
+        print(f"{row['backend']:<8}{'共享' if row['shared_bucket'] else '独立':<8}{row['total']:>10}"
+              f"{row['usage_requests']:>12}  {row['admitted']}")
+
+
+if __name__ == "__main__":
+    main()
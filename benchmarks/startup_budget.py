@@ -0,0 +1,123 @@
+"""
+启动与重新执行耗时预算
+
+测量两项指标并与预算比较，超出预算时返回非零：
+    import  - 在全新的Python进程中导入 app.py 依赖的本地模块的耗时（不含Streamlit本身），
+              同时检查 openai / dotenv 等重量级依赖没有在导入阶段被加载
+    rerun   - 用 streamlit.testing 在进程内执行 app.py：首次执行（冷启动）与之后每次交互的重新执行耗时
+
+用法:
+    python -m benchmarks.startup_budget
+    python -m benchmarks.startup_budget --import-budget-ms 60 --rerun-budget-ms 40 --json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "app.py")
+
+# app.py 在模块顶层导入的本地模块
+APP_MODULES = ("metrics", "ui_assets", "admission", "answer_corpus", "conversation_store", "profiling",
+               "stream_renderer")
+# 不应在导入阶段加载的重量级依赖
+LAZY_MODULES = ("openai", "dotenv", "numpy", "tiktoken", "llm_service")
+
+DEFAULT_IMPORT_BUDGET_MS = 60.0
+DEFAULT_RERUN_BUDGET_MS = 40.0
+
+_IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+elapsed = time.perf_counter() - started
+print(json.dumps({{"ms": elapsed * 1000, "loaded": [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import(repeat=5):
+    """在全新进程中导入 APP_MODULES，返回 (中位数毫秒, 被提前加载的重量级模块)"""
+    code = _IMPORT_PROBE.format(modules=APP_MODULES, lazy=LAZY_MODULES)
+    samples = []
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        samples.append(result["ms"])
+        loaded = result["loaded"]
+    samples.sort()
+    return samples[len(samples) // 2], loaded
+
+
+def _timed_run(app_test):
+    started = time.perf_counter()
+    app_test.run()
+    if app_test.exception:
+        raise RuntimeError(f"app.py 执行出错: {app_test.exception[0].message}")
+    return (time.perf_counter() - started) * 1000
+
+
+def measure_rerun(reruns=20):
+    """返回 {"cold": 首次执行毫秒, "welcome": 欢迎页重新执行中位数, "chat": 对话页重新执行中位数}"""
+    from streamlit.testing.v1 import AppTest
+
+    # 对话记录不落盘
+    os.environ.setdefault("TCM_CONVERSATION_DB", ":memory:")
+    app_test = AppTest.from_file(APP_PATH, default_timeout=30)
+    result = {"cold": _timed_run(app_test)}
+
+    samples = sorted(_timed_run(app_test) for _ in range(reruns))
+    result["welcome"] = samples[len(samples) // 2]
+
+    app_test.button(key="enter_chat").click()
+    _timed_run(app_test)
+    samples = sorted(_timed_run(app_test) for _ in range(reruns))
+    result["chat"] = samples[len(samples) // 2]
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="启动与重新执行耗时预算")
+    parser.add_argument("--import-budget-ms", type=float, default=DEFAULT_IMPORT_BUDGET_MS,
+                        help="导入本地模块的耗时预算（毫秒）")
+    parser.add_argument("--rerun-budget-ms", type=float, default=DEFAULT_RERUN_BUDGET_MS,
+                        help="每次重新执行 app.py 的耗时预算（毫秒，取中位数）")
+    parser.add_argument("--reruns", type=int, default=20, help="每个页面重新执行的次数")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args(argv)
+
+    import_ms, loaded = measure_import()
+    rerun = measure_rerun(args.reruns)
+
+    failures = []
+    if import_ms > args.import_budget_ms:
+        failures.append(f"导入耗时 {import_ms:.1f}ms > 预算 {args.import_budget_ms:g}ms")
+    if loaded:
+        failures.append("导入阶段加载了重量级依赖: " + ", ".join(loaded))
+    for page in ("welcome", "chat"):
+        if rerun[page] > args.rerun_budget_ms:
+            failures.append(f"{page} 页面重新执行 {rerun[page]:.1f}ms > 预算 {args.rerun_budget_ms:g}ms")
+
+    if args.json:
+        print(json.dumps({"import_ms": import_ms, "eager_modules": loaded, "rerun_ms": rerun,
+                          "failures": failures}, ensure_ascii=False, indent=2))
+    else:
+        print(f"{'项目':<24}{'耗时(ms)':>10}{'预算(ms)':>10}")
+        print(f"{'导入本地模块':<20}{import_ms:>14.1f}{args.import_budget_ms:>10g}")
+        print(f"{'首次执行（冷启动）':<16}{rerun['cold']:>14.1f}{'-':>10}")
+        print(f"{'欢迎页重新执行':<18}{rerun['welcome']:>14.1f}{args.rerun_budget_ms:>10g}")
+        print(f"{'对话页重新执行':<18}{rerun['chat']:>14.1f}{args.rerun_budget_ms:>10g}")
+        for item in failures:
+            print("超出预算: " + item)
+        if not failures:
+            print("全部在预算内")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+本地分诊回归用例
+
+分诊默认开启且位于模型之前：漏判会让急症描述得到普通的养生建议，
+误判会让常见问题只得到急症模板。这里收录曾经判错的输入，逐条核对危险信号的判定，有误判时返回非零。
+
+用法:
+    python -m benchmarks.triage_cases
+"""
+import sys
+
+import triage
+
+# (用户消息, 期望的危险信号类别；空元组表示不应判为急症)
+CASES = (
+    # "无力"、"无缘无故"中的"无"不是对后面症状的否定
+    ("突然左边手脚无力，说话不清", ("stroke",)),
+    ("四肢无力，胸痛", ("cardiac",)),
+    ("浑身无力胸痛出汗", ("cardiac",)),
+    ("胸口无缘无故胸痛", ("cardiac",)),
+    # 真正的否定
+    ("没有胸痛，只是有点胸闷", ()),
+    ("无明显胸痛，最近乏力", ()),
+    ("否认胸痛", ()),
+    ("没有明显的胸痛，偶尔心慌", ()),
+    # 常见的非急症说法
+    ("眼皮抽搐怎么办", ()),
+    ("颈部僵硬酸痛，低头久了", ()),
+    ("怎么预防中风", ()),
+    ("最近累得想死", ()),
+    # 温度不一定是体温
+    ("泡脚用40度左右的水可以吗", ()),
+    ("泡脚水温40度合适吗", ()),
+    ("孩子发烧到40度，怎么都退不下来", ("fever",)),
+    ("体温39度以上两天了", ("fever",)),
+    # 需要上下文才算急症的说法
+    ("孩子发烧后全身抽搐", ("consciousness",)),
+    ("剧烈头痛伴颈部僵硬", ("headache",)),
+    ("我爸中风了，嘴歪", ("stroke",)),
+    ("想预防中风，但现在突然口角歪斜", ("stroke",)),
+)
+
+
+def run():
+    """返回判错的用例 [(消息, 期望, 实际)]"""
+    failures = []
+    for text, expected in CASES:
+        actual = tuple(dict.fromkeys(flag.key for flag, _ in triage.triage(text).red_flags))
+        if actual != expected:
+            failures.append((text, expected, actual))
+    return failures
+
+
+def main():
+    failures = run()
+    for text, expected, actual in failures:
+        print(f"✗ {text!r}: 期望 {expected or '非急症'}，实际 {actual or '非急症'}")
+    print(f"{len(CASES) - len(failures)}/{len(CASES)} 条用例通过")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+本地分诊匹配器吞吐量
+
+在不同长度的输入上测量 triage.triage() 与 Aho-Corasick 匹配本身的速度，
+并与逐词查找（对词典中每个词调用一次 str.find）比较：
+前者耗时只随输入长度增长，后者还随词典大小增长。
+
+用法:
+    python -m benchmarks.triage_throughput
+    python -m benchmarks.triage_throughput --lengths 20 200 2000 --json
+"""
+import argparse
+import json
+import random
+import time
+
+import triage
+
+SAMPLE_TEXT = ("最近三个月总是乏力气短，说话没力气，容易感冒，吃完饭胃胀，大便溏，晚上睡不着，多梦，"
+               "手脚冰凉，怕冷，月经量少，面色萎黄，偶尔心慌，没有胸痛，平时工作压力大，经常叹气。")
+
+
+def _all_terms():
+    terms = [term.lower() for flag in triage.RED_FLAGS for term in flag.terms]
+    terms += [term for terms in triage.PATTERN_TERMS.values() for term in terms]
+    return terms
+
+
+def _naive_scan(text, terms):
+    """逐词查找所有出现位置（对照组）"""
+    found = 0
+    for term in terms:
+        start = text.find(term)
+        while start != -1:
+            found += 1
+            start = text.find(term, start + 1)
+    return found
+
+
+def _make_input(length, rng):
+    """从样例文本中随机截取并拼接出指定长度的输入"""
+    parts = []
+    size = 0
+    while size < length:
+        start = rng.randrange(len(SAMPLE_TEXT))
+        piece = SAMPLE_TEXT[start:start + rng.randint(5, 30)]
+        parts.append(piece)
+        size += len(piece)
+    return "".join(parts)[:length]
+
+
+def _rate(func, texts, min_seconds):
+    """重复调用直到累计 min_seconds，返回 (每秒调用次数, 每秒字符数)"""
+    calls = 0
+    chars = 0
+    started = time.perf_counter()
+    while True:
+        for text in texts:
+            func(text)
+        calls += len(texts)
+        chars += sum(len(text) for text in texts)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return calls / elapsed, chars / elapsed
+
+
+def run(lengths, min_seconds=0.5, seed=0):
+    rng = random.Random(seed)
+    terms = _all_terms()
+
+    started = time.perf_counter()
+    matcher = triage._build_matcher()
+    build_ms = (time.perf_counter() - started) * 1000
+
+    rows = []
+    for length in lengths:
+        texts = [_make_input(length, rng) for _ in range(50)]
+        triage_calls, triage_chars = _rate(triage.triage, texts, min_seconds)
+        match_calls, match_chars = _rate(lambda t: sum(1 for _ in matcher.iter_matches(t)), texts, min_seconds)
+        naive_calls, naive_chars = _rate(lambda t: _naive_scan(t, terms), texts, min_seconds)
+        rows.append({
+            "length": length,
+            "triage_calls_per_sec": triage_calls,
+            "triage_us_per_call": 1e6 / triage_calls,
+            "matcher_chars_per_sec": match_chars,
+            "naive_chars_per_sec": naive_chars,
+        })
+    return {"terms": len(terms), "states": matcher.states, "build_ms": build_ms, "results": rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地分诊匹配器吞吐量")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[20, 200, 2000], help="输入长度（字符）")
+    parser.add_argument("--seconds", type=float, default=0.5, help="每项测量的最短时长（秒）")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args(argv)
+
+    report = run(args.lengths, args.seconds)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    print(f"词典: {report['terms']} 个词，自动机 {report['states']} 个状态，构建耗时 {report['build_ms']:.1f}ms")
+    print(f"{'长度':>6}{'triage 次/秒':>14}{'μs/次':>10}{'匹配 字符/秒':>14}{'逐词查找 字符/秒':>18}")
+    for row in report["results"]:
+        print(f"{row['length']:>8}{row['triage_calls_per_sec']:>16,.0f}{row['triage_us_per_call']:>12.1f}"
+              f"{row['matcher_chars_per_sec']:>16,.0f}{row['naive_chars_per_sec']:>20,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+流式回复的取消
+
+用户中途点击"停止"、"新对话"或"返回"，或HTTP客户端断开时，正在生成的回复应当立即停止：
+关闭上游HTTP响应，不再继续生成（和计费）token，也不再占用连接。
+
+    - 分析器的流式方法返回可关闭的流（ClosingStream / AsyncClosingStream），既可以调用 close() / aclose()，
+      也可以用作上下文管理器；离开 with 块（包括异常和Streamlit中止脚本运行）时关闭整条生成器链，
+      最内层的 resilience.resilient_stream 随之关闭HTTP响应
+    - Cancellation 是跨线程的取消信号：上游流在后台线程中读取时（请求合并的读取线程、分节报告的各节），
+      调用方线程无法直接关闭正在执行的生成器，改为触发取消信号，resilient_stream 在等待数据时立即醒来，
+      关闭HTTP响应并抛出 StreamCancelled
+
+被取消的调用估算少生成的token数记入 metrics.CANCELLED_TOKENS。
+"""
+import functools
+import threading
+
+
+class StreamCancelled(Exception):
+    """流式请求已被取消信号中止（与正常结束区分，不写入缓存，统计为 cancelled）"""
+
+
+class Cancellation:
+    """跨线程的取消信号，触发时依次调用已注册的回调"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._cancelled = False
+
+    def is_set(self):
+        return self._cancelled
+
+    def cancel(self):
+        """触发取消（重复调用无效果）"""
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        """注册取消时调用的回调（应当快速返回且不抛异常）；已取消时立即调用"""
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+class ClosingStream:
+    """可关闭的同步文本块流：迭代器 + 上下文管理器，离开 with 块时关闭内层生成器"""
+
+    __slots__ = ("_stream",)
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._stream)
+
+    def close(self):
+        close_stream(self._stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncClosingStream:
+    """ClosingStream 的异步版本"""
+
+    __slots__ = ("_stream",)
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._stream.__anext__()
+
+    async def aclose(self):
+        await aclose_stream(self._stream)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+def closing_stream(method):
+    """装饰流式方法，使其返回 ClosingStream"""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return ClosingStream(method(*args, **kwargs))
+    return wrapper
+
+
+def aclosing_stream(method):
+    """装饰异步流式方法，使其返回 AsyncClosingStream"""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return AsyncClosingStream(method(*args, **kwargs))
+    return wrapper
+
+
+def close_stream(stream):
+    """关闭同步迭代器（没有 close 方法的迭代器忽略）"""
+    close = getattr(stream, "close", None)
+    if close is not None:
+        close()
+
+
+async def aclose_stream(stream):
+    """关闭异步迭代器（没有 aclose 方法的迭代器忽略）"""
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        await aclose()
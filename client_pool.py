@@ -0,0 +1,183 @@
+"""
+OpenAI客户端连接池
+
+进程内所有Streamlit会话共享同一组OpenAI客户端，底层使用keep-alive的HTTP连接池，
+避免每次回复都重新建立TLS连接。
+"""
+import atexit
+import os
+import threading
+
+import httpx
+
+# 连接池默认配置（可通过环境变量覆盖）
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE = 20
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+
+
+def _env_number(name, default, cast=int):
+    """读取数值型环境变量，格式错误时回退到默认值"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        return default
+
+
+def pool_limits_from_env():
+    """根据环境变量构建连接池限制"""
+    return httpx.Limits(
+        max_connections=_env_number("TCM_HTTP_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS),
+        max_keepalive_connections=_env_number("TCM_HTTP_MAX_KEEPALIVE", DEFAULT_MAX_KEEPALIVE),
+        keepalive_expiry=_env_number("TCM_HTTP_KEEPALIVE_EXPIRY", DEFAULT_KEEPALIVE_EXPIRY, float),
+    )
+
+
+class ConnectionStats:
+    """统计新建连接与复用连接的次数（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def record(self, opened):
+        with self._lock:
+            if opened:
+                self.opened += 1
+            else:
+                self.reused += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"opened": self.opened, "reused": self.reused}
+
+
+class _CountingTransport(httpx.HTTPTransport):
+    """通过httpcore的trace扩展判断每个请求是否新建了TCP连接"""
+
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self._stats = stats
+
+    def handle_request(self, request):
+        opened = []
+        previous_trace = request.extensions.get("trace")
+
+        def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                opened.append(True)
+            if previous_trace is not None:
+                previous_trace(event_name, info)
+
+        request.extensions["trace"] = trace
+        response = super().handle_request(request)
+        self._stats.record(bool(opened))
+        return response
+
+
+class _AsyncCountingTransport(httpx.AsyncHTTPTransport):
+    """异步版本的连接统计传输层"""
+
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self._stats = stats
+
+    async def handle_async_request(self, request):
+        opened = []
+        previous_trace = request.extensions.get("trace")
+
+        async def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                opened.append(True)
+            if previous_trace is not None:
+                await previous_trace(event_name, info)
+
+        request.extensions["trace"] = trace
+        response = await super().handle_async_request(request)
+        self._stats.record(bool(opened))
+        return response
+
+
+class ClientPool:
+    """按 (api_key, base_url) 缓存OpenAI客户端的注册表"""
+
+    def __init__(self, limits=None):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._limits = limits
+        self.stats = ConnectionStats()
+
+    def get_client(self, api_key, base_url=None):
+        """获取共享客户端，不存在时创建"""
+        key = (api_key, base_url)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                # openai 导入较慢，首次创建客户端时才导入
+                from openai import OpenAI
+
+                limits = self._limits or pool_limits_from_env()
+                http_client = httpx.Client(
+                    transport=_CountingTransport(self.stats, limits=limits),
+                    limits=limits,
+                )
+                # 重试由resilience层负责，避免与SDK内置重试叠加
+                client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                                max_retries=0)
+                self._clients[key] = client
+            return client
+
+    def shutdown(self):
+        """关闭所有客户端并释放连接"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+
+# 进程级共享连接池
+_pool = ClientPool()
+
+
+def get_client(api_key, base_url=None):
+    """获取进程内共享的OpenAI客户端"""
+    return _pool.get_client(api_key, base_url)
+
+
+def connection_stats():
+    """返回连接复用统计 {"opened": 新建连接数, "reused": 复用连接数}"""
+    return _pool.stats.snapshot()
+
+
+def create_async_http_client(limits=None):
+    """
+    创建带连接统计的异步HTTP客户端（供AsyncOpenAI使用）
+
+    异步客户端的连接绑定在事件循环上，因此由调用方负责在同一个循环中创建和关闭，
+    连接统计计入进程级的 connection_stats()。
+    """
+    limits = limits or pool_limits_from_env()
+    return httpx.AsyncClient(
+        transport=_AsyncCountingTransport(_pool.stats, limits=limits),
+        limits=limits,
+    )
+
+
+def shutdown():
+    """显式关闭连接池（进程退出时自动调用）"""
+    _pool.shutdown()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,50 @@
+"""
+运行配置
+
+.env 的加载和API密钥的解析在每个进程中只执行一次，结果缓存供后续调用直接使用。
+python-dotenv 在首次需要配置时才导入，不影响Streamlit脚本的冷启动时间。
+只有已经导入了Streamlit的进程（即界面）才读取 Streamlit secrets，api_server 等无界面进程不会加载Streamlit。
+"""
+import functools
+import os
+import sys
+
+
+@functools.lru_cache(maxsize=None)
+def load_env():
+    """加载 .env 中的环境变量（每个进程只执行一次，已存在的环境变量不会被覆盖）"""
+    from dotenv import load_dotenv
+    load_dotenv()
+
+
+@functools.lru_cache(maxsize=None)
+def api_key():
+    """
+    读取API密钥：优先从Streamlit secrets读取，然后从环境变量读取
+
+    异常:
+        ValueError: 未配置密钥（失败结果不会被缓存，配置后重试即可）
+    """
+    load_env()
+    key = None
+    try:
+        st = sys.modules.get("streamlit")
+        if st is not None and hasattr(st, 'secrets') and 'OPENAI_API_KEY' in st.secrets:
+            key = st.secrets['OPENAI_API_KEY']
+    except:
+        pass
+
+    if not key:
+        key = os.getenv("OPENAI_API_KEY")
+
+    if not key:
+        raise ValueError("未找到OPENAI_API_KEY，请在.env文件或Streamlit secrets中配置")
+
+    return key
+
+
+@functools.lru_cache(maxsize=None)
+def api_base():
+    """OpenAI兼容端点地址，未配置时返回None（使用官方地址）"""
+    load_env()
+    return os.getenv("OPENAI_API_BASE") or None
@@ -0,0 +1,204 @@
+"""
+上下文窗口管理
+
+按token预算（而不是固定条数）裁剪对话历史：系统提示词占用的token先扣除，
+剩余预算从最新的消息往前填充，放不下的较早轮次被丢弃。
+
+最新一条用户消息始终保留一份最低预算（超长时截断到该预算，而不是截成空消息）；
+系统提示词挤占了这份预留时抛出 ContextOverflow，由调用方缩减提示词中可选的部分（知识库目录、病例摘要）后重试。
+"""
+import functools
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# 默认提示词预算（系统提示词 + 对话历史）
+DEFAULT_PROMPT_BUDGET = 6000
+# 最新一条消息至少保留的token数（消息本身更短时按实际长度）
+DEFAULT_MIN_LATEST_TOKENS = 256
+
+# 每条消息的格式开销（role标记、分隔符等），与OpenAI官方计算方式一致
+MESSAGE_OVERHEAD = 4
+# 回复开头的固定开销
+REPLY_OVERHEAD = 3
+
+TRUNCATION_NOTICE = "\n…（内容过长，已截断）"
+
+_encodings = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _tiktoken():
+    """首次计算token数时才导入tiktoken，未安装时返回None"""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken
+
+
+def _get_encoding(model):
+    """获取模型对应的tiktoken编码，无法获取时返回None"""
+    tiktoken = _tiktoken()
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("o200k_base")
+    return _encodings[model]
+
+
+def _is_cjk(char):
+    code = ord(char)
+    return (
+        0x4E00 <= code <= 0x9FFF      # 中日韩统一表意文字
+        or 0x3400 <= code <= 0x4DBF   # 扩展A
+        or 0x3000 <= code <= 0x303F   # 中文标点
+        or 0xFF00 <= code <= 0xFFEF   # 全角字符
+    )
+
+
+def estimate_tokens(text):
+    """
+    未安装tiktoken时的估算方法
+
+    按 o200k_base 编码在中文养生文本上的实测比例校准：
+    汉字及中文标点约 1 token/字，其余字符约 4 字符/token。
+    """
+    cjk = 0
+    other = 0
+    for char in text:
+        if _is_cjk(char):
+            cjk += 1
+        elif not char.isspace():
+            other += 1
+    return cjk + (other + 3) // 4
+
+
+def count_tokens(text, model="gpt-4o-mini"):
+    """计算一段文本的token数"""
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return estimate_tokens(text)
+
+
+@functools.lru_cache(maxsize=256)
+def _count_prompt_tokens(text, model):
+    """系统提示词取值有限，缓存其token数"""
+    return count_tokens(text, model)
+
+
+def count_message_tokens(message, model="gpt-4o-mini"):
+    """计算单条消息（含格式开销）的token数"""
+    return count_tokens(message["content"], model) + MESSAGE_OVERHEAD
+
+
+class ContextOverflow(ValueError):
+    """系统提示词过长，放入后最新一条消息的预留预算不足"""
+
+
+def _truncate(text, max_tokens, model):
+    """截断过长的文本，保留开头部分"""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    max_tokens -= count_tokens(TRUNCATION_NOTICE, model)
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid], model) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + TRUNCATION_NOTICE
+
+
+class ContextResult:
+    """裁剪结果"""
+
+    __slots__ = ("messages", "prompt_tokens", "dropped")
+
+    def __init__(self, messages, prompt_tokens, dropped):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens
+        self.dropped = dropped
+
+
+class ContextWindow:
+    """基于token预算的上下文窗口"""
+
+    def __init__(self, budget=None, model="gpt-4o-mini", min_latest=None):
+        """
+        参数:
+            budget: 提示词token预算（系统提示词 + 历史），默认读取 TCM_PROMPT_TOKEN_BUDGET
+            model: 用于选择分词器的模型名称
+            min_latest: 最新一条消息至少保留的token数，默认读取 TCM_MIN_LATEST_TOKENS
+        """
+        if budget is None:
+            budget = int(os.getenv("TCM_PROMPT_TOKEN_BUDGET", DEFAULT_PROMPT_BUDGET))
+        if min_latest is None:
+            min_latest = int(os.getenv("TCM_MIN_LATEST_TOKENS", DEFAULT_MIN_LATEST_TOKENS))
+        self.budget = budget
+        self.model = model
+        self.min_latest = min_latest
+
+    def fit(self, system_prompt, history):
+        """
+        把对话历史放入预算
+
+        参数:
+            system_prompt: 系统提示词
+            history: 对话历史 [{"role": "user/assistant", "content": "..."}]，按时间顺序
+
+        返回:
+            ContextResult，messages 为包含系统提示词的完整消息列表
+
+        异常:
+            ContextOverflow: 系统提示词占用的预算使最新一条消息放不下最低预留
+        """
+        used = _count_prompt_tokens(system_prompt, self.model) + MESSAGE_OVERHEAD + REPLY_OVERHEAD
+        remaining = self.budget - used
+        if history:
+            reserve = min(count_message_tokens(history[-1], self.model), self.min_latest + MESSAGE_OVERHEAD)
+            if remaining < reserve:
+                raise ContextOverflow(
+                    f"系统提示词占用 {used} tokens，预算 {self.budget} 中剩余 {remaining}，"
+                    f"不足以放入最新一条消息（至少需要 {reserve}）"
+                )
+
+        kept = []
+        for index in range(len(history) - 1, -1, -1):
+            message = history[index]
+            cost = count_message_tokens(message, self.model)
+            if cost <= remaining:
+                kept.append(message)
+                remaining -= cost
+                continue
+
+            # 最新一条消息无论如何都要发送，超长时截断
+            if not kept:
+                content = _truncate(
+                    message["content"], max(remaining - MESSAGE_OVERHEAD, 0), self.model
+                )
+                kept.append({"role": message["role"], "content": content})
+                remaining -= count_tokens(content, self.model) + MESSAGE_OVERHEAD
+            break
+
+        kept.reverse()
+
+        # 保证历史从用户消息开始，避免以孤立的助手回复开头
+        while len(kept) > 1 and kept[0]["role"] != "user":
+            remaining += count_message_tokens(kept.pop(0), self.model)
+
+        messages = [{"role": "system", "content": system_prompt}] + kept
+        prompt_tokens = self.budget - remaining
+        dropped = len(history) - len(kept)
+
+        logger.info(
+            "prompt tokens=%d budget=%d history kept=%d dropped=%d",
+            prompt_tokens, self.budget, len(kept), dropped,
+        )
+        return ContextResult(messages, prompt_tokens, dropped)
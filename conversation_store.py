@@ -0,0 +1,272 @@
+"""
+对话记录存储
+
+对话页面原先把完整的对话历史以字典列表放在 st.session_state 中，
+每个打开的标签页都常驻内存且没有上限，重启后全部丢失。
+本模块把对话保存为紧凑的 Turn 记录：
+    - 活跃会话保存在进程内LRU中，每个会话只保留最近若干轮
+    - 所有轮次先进入写缓冲，按批量写入本地SQLite（缓冲满时立即写入，否则由后台线程按间隔写入），
+      较早的轮次只保存在磁盘上
+    - 会话ID可用于恢复对话（页面刷新、进程重启后仍然有效）
+进程内存只与会话上限和每会话保留轮数有关，与打开的会话总数无关。
+
+环境变量:
+    TCM_CONVERSATION_DB: SQLite文件路径，默认 conversations.sqlite3
+    TCM_CONVERSATION_MAX_SESSIONS: 内存中最多保留的会话数，默认1000
+    TCM_CONVERSATION_RECENT_TURNS: 每个会话在内存中保留的最近轮数，默认20
+    TCM_CONVERSATION_FLUSH_SIZE: 写缓冲达到多少条时批量写入，默认32
+    TCM_CONVERSATION_FLUSH_INTERVAL: 写缓冲最长保留秒数，默认2
+"""
+import atexit
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import config
+
+DEFAULT_PATH = "conversations.sqlite3"
+DEFAULT_MAX_SESSIONS = 1000
+DEFAULT_RECENT_TURNS = 20
+DEFAULT_FLUSH_SIZE = 32
+DEFAULT_FLUSH_INTERVAL = 2.0
+
+
+class Turn:
+    """一轮对话消息"""
+
+    __slots__ = ("seq", "role", "content", "created_at")
+
+    def __init__(self, seq, role, content, created_at=None):
+        self.seq = seq
+        self.role = role
+        self.content = content
+        self.created_at = created_at if created_at is not None else time.time()
+
+    def to_message(self):
+        """转换为 chat_streaming() 使用的消息字典"""
+        return {"role": self.role, "content": self.content}
+
+
+class _Session:
+    """内存中的会话：最近若干轮 + 下一个序号"""
+
+    __slots__ = ("session_id", "recent", "next_seq")
+
+    def __init__(self, session_id, recent, next_seq):
+        self.session_id = session_id
+        self.recent = recent
+        self.next_seq = next_seq
+
+
+class ConversationStore:
+    """有界的对话记录存储（内存LRU + SQLite批量落盘）"""
+
+    def __init__(self, path=DEFAULT_PATH, max_sessions=DEFAULT_MAX_SESSIONS, recent_turns=DEFAULT_RECENT_TURNS,
+                 flush_size=DEFAULT_FLUSH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        """
+        参数:
+            path: SQLite文件路径（":memory:" 表示不持久化）
+            max_sessions: 内存中最多保留的会话数，超出时淘汰最久未访问的会话
+            recent_turns: 每个会话在内存中保留的最近轮数
+            flush_size: 写缓冲达到该条数时批量写入
+            flush_interval: 后台线程写入缓冲的间隔（秒），即没有新消息时缓冲的最长保留时间
+        """
+        self.path = path
+        self.max_sessions = max_sessions
+        self.recent_turns = recent_turns
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_turns ("
+            "session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, "
+            "content TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (session_id, seq))"
+        )
+        self._conn.commit()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="conversation-flush", daemon=True)
+        self._thread.start()
+
+    # ---------- 内部方法（调用方持有锁） ----------
+
+    def _flush_locked(self):
+        if not self._pending:
+            return
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO conversation_turns (session_id, seq, role, content, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(session_id, t.seq, t.role, t.content, t.created_at) for session_id, t in self._pending],
+        )
+        self._conn.commit()
+        self._pending = []
+        self._last_flush = time.monotonic()
+
+    def _load_locked(self, session_id):
+        """从SQLite加载会话的最近若干轮，不存在时返回None"""
+        self._flush_locked()
+        rows = self._conn.execute(
+            "SELECT seq, role, content, created_at FROM conversation_turns "
+            "WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+            (session_id, self.recent_turns),
+        ).fetchall()
+        if not rows:
+            return None
+        recent = [Turn(*row) for row in reversed(rows)]
+        return _Session(session_id, recent, recent[-1].seq + 1)
+
+    def _get_locked(self, session_id, create=False):
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions.move_to_end(session_id)
+            return session
+        session = self._load_locked(session_id)
+        if session is None:
+            if not create:
+                return None
+            session = _Session(session_id, [], 0)
+        return self._insert_locked(session)
+
+    def _insert_locked(self, session):
+        self._sessions[session.session_id] = session
+        # 淘汰的会话只从内存移除，未落盘的轮次仍在写缓冲中
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return session
+
+    # ---------- 公共接口 ----------
+
+    def new_session(self):
+        """创建新会话，返回会话ID"""
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            # 新生成的ID在磁盘上不可能有记录，直接放入内存，不写缓冲也不查询
+            self._insert_locked(_Session(session_id, [], 0))
+        return session_id
+
+    def append(self, session_id, role, content):
+        """追加一轮消息（会话不存在时自动创建）"""
+        with self._lock:
+            session = self._get_locked(session_id, create=True)
+            turn = Turn(session.next_seq, role, content)
+            session.next_seq += 1
+            session.recent.append(turn)
+            if len(session.recent) > self.recent_turns:
+                del session.recent[:-self.recent_turns]
+            self._pending.append((session_id, turn))
+            if len(self._pending) >= self.flush_size:
+                self._flush_locked()
+            return turn
+
+    def recent(self, session_id):
+        """
+        返回会话最近若干轮的消息字典列表（按时间顺序）
+
+        较早的轮次可通过 history() 从磁盘读取
+        """
+        with self._lock:
+            session = self._get_locked(session_id)
+            if session is None:
+                return []
+            return [turn.to_message() for turn in session.recent]
+
+    def turn_count(self, session_id):
+        """会话的总轮数"""
+        with self._lock:
+            session = self._get_locked(session_id)
+            return session.next_seq if session is not None else 0
+
+    def history(self, session_id, start=0):
+        """从磁盘读取会话的完整历史（seq >= start），用于恢复或导出"""
+        with self._lock:
+            self._flush_locked()
+            rows = self._conn.execute(
+                "SELECT role, content FROM conversation_turns WHERE session_id = ? AND seq >= ? ORDER BY seq",
+                (session_id, start),
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def delete(self, session_id):
+        """删除会话及其全部记录"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._pending = [item for item in self._pending if item[0] != session_id]
+            self._conn.execute("DELETE FROM conversation_turns WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def flush(self):
+        """把写缓冲写入磁盘"""
+        with self._lock:
+            self._flush_locked()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            with self._lock:
+                if self._pending and time.monotonic() - self._last_flush >= self.flush_interval:
+                    try:
+                        self._flush_locked()
+                    except sqlite3.Error:
+                        # 数据库暂时不可写（如被其他进程锁住）时保留缓冲，下一次再写
+                        pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions_in_memory": len(self._sessions),
+                "turns_in_memory": sum(len(s.recent) for s in self._sessions.values()),
+                "pending_writes": len(self._pending),
+            }
+
+    def close(self):
+        """停止后台线程，写入剩余的缓冲并关闭数据库"""
+        self._stopped.set()
+        self._thread.join(timeout=self.flush_interval + 1)
+        with self._lock:
+            self._flush_locked()
+            self._conn.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def store_from_env():
+    """根据环境变量创建对话存储"""
+    config.load_env()
+    return ConversationStore(
+        path=os.getenv("TCM_CONVERSATION_DB", DEFAULT_PATH),
+        max_sessions=int(os.getenv("TCM_CONVERSATION_MAX_SESSIONS", DEFAULT_MAX_SESSIONS)),
+        recent_turns=int(os.getenv("TCM_CONVERSATION_RECENT_TURNS", DEFAULT_RECENT_TURNS)),
+        flush_size=int(os.getenv("TCM_CONVERSATION_FLUSH_SIZE", DEFAULT_FLUSH_SIZE)),
+        flush_interval=float(os.getenv("TCM_CONVERSATION_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)),
+    )
+
+
+def get_store():
+    """获取进程内共享的对话存储（所有会话共用）"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = store_from_env()
+    return _store
+
+
+def shutdown():
+    """写入剩余的缓冲并关闭数据库"""
+    global _store
+    with _store_lock:
+        store, _store = _store, None
+    if store is not None:
+        store.close()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,453 @@
+"""
+本地养生知识库
+
+食物、食疗方、穴位、功法等参考资料很少变化，不必每次都让模型重新生成。知识库收录这些条目，
+按证型和症状词建立倒排索引；对话时先用本地分诊的结果检索候选条目放进提示词，
+模型只需写出辨证分析和所选条目的编号（如 [[R01]]），应用在本地把编号展开为完整的做法、位置和要点，
+大幅减少生成的token数和回复耗时。
+
+条目的源数据在 knowledge_base.json 中维护，首次加载时编译为紧凑的二进制索引文件并以内存映射方式打开
+（源数据变化后自动重新编译）。文件布局（小端）：
+    文件头      魔数、源数据摘要、条目数与条目表偏移、索引键数与键表偏移、元数据偏移与长度
+    条目表      每个条目 (编号偏移, 编号长度, 记录偏移, 记录长度)，按编号排序
+    键表        每个索引键 (键偏移, 键长度, 倒排表偏移, 条目数)，按键排序，查找时二分
+    倒排表      条目序号（uint16）
+    数据区      编号、键（UTF-8）和条目记录（JSON），只在用到时解码
+
+环境变量:
+    TCM_KB: off 关闭知识库（默认开启）
+    TCM_KB_PATH: 编译后的索引文件路径，默认与源数据放在一起
+    TCM_KB_MAX_TOKENS: 引用知识库条目的回复的最大生成token数，默认900
+"""
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+
+import cancellation
+import metrics
+
+SOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge_base.json")
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge_base.idx")
+DEFAULT_MAX_TOKENS = 900
+
+MAGIC = b"TCMKB\x00\x00\x01"
+HEADER = struct.Struct("<8s16sIIIIII")
+ITEM_ENTRY = struct.Struct("<IIII")
+KEY_ENTRY = struct.Struct("<IIII")
+POSTING = struct.Struct("<H")
+
+# 每类最多放进提示词的候选条目数
+DEFAULT_LIMITS = {"food": 6, "recipe": 3, "acupoint": 4, "exercise": 3, "external": 1}
+
+# 首要证型的权重最高，其后依次递减；每命中一个症状词加1
+PATTERN_WEIGHTS = (3, 2, 1)
+
+# 回复中的条目引用，如 [[R01]]
+MARKER = re.compile(r"\[\[([A-Z]\d{2})\]\]")
+MARKER_MAX_LEN = 7
+
+
+def pattern_key(pattern):
+    return "p:" + pattern
+
+
+def symptom_key(term):
+    return "s:" + term
+
+
+class KnowledgeItem:
+    """知识库中的一个条目"""
+
+    __slots__ = ("id", "kind", "name", "summary", "detail", "patterns", "symptoms")
+
+    def __init__(self, id, kind, name, summary, detail, patterns=(), symptoms=()):
+        self.id = id
+        self.kind = kind
+        self.name = name
+        self.summary = summary      # 一句话功效，放进提示词供模型选择
+        self.detail = detail        # 展开后的内容（每行一条）
+        self.patterns = patterns
+        self.symptoms = symptoms
+
+    def render(self):
+        """展开为markdown：只有一行时紧跟名称，多行时作为下一级列表"""
+        if len(self.detail) == 1:
+            return f"**{self.name}**：{self.detail[0]}"
+        lines = "".join(f"\n  - {line}" for line in self.detail)
+        return f"**{self.name}**（{self.summary}）{lines}"
+
+    def __repr__(self):
+        return f"KnowledgeItem({self.id!r}, {self.name!r})"
+
+
+# ==================== 编译 ====================
+
+def source_digest(raw):
+    return hashlib.sha256(raw).digest()[:16]
+
+
+def compile_index(raw):
+    """
+    把源数据编译为二进制索引
+
+    参数:
+        raw: knowledge_base.json 的原始字节
+
+    返回:
+        bytes
+    """
+    source = json.loads(raw.decode("utf-8"))
+    items = sorted(source["items"], key=lambda item: item["id"].encode("utf-8"))
+    if len(items) > 0xFFFF:
+        raise ValueError("知识库条目过多")
+    ids = [item["id"] for item in items]
+    if len(set(ids)) != len(ids):
+        raise ValueError("知识库条目编号重复")
+    for item in items:
+        if item["kind"] not in source["kinds"]:
+            raise ValueError(f"未知的条目类型: {item['kind']}（{item['id']}）")
+
+    postings = {}
+    for index, item in enumerate(items):
+        keys = [pattern_key(p) for p in item["patterns"]] + [symptom_key(s) for s in item["symptoms"]]
+        for key in dict.fromkeys(keys):
+            postings.setdefault(key.encode("utf-8"), []).append(index)
+    keys = sorted(postings)
+
+    blob = bytearray()
+
+    def put(data):
+        offset = len(blob)
+        blob.extend(data)
+        return offset
+
+    item_entries = []
+    for item in items:
+        record = {k: item[k] for k in ("kind", "name", "summary", "detail", "patterns", "symptoms")}
+        id_bytes = item["id"].encode("utf-8")
+        id_off = put(id_bytes)
+        record_bytes = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        item_entries.append((id_off, len(id_bytes), put(record_bytes), len(record_bytes)))
+    key_entries = []
+    posting_bytes = bytearray()
+    for key in keys:
+        post_off = len(posting_bytes)
+        for index in postings[key]:
+            posting_bytes.extend(POSTING.pack(index))
+        key_entries.append((put(key), len(key), post_off, len(postings[key])))
+    meta = json.dumps({"kinds": source["kinds"]}, ensure_ascii=False).encode("utf-8")
+    meta_off = put(meta)
+
+    # 依次排列：文件头、条目表、键表、倒排表、数据区（表中的偏移在此换算为文件内偏移）
+    items_off = HEADER.size
+    keys_off = items_off + ITEM_ENTRY.size * len(items)
+    postings_off = keys_off + KEY_ENTRY.size * len(keys)
+    blob_off = postings_off + len(posting_bytes)
+
+    out = bytearray(HEADER.pack(MAGIC, source_digest(raw), len(items), items_off, len(keys), keys_off,
+                                blob_off + meta_off, len(meta)))
+    for id_off, id_len, rec_off, rec_len in item_entries:
+        out += ITEM_ENTRY.pack(blob_off + id_off, id_len, blob_off + rec_off, rec_len)
+    for key_off, key_len, post_off, count in key_entries:
+        out += KEY_ENTRY.pack(blob_off + key_off, key_len, postings_off + post_off, count)
+    out += posting_bytes
+    out += blob
+    return bytes(out)
+
+
+# ==================== 读取 ====================
+
+class KnowledgeBase:
+    """内存映射的知识库索引（只读，线程安全）"""
+
+    def __init__(self, buffer, mapping=None):
+        """
+        参数:
+            buffer: 编译后的索引（bytes 或 mmap）
+            mapping: 需要在 close() 时关闭的mmap，可选
+        """
+        magic, digest, n_items, items_off, n_keys, keys_off, meta_off, meta_len = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("不是知识库索引文件")
+        self._buf = buffer
+        self._mapping = mapping
+        self.digest = digest
+        self.version = digest.hex()
+        self._n_items = n_items
+        self._items_off = items_off
+        self._n_keys = n_keys
+        self._keys_off = keys_off
+        self.kinds = json.loads(bytes(buffer[meta_off:meta_off + meta_len]).decode("utf-8"))["kinds"]
+        self._items = {}
+
+    def __len__(self):
+        return self._n_items
+
+    def _item_id(self, index):
+        id_off, id_len, _, _ = ITEM_ENTRY.unpack_from(self._buf, self._items_off + index * ITEM_ENTRY.size)
+        return bytes(self._buf[id_off:id_off + id_len])
+
+    def _key(self, index):
+        key_off, key_len, _, _ = KEY_ENTRY.unpack_from(self._buf, self._keys_off + index * KEY_ENTRY.size)
+        return bytes(self._buf[key_off:key_off + key_len])
+
+    @staticmethod
+    def _bisect(count, probe, target):
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if probe(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < count and probe(lo) == target else None
+
+    def item(self, index):
+        """按序号读取条目（解码结果缓存）"""
+        item = self._items.get(index)
+        if item is None:
+            _, _, rec_off, rec_len = ITEM_ENTRY.unpack_from(self._buf, self._items_off + index * ITEM_ENTRY.size)
+            record = json.loads(bytes(self._buf[rec_off:rec_off + rec_len]).decode("utf-8"))
+            item = KnowledgeItem(self._item_id(index).decode("utf-8"), record["kind"], record["name"],
+                                 record["summary"], tuple(record["detail"]),
+                                 tuple(record["patterns"]), tuple(record["symptoms"]))
+            self._items[index] = item
+        return item
+
+    def get(self, item_id):
+        """按编号查找条目，不存在时返回None"""
+        index = self._bisect(self._n_items, self._item_id, item_id.encode("utf-8"))
+        return None if index is None else self.item(index)
+
+    def postings(self, key):
+        """倒排查找：返回包含该键的条目序号"""
+        index = self._bisect(self._n_keys, self._key, key.encode("utf-8"))
+        if index is None:
+            return ()
+        _, _, post_off, count = KEY_ENTRY.unpack_from(self._buf, self._keys_off + index * KEY_ENTRY.size)
+        return struct.unpack_from(f"<{count}H", self._buf, post_off)
+
+    def candidates(self, patterns, symptoms=(), limits=None):
+        """
+        按证型和症状词检索候选条目
+
+        参数:
+            patterns: 证型列表，按重要性从高到低
+            symptoms: 命中的症状词
+            limits: 每类最多返回的条目数，默认 DEFAULT_LIMITS
+
+        返回:
+            [KnowledgeItem]，按类型分组，组内按相关度从高到低
+        """
+        limits = DEFAULT_LIMITS if limits is None else limits
+        scores = {}
+        for rank, pattern in enumerate(patterns):
+            weight = PATTERN_WEIGHTS[min(rank, len(PATTERN_WEIGHTS) - 1)]
+            for index in self.postings(pattern_key(pattern)):
+                scores[index] = scores.get(index, 0) + weight
+        for term in dict.fromkeys(symptoms):
+            for index in self.postings(symptom_key(term)):
+                scores[index] = scores.get(index, 0) + 1
+
+        chosen = {}
+        for index in sorted(scores, key=lambda i: (-scores[i], i)):
+            item = self.item(index)
+            group = chosen.setdefault(item.kind, [])
+            if len(group) < limits.get(item.kind, 0):
+                group.append(item)
+        return [item for kind in self.kinds for item in chosen.get(kind, ())]
+
+    def catalog(self, items):
+        """候选条目在提示词中的列表：按类型分组，每行"编号 名称：功效\""""
+        groups = {}
+        for item in items:
+            groups.setdefault(item.kind, []).append(f"{item.id} {item.name}：{item.summary}")
+        return "\n".join(f"【{self.kinds[kind]}】\n" + "\n".join(lines) for kind, lines in groups.items())
+
+    def close(self):
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+
+def _read_index(path, digest):
+    """打开与源数据一致的索引文件，不存在或已过期时返回None"""
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    with f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size or header[:8] != MAGIC or header[8:24] != digest:
+            return None
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return KnowledgeBase(mapping, mapping)
+
+
+def load(path=DEFAULT_INDEX_PATH, source=SOURCE_PATH):
+    """
+    加载知识库：索引文件与源数据一致时直接映射，否则重新编译并写入索引文件
+
+    参数:
+        path: 索引文件路径
+        source: 源数据路径
+
+    返回:
+        KnowledgeBase（索引文件无法写入时在内存中使用编译结果）
+    """
+    with open(source, "rb") as f:
+        raw = f.read()
+    digest = source_digest(raw)
+    kb = _read_index(path, digest)
+    if kb is not None:
+        return kb
+
+    data = compile_index(raw)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        # 部署目录只读时直接使用内存中的编译结果
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return KnowledgeBase(data)
+    return _read_index(path, digest) or KnowledgeBase(data)
+
+
+# ==================== 展开回复中的条目引用 ====================
+
+class Expander:
+    """把流式回复中的 [[编号]] 展开为条目内容；跨文本块被截断的引用会先缓存，凑齐后再展开"""
+
+    def __init__(self, kb):
+        self.kb = kb
+        self._pending = ""
+
+    def _replace(self, match):
+        item = self.kb.get(match.group(1))
+        if item is None:
+            # 模型编造或引用了不存在的编号，直接去掉
+            metrics.KNOWLEDGE.inc(outcome="unknown", kind="unknown")
+            return ""
+        metrics.KNOWLEDGE.inc(outcome="expanded", kind=item.kind)
+        return item.render()
+
+    def feed(self, text):
+        """输入一个文本块，返回可以输出的文本（可能为空）"""
+        text = self._pending + text
+        cut = len(text)
+        start = text.rfind("[[")
+        if start != -1 and "]]" not in text[start:] and len(text) - start < MARKER_MAX_LEN:
+            cut = start
+        elif text.endswith("["):
+            cut -= 1
+        self._pending = text[cut:]
+        return MARKER.sub(self._replace, text[:cut])
+
+    def flush(self):
+        """回复结束时输出剩余文本"""
+        text, self._pending = self._pending, ""
+        return MARKER.sub(self._replace, text)
+
+
+def expand_stream(kb, chunks):
+    """展开同步文本块流中的条目引用（被提前关闭时随之关闭 chunks）"""
+    expander = Expander(kb)
+    try:
+        for text in chunks:
+            text = expander.feed(text)
+            if text:
+                yield text
+    finally:
+        cancellation.close_stream(chunks)
+    tail = expander.flush()
+    if tail:
+        yield tail
+
+
+async def aexpand_stream(kb, chunks):
+    """展开异步文本块流中的条目引用"""
+    expander = Expander(kb)
+    try:
+        async for text in chunks:
+            text = expander.feed(text)
+            if text:
+                yield text
+    finally:
+        await cancellation.aclose_stream(chunks)
+    tail = expander.flush()
+    if tail:
+        yield tail
+
+
+def expand(kb, text):
+    """展开完整文本中的条目引用"""
+    expander = Expander(kb)
+    return expander.feed(text) + expander.flush()
+
+
+# ==================== 配置 ====================
+
+def knowledge_enabled():
+    return os.getenv("TCM_KB", "on").strip().lower() not in ("0", "off", "false")
+
+
+def max_tokens_from_env():
+    return int(os.getenv("TCM_KB_MAX_TOKENS", DEFAULT_MAX_TOKENS))
+
+
+# 进程级共享的知识库
+_kb = None
+_kb_loaded = False
+_kb_lock = threading.Lock()
+
+
+def get_knowledge_base():
+    """获取进程内共享的知识库（线程安全，首次调用时加载；关闭时返回None）"""
+    global _kb, _kb_loaded
+    if not _kb_loaded:
+        with _kb_lock:
+            if not _kb_loaded:
+                if knowledge_enabled():
+                    _kb = load(os.getenv("TCM_KB_PATH") or DEFAULT_INDEX_PATH)
+                _kb_loaded = True
+    return _kb
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="本地养生知识库")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="编译索引文件")
+    build.add_argument("--output", default=os.getenv("TCM_KB_PATH") or DEFAULT_INDEX_PATH)
+    search = sub.add_parser("search", help="按证型/症状词检索候选条目")
+    search.add_argument("text", help="症状描述，先经过本地分诊提取证型和症状词")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        with open(SOURCE_PATH, "rb") as f:
+            data = compile_index(f.read())
+        with open(args.output, "wb") as f:
+            f.write(data)
+        print(f"已写入 {args.output}（{len(data)} 字节）")
+        return
+
+    import triage
+    result = triage.triage(args.text)
+    kb = load(os.getenv("TCM_KB_PATH") or DEFAULT_INDEX_PATH)
+    print(f"证型线索：{result.pattern_hint() or '无'}")
+    items = kb.candidates([name for name, _ in result.patterns],
+                          [term for _, terms in result.patterns for term in terms])
+    print(kb.catalog(items) or "无候选条目")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,127 +1,354 @@
+import contextlib
 import os
-from openai import OpenAI
-from dotenv import load_dotenv
-
-# 加载环境变量
-load_dotenv()
-
-
-class TCMAnalyzer:
-    """中医智能分析器"""
-
-    def __init__(self):
-        """初始化OpenAI客户端"""
-        # 优先从Streamlit secrets读取，然后从环境变量读取
-        api_key = None
-        try:
-            import streamlit as st
-            if hasattr(st, 'secrets') and 'OPENAI_API_KEY' in st.secrets:
-                api_key = st.secrets['OPENAI_API_KEY']
-        except:
-            pass
-
-        if not api_key:
-            api_key = os.getenv("OPENAI_API_KEY")
-
-        if not api_key:
-            raise ValueError("未找到OPENAI_API_KEY，请在.env文件或Streamlit secrets中配置")
-
-        self.client = OpenAI(api_key=api_key)
-        self.model = "gpt-4o-mini"  # 使用GPT-4 Turbo模型以获得更好的中医分析能力
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import analysis_report
+import answer_corpus
+import cancellation
+import client_pool
+import config
+import knowledge_base
+import metrics
+import model_router
+import prompts
+import resilience
+import response_cache
+import shared_state
+import single_flight
+import triage
+from analysis_report import ADVICE_SECTIONS, DIAGNOSIS, DIAGNOSIS_SECTION, AnalysisReport, SectionDelta
+from context_window import ContextOverflow, ContextWindow, count_message_tokens
+from summarizer import summarizer_from_env
+
+# 区分"未传参"与显式传入None
+_DEFAULT = object()
+
+
+class ChatRequest:
+    """一次多轮对话请求的准备结果"""
+
+    __slots__ = ("messages", "kind", "flight_key", "cache_key", "prompt_tokens", "first_turn", "fold_job",
+                 "triage", "fingerprint", "max_tokens", "knowledge", "models")
+
+    def __init__(self, messages, kind, cache_key, prompt_tokens, first_turn, fold_job,
+                 triage=None, fingerprint=prompts.CHAT_SYSTEM.fingerprint, max_tokens=1500, knowledge=None,
+                 models=None):
+        self.messages = messages            # 发送给API的完整消息列表
+        self.kind = kind                    # 路由使用的请求类型：analysis / followup
+        self.flight_key = single_flight.flight_key(kind, messages)  # 在途请求合并键
+        self.cache_key = cache_key          # 回复缓存键，未启用缓存时为None
+        self.prompt_tokens = prompt_tokens
+        self.first_turn = first_turn        # 首轮提问内容（仅用于语义缓存），否则为None
+        self.fold_job = fold_job            # 需要在本轮回复之外执行的摘要整理任务
+        self.triage = triage                # 最新用户消息的本地分诊结果，未启用分诊时为None
+        self.fingerprint = fingerprint      # 所用系统提示词模板的指纹
+        self.max_tokens = max_tokens
+        self.knowledge = knowledge          # 回复中的条目引用需要用该知识库展开，未引用知识库时为None
+        self.models = models                # 可能生成回复的模型（ModelRouter.model_key），缓存键和语料版本戳的一部分
+
+
+def _shrink_candidates(candidates):
+    """
+    每类候选条目减半，保留组内相关度最高的；每类至少保留一条
+    （去掉整个目录会退回到更长的完整提示词）
+    """
+    totals = Counter(item.kind for item in candidates)
+    seen = Counter()
+    kept = []
+    for item in candidates:
+        if seen[item.kind] < max(totals[item.kind] // 2, 1):
+            kept.append(item)
+        seen[item.kind] += 1
+    return kept
+
+
+class BaseAnalyzer:
+    """分析器公共逻辑：提示词构建、上下文裁剪与缓存键（同步/异步分析器共用）"""
+
+    def __init__(self, router, cache=_DEFAULT, context_window=None, retry_policy=None,
+                 semantic_cache=_DEFAULT, summarizer=_DEFAULT):
+        config.load_env()
+        if cache is _DEFAULT:
+            cache = response_cache.cache_from_env()
+        if semantic_cache is _DEFAULT:
+            # 语义缓存依赖NumPy，创建分析器时才导入
+            from semantic_cache import semantic_cache_from_env
+            semantic_cache = semantic_cache_from_env()
+
+        # 默认后端的客户端和模型用于缓存键、token计数和Batch接口；实际请求由路由器分配
+        self.router = router
+        self.client = router.default.client
+        self.cache = cache
+        self.semantic_cache = semantic_cache
+        self.retry_policy = retry_policy or resilience.RetryPolicy.from_env()
+        self.model = router.default.model
+        self.context_window = context_window or ContextWindow(model=self.model)
+        self.summarizer = summarizer_from_env(self.model) if summarizer is _DEFAULT else summarizer
+        self.report_max_parallel = analysis_report.max_parallel_from_env()
+        self.triage_policy = triage.policy_from_env()
+        self.knowledge = knowledge_base.get_knowledge_base()
+        self.knowledge_max_tokens = knowledge_base.max_tokens_from_env()
+        # 启用共享状态时，本进程各次调用的用量随批量写入累加到共享后端（所有副本合计）
+        self.shared_state = shared_state.get_state()
+        self.corpus = answer_corpus.get_corpus()
 
     def _build_system_prompt(self):
         """构建系统提示词 - 定义AI助手的角色和行为准则"""
-        return """你是一位经验丰富的中医养生专家，拥有深厚的中医理论功底和丰富的临床经验。你精通：
-- 中医基础理论：阴阳五行、藏象学说、经络学说、病因病机
-- 中医诊断：望闻问切、八纲辨证、脏腑辨证、气血津液辨证
-- 养生之道：饮食调理、情志调摄、起居有常、运动养生
-
-你的分析特点：
-1. 辨证准确：能从症状中识别证型特征，分析病机
-2. 建议实用：提供具体可操作的养生方案，避免空泛
-3. 解释清晰：用现代语言解释中医概念，深入浅出
-4. 因人制宜：考虑年龄、性别、体质等个体差异
-
-重要原则：
-✓ 本建议仅供养生保健参考，不能替代专业医疗诊断和治疗
-✓ 遇到以下情况必须明确建议就医：急性重症、持续恶化、疑似器质性病变
-✓ 不推荐具体中药方剂，重点在食疗和生活方式调整
-✓ 保持专业、客观、温和的语气，避免夸大或恐吓
-✓ 建议要科学合理，符合现代医学常识"""
+        return prompts.analysis_system_prompt()
 
     def _build_user_prompt(self, symptoms, age, gender, duration):
-        """构建用户提示词 - 整合用户输入的症状信息"""
-        prompt = f"""请为以下用户提供专业的中医养生分析和建议：
-
-【用户基本信息】
-- 年龄：{age}岁
-- 性别：{gender}
-- 症状持续时间：{duration}
-
-【症状描述】
-{symptoms}
-
-【分析要求】
-请按以下结构提供详细、专业且实用的分析和建议：
-
-## 一、中医辨证分析
-
-1. **证型判断**：基于描述的症状，分析最可能的1-2个证型
-   - 常见证型包括：气虚、血虚、阴虚、阳虚、气滞、血瘀、痰湿、湿热等
-   - 说明选择该证型的主要依据
-
-2. **病机分析**：用通俗语言解释
-   - 为什么会出现这些症状？
-   - 中医如何理解这种身体状态？
-   - 与年龄、性别的关联
-
-## 二、个性化养生建议
+        """构建用户提示词 - 静态分析要求在前，用户信息和症状在后"""
+        return prompts.analysis_user_prompt(symptoms, age, gender, duration)
+
+    def _build_analysis_messages(self, symptoms, age, gender, duration):
+        """构建结构化分析的消息列表"""
+        return [
+            {"role": "system", "content": self._build_system_prompt()},
+            {"role": "user", "content": self._build_user_prompt(symptoms, age, gender, duration)}
+        ]
+
+    def _report_section_messages(self, spec, symptoms, age, gender, duration, diagnosis):
+        """分节报告中一节建议的消息列表"""
+        return prompts.report_section_messages(spec.key, spec.title, symptoms, age, gender, duration, diagnosis)
+
+    @staticmethod
+    def _chat_history(messages):
+        """整理对话历史（跳过欢迎消息）"""
+        history = []
+        for msg in messages:
+            if msg['role'] in ['user', 'assistant']:
+                # 过滤掉欢迎消息
+                if not (msg['role'] == 'assistant' and '我是您的中医智能小助手' in msg['content']):
+                    history.append({
+                        "role": msg['role'],
+                        "content": msg['content']
+                    })
+        return history
+
+    def _prepare_chat(self, messages, age, gender, session_id=None, count_triage=True):
+        """
+        构建多轮对话的API消息列表
 
-### 1. 饮食调理（重点推荐）
-- **推荐食物**：列举3-5种具体食物，说明功效
-- **食疗方**：提供1-2个简单易做的食疗方，标注材料和做法
-- **避免食物**：明确哪些食物不宜多吃
-- **饮食习惯**：用餐时间、份量、温度等建议
+        参数:
+            session_id: 会话ID，提供时较早的轮次会被整理为病例摘要
+            count_triage: 是否计入分诊指标；只为查询预生成语料而构建时为False，
+                          未命中时随后的 chat_streaming() 会再构建一次
 
-### 2. 生活起居
-- **作息建议**：具体的睡眠时间（如"建议23:00前入睡"）
-- **睡眠改善**：提供2-3个实用方法
-- **情绪调节**：针对症状的情志调摄建议
-- **日常注意**：需要避免的生活习惯
+        返回:
+            ChatRequest
+        """
+        history = self._chat_history(messages)
 
-### 3. 运动养生
-- **推荐运动**：列举2-3种适合的运动方式
-- **运动方案**：具体的频率、时长、强度建议
-- **传统功法**：如适合，推荐八段锦、太极等，说明练习要点
-- **运动禁忌**：需要避免的运动类型或注意事项
+        # 本地分诊：危险信号直接以模板回复，证型线索用于选择提示词
+        triage_result = None
+        if self.triage_policy is not None and history and history[-1]["role"] == "user":
+            triage_result = triage.triage(history[-1]["content"])
 
-### 4. 其他调理方法
-- **穴位保健**：推荐2-3个穴位，说明位置和按摩方法
-- **外治方法**：如泡脚、艾灸等，提供具体方案
-- **季节调养**：当前季节的特别注意事项
+        # 较早的轮次用病例摘要代替，只发送摘要之后的原文
+        summary = None
+        fold_job = None
+        if self.summarizer is not None and session_id is not None:
+            summary, history, fold_job = self.summarizer.prepare(session_id, history)
 
-## 三、重要提醒
+        try:
+            # 最新消息有证型线索时从知识库检索候选条目，模型只需引用编号
+            candidates = None
+            if self.knowledge is not None and triage_result is not None and not triage_result.urgent:
+                candidates = self.knowledge.candidates(
+                    [name for name, _ in triage_result.patterns],
+                    [term for _, terms in triage_result.patterns for term in terms],
+                )
+
+            # 按token预算裁剪历史，构建完整的消息列表；系统提示词挤占了最新消息的最低预留时，
+            # 先逐步缩减知识库目录，再去掉病例摘要
+            while True:
+                template, max_tokens, fingerprint, system_prompt = self._chat_system_prompt(
+                    age, gender, triage_result, history, summary, candidates)
+                try:
+                    context = self.context_window.fit(system_prompt, history)
+                    break
+                except ContextOverflow:
+                    smaller = _shrink_candidates(candidates) if candidates else None
+                    if smaller is not None and len(smaller) < len(candidates):
+                        candidates = smaller
+                    elif summary:
+                        summary = None
+                    else:
+                        raise
+            if triage_result is not None and count_triage:
+                metrics.TRIAGE.inc(outcome="red_flag" if triage_result.urgent
+                                   else "knowledge" if template is prompts.CHAT_KNOWLEDGE
+                                   else "focused" if template is prompts.CHAT_FOCUSED else "full")
+            api_messages = context.messages
+            kind = self.router.classify_chat(api_messages[1:])
+            # 回复可能由该类型的任一后端生成，缓存与语料按这些后端的模型区分，而不是默认后端的模型
+            models = self.router.model_key(kind)
+
+            cache_key = None
+            if self.cache is not None:
+                key_messages = api_messages[1:]
+                if summary:
+                    key_messages = [{"role": "system", "content": summary}] + key_messages
+                if template is prompts.CHAT_FOCUSED:
+                    key_messages = [{"role": "system", "content": triage_result.pattern_hint()}] + key_messages
+                cache_key = response_cache.make_key(
+                    models, fingerprint or template.fingerprint, key_messages, age, gender
+                )
+
+            # 语义缓存只用于首轮提问（仅一条用户消息且没有摘要）
+            first_turn = None
+            if summary is None and len(api_messages) == 2 and api_messages[1]["role"] == "user":
+                first_turn = api_messages[1]["content"]
+
+            return ChatRequest(api_messages, kind, cache_key, context.prompt_tokens, first_turn, fold_job,
+                               triage_result, fingerprint or template.fingerprint, max_tokens,
+                               self.knowledge if candidates else None, models)
+        except BaseException:
+            # prepare() 已把会话标记为整理中，本轮无法发出请求时必须释放，否则该会话不会再整理
+            if fold_job is not None:
+                self.summarizer.abort(fold_job)
+            raise
+
+    def _chat_system_prompt(self, age, gender, triage_result, history, summary, candidates):
+        """
+        构建多轮对话的系统提示词（静态前缀 + 用户信息 + 病例摘要）
 
-### ⚠️ 需要就医的情况
-明确列出哪些症状变化需要及时就医，不要延误
+        有知识库候选条目时使用知识库提示词；未启用知识库时，首轮提问的证型线索明确则改用聚焦提示词，回复更短
 
-### 📅 调理周期
-- 预期多久能看到改善
-- 需要坚持多久
-- 定期评估的建议
+        返回:
+            (模板, 最大生成token数, 缓存指纹或None, 系统提示词)
+        """
+        if candidates:
+            template = prompts.CHAT_KNOWLEDGE
+            # 缓存的回复是展开后的文本，知识库内容变化后不再复用
+            fingerprint = f"{template.fingerprint}:{self.knowledge.version}"
+            system_prompt = prompts.chat_knowledge_prompt(
+                age, gender, triage_result.pattern_hint(), self.knowledge.catalog(candidates), summary)
+            return template, self.knowledge_max_tokens, fingerprint, system_prompt
+        if (triage_result is not None and summary is None and len(history) == 1
+                and self.triage_policy.focused(triage_result)):
+            system_prompt = prompts.chat_focused_prompt(age, gender, triage_result.pattern_hint())
+            return prompts.CHAT_FOCUSED, self.triage_policy.focused_max_tokens, None, system_prompt
+        return prompts.CHAT_SYSTEM, 1500, None, prompts.chat_system_with_summary(age, gender, summary)
+
+    def _lookup_reply(self, request, age, gender):
+        """
+        查找已有的回复：首轮提问先查预生成语料，再查回复缓存的精确匹配，
+        都未命中时对首轮提问做语义近似匹配
+        """
+        if self.corpus is not None and request.first_turn is not None:
+            reply = self.corpus.lookup(request.first_turn, age, gender,
+                                       answer_corpus.make_stamp(request.models, request.fingerprint))
+            if reply is not None:
+                return reply
+        if request.cache_key is not None:
+            cached = self.cache.get(request.cache_key)
+            if cached is not None:
+                return cached
+        if self.semantic_cache is not None and request.first_turn is not None:
+            cached, _ = self.semantic_cache.lookup(request.first_turn, self._semantic_profile(request, age, gender))
+            return cached
+        return None
+
+    def precomputed_reply(self, messages, age="未提供", gender="不方便透露"):
+        """
+        首轮提问命中预生成语料时直接返回回复，否则返回None
 
-### 💊 特别说明
-- 强调这是养生保健建议，不能替代医疗诊断
-- 如有基础疾病或在服药，需咨询医生
-- 建议要循序渐进，不可操之过急
+        调用方据此可以跳过排队和流式请求；版本戳与当前提示词、模型不一致的回复不会返回
+        """
+        if self.corpus is None:
+            return None
+        history = self._chat_history(messages)
+        if len(history) != 1 or history[0]["role"] != "user":
+            return None
+        if not self.corpus.contains(history[0]["content"], age, gender):
+            return None
+        request = self._prepare_chat(history, age, gender, count_triage=False)
+        if request.first_turn is None:
+            return None
+        return self.corpus.lookup(request.first_turn, age, gender,
+                                  answer_corpus.make_stamp(request.models, request.fingerprint))
+
+    def _store_reply(self, request, age, gender, reply):
+        """保存完整生成的回复"""
+        if request.cache_key is not None:
+            self.cache.set(request.cache_key, reply)
+        if self.semantic_cache is not None and request.first_turn is not None:
+            self.semantic_cache.add(request.first_turn, self._semantic_profile(request, age, gender), reply)
+
+    def _fold_request_kwargs(self, job):
+        """病例摘要整理请求的参数"""
+        return {
+            "messages": self.summarizer.fold_messages(job),
+            "temperature": 0.2,
+            "max_tokens": self.summarizer.max_tokens,
+            "timeout": self.retry_policy.request_timeout_config(),
+        }
+
+    def _semantic_profile(self, request, age, gender):
+        return (request.models, request.fingerprint, response_cache.age_bucket(age), gender)
+
+    def _estimate_prompt_tokens(self, messages):
+        """本地估算提示词token数（上游未返回usage时用于统计）"""
+        return sum(count_message_tokens(m, self.model) for m in messages)
+
+
+class TCMAnalyzer(BaseAnalyzer):
+    """中医智能分析器"""
 
-【输出要求】
-- 语言通俗易懂，避免过多专业术语
-- 建议具体可操作，给出明确的数量、时间等
-- 重视安全性，对可能的风险做出提醒
-- 整体积极温和，给用户信心和方向"""
+    def __init__(self, client=None, cache=_DEFAULT, context_window=None, retry_policy=None,
+                 semantic_cache=_DEFAULT, summarizer=_DEFAULT, router=None):
+        """
+        初始化OpenAI客户端
 
-        return prompt
+        参数:
+            client: 可选的OpenAI客户端，传入时只使用该客户端（不做多后端路由）
+            cache: 可选的ResponseCache，默认按环境变量创建，传入None则不缓存
+            context_window: 可选的ContextWindow，控制多轮对话的提示词token预算
+            retry_policy: 可选的RetryPolicy，控制超时、重试与对冲请求
+            semantic_cache: 可选的SemanticCache，首轮提问的语义近似缓存，默认按环境变量创建
+            summarizer: 可选的RollingSummarizer，长对话的滚动摘要，默认按环境变量创建
+            router: 可选的ModelRouter，默认按 TCM_BACKENDS 创建，后端客户端来自共享连接池
+
+        异常:
+            调用失败时抛出 resilience.LLMError 的子类
+        """
+        if router is None:
+            if client is not None:
+                router = model_router.ModelRouter([model_router.Backend("default", client)])
+            else:
+                router = model_router.router_from_env(client_pool.get_client, config.api_key)
+
+        super().__init__(router, cache, context_window, retry_policy, semantic_cache, summarizer)
+        self.single_flight = single_flight.SingleFlight() if single_flight.single_flight_enabled() else None
+        self._fold_executor = None
+        self._fold_lock = threading.Lock()
+
+    def _start_fold(self, job):
+        """在后台线程中整理病例摘要，不占用当前回复的时间"""
+        with self._fold_lock:
+            if self._fold_executor is None:
+                self._fold_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tcm-summary")
+        self._fold_executor.submit(self._run_fold, job)
+
+    def _run_fold(self, job):
+        kwargs = self._fold_request_kwargs(job)
+        tracker = metrics.CallTracker("summarize", self.model, self._estimate_prompt_tokens(kwargs["messages"]))
+        plan = self.router.plan("followup", tracker)
+        try:
+            response = resilience.call_with_retry(lambda: plan.call(**kwargs), self.retry_policy)
+        except Exception:
+            tracker.finish("error")
+            self.summarizer.abort(job)
+            return
+        if response.usage is not None:
+            tracker.set_usage(response.usage)
+        tracker.finish()
+        self.summarizer.complete(job, response.choices[0].message.content)
 
     def analyze(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
         """
@@ -138,26 +365,39 @@ class TCMAnalyzer:
         """
         try:
             # 构建消息
-            messages = [
-                {"role": "system", "content": self._build_system_prompt()},
-                {"role": "user", "content": self._build_user_prompt(symptoms, age, gender, duration)}
-            ]
-
-            # 调用OpenAI API
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=0.7,  # 适度的创造性，保持专业性
-                max_tokens=2000,  # 确保回答足够详细
-            )
+            messages = self._build_analysis_messages(symptoms, age, gender, duration)
+
+            tracker = metrics.CallTracker("analyze", self.model, self._estimate_prompt_tokens(messages))
+            plan = self.router.plan("analysis", tracker)
+
+            # 调用OpenAI API（失败时按策略退避重试，重试时切换到下一个候选后端）
+            try:
+                response = resilience.call_with_retry(
+                    lambda: plan.call(
+                        messages=messages,
+                        temperature=0.7,  # 适度的创造性，保持专业性
+                        max_tokens=2000,  # 确保回答足够详细
+                        timeout=self.retry_policy.request_timeout_config(),
+                    ),
+                    self.retry_policy,
+                )
+            except Exception:
+                tracker.finish("error")
+                raise
 
             # 提取回答
             result = response.choices[0].message.content
+            if response.usage is not None:
+                tracker.set_usage(response.usage)
+            tracker.finish()
             return result
 
+        except resilience.LLMError:
+            raise
         except Exception as e:
-            raise Exception(f"调用LLM API时出错: {str(e)}")
+            raise resilience.translate_error(e) from e
 
+    @cancellation.closing_stream
     def analyze_streaming(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
         """
         流式执行中医分析（支持实时显示结果）
@@ -169,151 +409,227 @@ class TCMAnalyzer:
             duration: 症状持续时间
 
         返回:
-            生成器，逐步返回分析结果
+            cancellation.ClosingStream，逐步返回分析结果；提前 close() 或离开 with 块时立即关闭上游HTTP响应
         """
         try:
             # 构建消息
-            messages = [
-                {"role": "system", "content": self._build_system_prompt()},
-                {"role": "user", "content": self._build_user_prompt(symptoms, age, gender, duration)}
-            ]
-
-            # 调用OpenAI API（流式）
-            stream = self.client.chat.completions.create(
-                model=self.model,
+            messages = self._build_analysis_messages(symptoms, age, gender, duration)
+            yield from self._stream_completion("analyze_streaming", messages, max_tokens=2000)
+
+        except resilience.LLMError:
+            raise
+        except Exception as e:
+            raise resilience.translate_error(e) from e
+
+    def _stream_completion(self, method, messages, max_tokens, kind="analysis", cancel=None):
+        """
+        流式调用一次模型（带首token超时、重试与对冲；重试和对冲使用下一个候选后端）
+
+        cancel 为可选的 cancellation.Cancellation，在其他线程中读取返回的流时用于中止请求
+        """
+        tracker = metrics.CallTracker(method, self.model, self._estimate_prompt_tokens(messages), max_tokens)
+        plan = self.router.plan(kind, tracker)
+        stream = resilience.resilient_stream(
+            lambda: plan.open_stream(
                 messages=messages,
                 temperature=0.7,
-                max_tokens=2000,
-                stream=True  # 启用流式输出
-            )
+                max_tokens=max_tokens,
+                stream=True,  # 启用流式输出
+                timeout=self.retry_policy.stream_timeout(),
+                **metrics.usage_kwargs(),
+            ),
+            self.retry_policy,
+            on_chunk=tracker.on_chunk,
+            cancel=cancel,
+        )
+        return metrics.track_stream(tracker, stream)
+
+    def analyze_report(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
+        """
+        生成分节分析报告：先辨证，再并行生成各节建议
 
-            # 逐步返回结果
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    yield chunk.choices[0].delta.content
+        返回:
+            analysis_report.AnalysisReport（某一节失败时该节状态为error，其余章节照常返回）
+        """
+        return AnalysisReport.collect(self.analyze_report_streaming(symptoms, age, gender, duration))
 
-        except Exception as e:
-            raise Exception(f"调用LLM API时出错: {str(e)}")
+    @cancellation.closing_stream
+    def analyze_report_streaming(self, symptoms, age=30, gender="不方便透露", duration="1-3天"):
+        """
+        流式生成分节分析报告
+
+        参数同 analyze()
+
+        返回:
+            cancellation.ClosingStream，逐步返回 analysis_report.SectionDelta：先是辨证分析的文本块，
+            之后各节建议并行生成，文本块交错到达，每节以 done=True 的事件结束；
+            提前关闭时辨证分析和尚未完成的各节都立即中止
 
-    def chat_streaming(self, messages, age="未提供", gender="不方便透露"):
+        异常:
+            辨证分析失败时抛出 resilience.LLMError 的子类（各节建议以此为依据，无法继续）
+        """
+        started = time.perf_counter()
+        try:
+            parts = []
+            messages = prompts.report_diagnosis_messages(symptoms, age, gender, duration)
+            with contextlib.closing(self._stream_completion("report_diagnosis", messages,
+                                                            DIAGNOSIS_SECTION.max_tokens)) as stream:
+                for text in stream:
+                    parts.append(text)
+                    yield SectionDelta(DIAGNOSIS, text)
+            yield SectionDelta(DIAGNOSIS, done=True)
+        except resilience.LLMError:
+            raise
+        except Exception as e:
+            raise resilience.translate_error(e) from e
+        diagnosis = "".join(parts)
+
+        events = queue.Queue()
+        stop = cancellation.Cancellation()
+
+        def generate(spec):
+            if stop.is_set():
+                return
+            messages = self._report_section_messages(spec, symptoms, age, gender, duration, diagnosis)
+            stream = self._stream_completion("report_section", messages, spec.max_tokens, cancel=stop)
+            try:
+                for text in stream:
+                    if stop.is_set():
+                        return
+                    events.put(SectionDelta(spec.key, text))
+                events.put(SectionDelta(spec.key, done=True))
+            except Exception as e:
+                events.put(SectionDelta(spec.key, done=True, error=resilience.translate_error(e)))
+            finally:
+                stream.close()
+
+        executor = ThreadPoolExecutor(max_workers=min(self.report_max_parallel, len(ADVICE_SECTIONS)),
+                                      thread_name_prefix="tcm-report")
+        for spec in ADVICE_SECTIONS:
+            executor.submit(generate, spec)
+        try:
+            remaining = len(ADVICE_SECTIONS)
+            while remaining:
+                delta = events.get()
+                remaining -= delta.done
+                yield delta
+            metrics.REPORT_DURATION.observe(time.perf_counter() - started, model=self.model)
+        finally:
+            # 调用方提前关闭时，尚未完成的章节立即中止并关闭HTTP响应
+            stop.cancel()
+            executor.shutdown(wait=False)
+
+    @cancellation.closing_stream
+    def chat_streaming(self, messages, age="未提供", gender="不方便透露", session_id=None):
         """
         多轮对话流式输出
 
         参数:
-            messages: 对话历史 [{"role": "user/assistant", "content": "..."}]
+            messages: 对话历史 [{"role": "user/assistant", "content": "..."}]，
+                      会按token预算自动裁剪，无需调用方截断
             age: 年龄（可以是数字或"未提供"）
             gender: 性别
+            session_id: 可选的会话ID，提供时较早的轮次以病例摘要代替
 
         返回:
-            生成器，逐步返回AI回复
+            cancellation.ClosingStream，逐步返回AI回复；提前 close() 或离开 with 块时立即关闭上游HTTP响应
+            （与其他会话合并的请求在所有订阅者都离开后关闭）
         """
+        request = None
         try:
-            # 格式化年龄信息
-            if age == "未提供":
-                age_info = "未提供（请勿在回复中假设或提及具体年龄）"
+            request = self._prepare_chat(messages, age, gender, session_id)
+            api_messages = request.messages
+            # 危险信号直接以模板回复，不调用模型
+            if request.triage is not None and request.triage.urgent:
+                yield from response_cache.replay(request.triage.reply())
+                return
+
+            tracker = metrics.CallTracker("chat_streaming", self.model, request.prompt_tokens, request.max_tokens)
+
+            # 命中缓存时直接回放，跳过API调用
+            cached = self._lookup_reply(request, age, gender)
+            if cached is not None:
+                tracker.cache_hit = True
+                yield from metrics.track_stream(tracker, response_cache.replay(cached))
+                return
+
+            # 请求合并时上游流在读取线程中运行，所有订阅者都离开后以此中止
+            cancel = cancellation.Cancellation()
+
+            def upstream():
+                # 调用OpenAI API（流式，带首token超时、重试与对冲；按请求类型选择后端）
+                plan = self.router.plan(request.kind, tracker)
+                stream = resilience.resilient_stream(
+                    lambda: plan.open_stream(
+                        messages=api_messages,
+                        temperature=0.7,
+                        max_tokens=request.max_tokens,
+                        stream=True,
+                        timeout=self.retry_policy.stream_timeout(),
+                        **metrics.usage_kwargs(),
+                    ),
+                    self.retry_policy,
+                    on_chunk=tracker.on_chunk,
+                    cancel=cancel,
+                )
+
+                chunks = metrics.track_stream(tracker, stream)
+                if request.knowledge is not None:
+                    # 把回复中的条目编号展开为知识库内容
+                    chunks = knowledge_base.expand_stream(request.knowledge, chunks)
+
+                parts = []
+                with contextlib.closing(chunks):
+                    for text in chunks:
+                        parts.append(text)
+                        yield text
+
+                # 完整接收后写入缓存
+                self._store_reply(request, age, gender, "".join(parts))
+
+            # 逐步返回结果；提示词完全相同的在途请求共享同一个上游流
+            if self.single_flight is None:
+                yield from upstream()
             else:
-                age_info = f"{age}岁"
-
-            # 构建系统提示词（针对多轮对话优化）
-            system_prompt = f"""你是一位经验丰富的中医养生专家，正在与用户进行多轮对话咨询。
-
-用户信息：
-- 年龄：{age_info}
-- 性别：{gender}
-
-你的职责：
-1. 耐心倾听用户的症状和问题
-2. 通过提问了解更多细节（如症状持续时间、加重缓解因素等）
-3. 从中医角度分析症状，给出辨证结果
-4. 提供实用的养生建议（饮食、起居、运动等）
-5. 回答用户的追问，解释中医理论
-
-对话原则：
-- 语言简洁友好，避免过于专业的术语
-- 根据对话上下文给出针对性回复
-- 如果信息不足，先主动询问更多细节（如症状持续时间、程度、伴随症状等）
-- 当收集到足够信息后，必须提供完整的分析，包括：
-  * 中医辨证分析（证型判断及依据）
-  * 个性化养生建议（饮食、起居、运动等）
-- 强调这是养生保健建议，不能替代医疗诊断
-- 遇到严重症状，建议就医
-
-回复格式要求：
-- 简短问答：直接回复即可
-- 症状分析：当用户描述完整症状或你已收集足够信息时，必须按以下结构提供详细回复：
-
-**中医辨证分析：**
-1. 证型判断：明确指出1-2个最可能的证型（如气虚、血虚、阴虚、阳虚、气滞、血瘀、痰湿、湿热等）
-2. 辨证依据：详细说明为什么判断为该证型，结合用户症状逐一分析
-3. 病机解释：用通俗易懂的语言解释中医如何理解这种身体状态
-4. 个体因素：考虑年龄、性别对症状的影响
-
-**养生建议：**（每项都要具体、可操作）
-
-1. 饮食调理：
-   - 推荐食物：列举5-8种具体食物，说明功效和食用方法
-   - 食疗方：提供2-3个简单易做的食疗方，标注材料用量和详细做法
-   - 避免食物：明确列出不宜食物及原因
-   - 饮食习惯：用餐时间、份量、温度、烹饪方式等建议
-
-2. 生活起居：
-   - 作息建议：具体的睡眠时间和午休建议
-   - 睡眠改善：提供3-5个实用方法
-   - 情绪调节：针对症状的具体情志调摄建议
-   - 日常注意：需要避免的生活习惯，给出替代方案
-
-3. 运动养生：
-   - 推荐运动：列举3-5种适合的运动方式及理由
-   - 运动方案：具体的频率（每周几次）、时长、强度、最佳时间
-   - 传统功法：如适合，推荐八段锦、太极、五禽戏等，说明练习要点和注意事项
-   - 运动禁忌：明确需要避免的运动类型
-
-4. 其他调理方法：
-   - 穴位保健：推荐3-5个穴位，详细说明位置、按摩手法、频率和作用
-   - 外治方法：如泡脚、艾灸、刮痧等，提供具体操作方案
-   - 季节调养：当前季节的特别注意事项和调养重点
-   - 日常小妙招：提供2-3个简单实用的养生技巧
-
-**重要提醒：**
-1. 就医建议：明确列出哪些症状变化需要及时就医
-2. 调理周期：预期多久能看到改善，需要坚持多久
-3. 注意事项：如有基础疾病或在服药的特别提醒
-4. 跟踪评估：建议定期自我评估和调整的方法
-
-内容要求：
-- 每个建议都要具体、详细、可操作
-- 避免空泛的建议，给出明确的数量、时间、方法
-- 语言通俗易懂，适当使用比喻帮助理解
-- 整体积极温和，给用户信心和方向
-
-请保持温和、专业的语气，像一位可信赖的中医师一样与用户交流。"""
-
-            # 构建完整的消息列表
-            api_messages = [{"role": "system", "content": system_prompt}]
-
-            # 添加对话历史（跳过欢迎消息）
-            for msg in messages:
-                if msg['role'] in ['user', 'assistant']:
-                    # 过滤掉欢迎消息
-                    if not (msg['role'] == 'assistant' and '我是您的中医智能小助手' in msg['content']):
-                        api_messages.append({
-                            "role": msg['role'],
-                            "content": msg['content']
-                        })
-
-            # 调用OpenAI API（流式）
-            stream = self.client.chat.completions.create(
-                model=self.model,
-                messages=api_messages,
-                temperature=0.7,
-                max_tokens=1500,
-                stream=True
-            )
-
-            # 逐步返回结果
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    yield chunk.choices[0].delta.content
+                yield from self.single_flight.stream(request.flight_key, upstream, cancel)
 
+        except resilience.LLMError:
+            raise
         except Exception as e:
-            raise Exception(f"调用LLM API时出错: {str(e)}")
\ No newline at end of file
+            raise resilience.translate_error(e) from e
+        finally:
+            # 本轮回复结束后再整理摘要，避免与当前回复争用连接
+            if request is not None and request.fold_job is not None:
+                self._start_fold(request.fold_job)
+
+
+# 进程级共享的分析器实例
+_analyzer = None
+_analyzer_lock = threading.Lock()
+
+
+def get_analyzer():
+    """
+    获取所有会话共享的分析器实例（线程安全，首次调用时创建）
+
+    设置环境变量 TCM_ENGINE=async 时返回异步引擎的同步适配器，接口与TCMAnalyzer一致。
+    """
+    global _analyzer
+    config.load_env()
+    if os.getenv("TCM_ENGINE", "sync").strip().lower() == "async":
+        from async_llm_service import get_sync_analyzer
+        return get_sync_analyzer()
+
+    if _analyzer is None:
+        with _analyzer_lock:
+            if _analyzer is None:
+                _analyzer = TCMAnalyzer()
+    return _analyzer
+
+
+def shutdown():
+    """释放共享分析器及其HTTP连接池"""
+    global _analyzer
+    with _analyzer_lock:
+        _analyzer = None
+    client_pool.shutdown()
@@ -0,0 +1,522 @@
+"""
+延迟与token统计
+
+记录每次LLM调用的首token耗时、流式总耗时、生成速度、提示词/生成token数和缓存命中，
+以直方图和计数器的形式汇总，可导出为Prometheus文本格式，或把每次调用逐条写入JSON Lines文件。
+文件写入在后台线程中按间隔批量进行，请求线程只把记录放入待写缓冲；写入失败只计入
+tcm_metrics_export_errors_total，不会影响调用本身。
+
+环境变量:
+    TCM_METRICS_JSONL: 每次调用结束后追加一条JSON记录的文件路径
+    TCM_METRICS_PROM_FILE: 定期写入Prometheus文本格式的文件路径（供node_exporter textfile采集）
+    TCM_METRICS_USAGE: 设为 on 时请求上游在流式输出末尾返回usage（需要上游支持 stream_options）
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+import cancellation
+from context_window import count_tokens
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+TOKENS_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000)
+RATE_BUCKETS = (5, 10, 20, 40, 80, 160, 320)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Prometheus文本文件的最短写入间隔（秒）
+PROM_FILE_INTERVAL = 10.0
+# 统计记录的后台写入间隔（秒）与待写缓冲上限（持续写入失败时丢弃最早的记录）
+EXPORT_INTERVAL = 1.0
+MAX_PENDING_RECORDS = 10000
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=None):
+    items = list(key) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    body = ",".join(f'{name}="{value}"' for name, value in items)
+    return "{" + body + "}"
+
+
+class Counter:
+    """单调递增计数器"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return dict(self._values)
+
+    def prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.samples().items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    """固定桶直方图"""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+
+    def summary(self, **labels):
+        """返回 {"count", "sum", "mean"}"""
+        state = self.samples().get(_label_key(labels))
+        if state is None:
+            return {"count": 0, "sum": 0.0, "mean": None}
+        _, total, count = state
+        return {"count": count, "sum": total, "mean": total / count}
+
+    def prometheus(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.samples().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', f'{bound:g}')])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total:g}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def counter(self, name, help_text):
+        return self._register(name, lambda: Counter(name, help_text))
+
+    def histogram(self, name, help_text, buckets=SECONDS_BUCKETS):
+        return self._register(name, lambda: Histogram(name, help_text, buckets))
+
+    def _register(self, name, factory):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = factory()
+            return metric
+
+    def to_prometheus(self):
+        """导出为Prometheus文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.prometheus())
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        """导出为可JSON序列化的字典"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        result = {}
+        for metric in metrics:
+            entries = []
+            for key, value in metric.samples().items():
+                entry = {"labels": dict(key)}
+                if isinstance(metric, Histogram):
+                    counts, total, count = value
+                    entry.update({"buckets": dict(zip([*map(str, metric.buckets), "+Inf"], counts)),
+                                  "sum": total, "count": count})
+                else:
+                    entry["value"] = value
+                entries.append(entry)
+            result[metric.name] = entries
+        return result
+
+
+registry = MetricsRegistry()
+
+# ==================== LLM调用指标 ====================
+
+REQUESTS = registry.counter("tcm_llm_requests_total", "LLM调用次数（按方法和结果）")
+CACHE_HITS = registry.counter("tcm_llm_cache_hits_total", "回复缓存命中次数")
+PROMPT_TOKENS = registry.counter("tcm_llm_prompt_tokens_total", "发送的提示词token数")
+COMPLETION_TOKENS = registry.counter("tcm_llm_completion_tokens_total", "生成的token数")
+TTFT = registry.histogram("tcm_llm_time_to_first_token_seconds", "从发起请求到收到首个文本块的耗时")
+DURATION = registry.histogram("tcm_llm_duration_seconds", "一次调用从开始到结束的总耗时")
+TOKENS_PER_SECOND = registry.histogram("tcm_llm_tokens_per_second", "首token之后的生成速度", RATE_BUCKETS)
+PROMPT_SIZE = registry.histogram("tcm_llm_prompt_tokens", "单次请求的提示词token数", TOKENS_BUCKETS)
+CANCELLED_TOKENS = registry.counter("tcm_llm_cancelled_tokens_saved_total",
+                                    "调用被取消（停止、新对话、客户端断开）后估算少生成的token数")
+
+SEMANTIC_REQUESTS = registry.counter("tcm_semantic_cache_requests_total", "语义缓存查找次数（按是否命中）")
+SEMANTIC_LOOKUP = registry.histogram("tcm_semantic_cache_lookup_seconds", "语义缓存单次查找耗时",
+                                     (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+
+ROUTER_ATTEMPTS = registry.counter("tcm_router_attempts_total", "各后端的请求尝试次数（按后端和结果）")
+ROUTER_TTFT = registry.histogram("tcm_router_time_to_first_token_seconds", "各后端的首token耗时")
+ROUTER_EXPLORE = registry.counter("tcm_router_explore_total", "least_latency 策略下先试非最快后端的次数（按后端）")
+
+SINGLE_FLIGHT = registry.counter("tcm_single_flight_requests_total",
+                                 "多轮对话上游请求的发起与合并次数（originated / coalesced）")
+
+ADMISSION = registry.counter("tcm_admission_total",
+                             "准入控制结果（admitted / session_rate / queue_full / timeout）")
+ADMISSION_WAIT = registry.histogram("tcm_admission_wait_seconds", "请求从提交到放行的排队时间")
+
+TRIAGE = registry.counter("tcm_triage_total",
+                          "本地分诊结果（red_flag 模板回复 / knowledge 知识库提示词 / focused 聚焦提示词 / full 完整提示词）")
+CORPUS = registry.counter("tcm_answer_corpus_total", "首轮提问命中预生成回复语料的结果（hit / stale 版本已过期）")
+KNOWLEDGE = registry.counter("tcm_knowledge_items_total", "回复中知识库条目引用的展开次数（expanded / unknown）")
+
+REPORT_DURATION = registry.histogram("tcm_report_seconds", "分节报告从开始到全部章节完成的耗时")
+
+SUMMARY_FOLDS = registry.counter("tcm_summary_folds_total", "病例摘要增量整理次数（按结果）")
+
+SHARED_STATE = registry.counter("tcm_shared_state_total",
+                                "共享状态操作（get: hit / miss / error，flush: ok / error）")
+SHARED_STATE_FLUSH = registry.histogram("tcm_shared_state_flush_seconds", "共享状态一次批量写入的耗时",
+                                        (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5))
+SHARED_STATE_BATCH = registry.histogram("tcm_shared_state_batch_ops", "共享状态每次批量写入的更新数", COUNT_BUCKETS)
+
+EXPORT_ERRORS = registry.counter("tcm_metrics_export_errors_total",
+                                 "统计导出失败次数（sink: 接收者出错，jsonl / prometheus: 写文件失败，dropped: 待写缓冲已满）")
+
+# ==================== 界面渲染指标 ====================
+
+UI_TTFT = registry.histogram("tcm_ui_time_to_first_frame_seconds", "从开始生成回复到界面显示首帧的耗时")
+UI_DURATION = registry.histogram("tcm_ui_reply_seconds", "界面上一次完整回复的耗时")
+UI_FRAMES = registry.histogram("tcm_ui_frames_per_reply", "每次回复推送到前端的渲染帧数", COUNT_BUCKETS)
+
+
+def usage_enabled():
+    """是否请求上游在流式输出中返回usage"""
+    return os.getenv("TCM_METRICS_USAGE", "off").strip().lower() in ("1", "on", "true")
+
+
+def usage_kwargs():
+    """流式请求的额外参数：启用时请求上游返回usage，否则为空"""
+    return {"stream_options": {"include_usage": True}} if usage_enabled() else {}
+
+
+_sinks = []
+
+
+def add_sink(callback):
+    """注册统计记录的接收者 callback(record)，每次调用结束后调用（应当快速返回，例如只记入待写缓冲）"""
+    _sinks.append(callback)
+
+
+class _FileExporter:
+    """JSONL记录与Prometheus文本文件的后台写入（首次有记录时启动后台线程）"""
+
+    def __init__(self, interval=EXPORT_INTERVAL, max_pending=MAX_PENDING_RECORDS):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = deque()
+        self._last_prom_write = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def submit(self, record):
+        """放入待写缓冲（record 为None时只触发Prometheus文本文件的定期写入）"""
+        with self._lock:
+            if record is not None:
+                if len(self._pending) >= self.max_pending:
+                    self._pending.popleft()
+                    EXPORT_ERRORS.inc(target="dropped")
+                self._pending.append(record)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="metrics-export", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def flush(self):
+        """写入待写缓冲中的记录，并按间隔刷新Prometheus文本文件；失败时计数后丢弃"""
+        jsonl_path = os.getenv("TCM_METRICS_JSONL")
+        prom_path = os.getenv("TCM_METRICS_PROM_FILE")
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, deque()
+            if pending and jsonl_path:
+                try:
+                    lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in pending)
+                    with open(jsonl_path, "a", encoding="utf-8") as f:
+                        f.write(lines)
+                except (OSError, TypeError, ValueError):
+                    EXPORT_ERRORS.inc(len(pending), target="jsonl")
+            if prom_path and time.monotonic() - self._last_prom_write >= PROM_FILE_INTERVAL:
+                self._last_prom_write = time.monotonic()
+                try:
+                    write_prometheus(prom_path)
+                except OSError:
+                    EXPORT_ERRORS.inc(target="prometheus")
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        """停止后台线程并写入剩余的记录（重复调用无效果）"""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+        self.flush()
+
+
+_exporter = _FileExporter()
+
+
+def _export(record):
+    """把记录交给已注册的接收者，并放入JSONL / Prometheus文本文件的待写缓冲；任何导出错误都只计数"""
+    for sink in _sinks:
+        try:
+            sink(record)
+        except Exception:
+            EXPORT_ERRORS.inc(target="sink")
+    jsonl_path = os.getenv("TCM_METRICS_JSONL")
+    prom_path = os.getenv("TCM_METRICS_PROM_FILE")
+    if jsonl_path or prom_path:
+        _exporter.submit(record if jsonl_path else None)
+
+
+def write_prometheus(path):
+    """把当前指标以Prometheus文本格式写入文件（先写临时文件再替换，避免读到半个文件）"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(registry.to_prometheus())
+    os.replace(tmp_path, path)
+
+
+class _CompletionLengths:
+    """各方法完整回复的平均生成token数，用于估算取消调用少生成的token数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def record(self, key, tokens):
+        with self._lock:
+            count, total = self._totals.get(key, (0, 0))
+            self._totals[key] = (count + 1, total + tokens)
+
+    def mean(self, key):
+        with self._lock:
+            count, total = self._totals.get(key, (0, 0))
+        return total / count if count else None
+
+
+_completion_lengths = _CompletionLengths()
+
+
+def estimate_saved_tokens(method, model, generated, max_tokens=None):
+    """
+    估算取消的调用少生成的token数：同类调用完整回复的平均长度减去已生成的部分，
+    尚无完整回复时按 max_tokens 估算（上限）
+
+    返回:
+        token数，无法估算时返回0
+    """
+    expected = _completion_lengths.mean((method, model))
+    if expected is None:
+        expected = max_tokens or 0
+    elif max_tokens:
+        expected = min(expected, max_tokens)
+    return max(int(expected) - (generated or 0), 0)
+
+
+class CallTracker:
+    """跟踪一次LLM调用"""
+
+    def __init__(self, method, model, prompt_tokens=None, max_tokens=None):
+        """
+        参数:
+            method: analyze / analyze_streaming / chat_streaming
+            model: 模型名称
+            prompt_tokens: 本地估算的提示词token数（上游返回usage时以usage为准）
+            max_tokens: 请求的生成上限，用于估算取消时少生成的token数
+        """
+        self.method = method
+        self.model = model
+        self.max_tokens = max_tokens
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = None
+        self.cache_hit = False
+        self._parts = []
+        self._finished = False
+
+    def on_text(self, text):
+        """收到一个文本块"""
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self._parts.append(text)
+
+    def on_chunk(self, chunk):
+        """收到一个原始chunk，提取其中的usage"""
+        usage = getattr(chunk, "usage", None)
+        if usage is not None:
+            self.set_usage(usage)
+
+    def set_usage(self, usage):
+        self.prompt_tokens = usage.prompt_tokens
+        self.completion_tokens = usage.completion_tokens
+
+    def finish(self, outcome="ok"):
+        """结束统计，outcome 为 ok / error / cancelled"""
+        if self._finished:
+            return
+        self._finished = True
+        ended = time.perf_counter()
+        labels = {"method": self.method, "model": self.model}
+
+        if self.completion_tokens is None and self._parts:
+            self.completion_tokens = count_tokens("".join(self._parts), self.model)
+
+        REQUESTS.inc(outcome=outcome, cache="hit" if self.cache_hit else "miss", **labels)
+        DURATION.observe(ended - self.started, **labels)
+        if self.cache_hit:
+            CACHE_HITS.inc(**labels)
+        else:
+            if self.prompt_tokens:
+                PROMPT_TOKENS.inc(self.prompt_tokens, **labels)
+                PROMPT_SIZE.observe(self.prompt_tokens, **labels)
+            if self.completion_tokens:
+                COMPLETION_TOKENS.inc(self.completion_tokens, **labels)
+            if outcome == "ok" and self.completion_tokens:
+                _completion_lengths.record((self.method, self.model), self.completion_tokens)
+            elif outcome == "cancelled":
+                saved = estimate_saved_tokens(self.method, self.model, self.completion_tokens, self.max_tokens)
+                if saved:
+                    CANCELLED_TOKENS.inc(saved, **labels)
+
+        ttft = None
+        tokens_per_second = None
+        if self.first_token_at is not None and not self.cache_hit:
+            ttft = self.first_token_at - self.started
+            TTFT.observe(ttft, **labels)
+            generation = ended - self.first_token_at
+            if self.completion_tokens and generation > 0:
+                tokens_per_second = self.completion_tokens / generation
+                TOKENS_PER_SECOND.observe(tokens_per_second, **labels)
+
+        _export({
+            "ts": time.time(),
+            "method": self.method,
+            "model": self.model,
+            "outcome": outcome,
+            "cache_hit": self.cache_hit,
+            "ttft": ttft,
+            "duration": ended - self.started,
+            "tokens_per_second": tokens_per_second,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        })
+
+
+def track_stream(tracker, stream):
+    """
+    包装文本流：逐块记录，流结束、出错或被关闭时结束统计
+
+    参数:
+        tracker: CallTracker
+        stream: 文本块迭代器（被提前关闭时随之关闭，上游HTTP响应立即断开）
+    """
+    outcome = "cancelled"
+    try:
+        for text in stream:
+            tracker.on_text(text)
+            yield text
+        outcome = "ok"
+    except cancellation.StreamCancelled:
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        cancellation.close_stream(stream)
+        tracker.finish(outcome)
+
+
+async def atrack_stream(tracker, stream):
+    """track_stream 的异步版本"""
+    outcome = "cancelled"
+    try:
+        async for text in stream:
+            tracker.on_text(text)
+            yield text
+        outcome = "ok"
+    except cancellation.StreamCancelled:
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        await cancellation.aclose_stream(stream)
+        tracker.finish(outcome)
+
+
+def record_render(started, first_frame_at, frames):
+    """记录界面侧一次回复的渲染统计"""
+    ended = time.perf_counter()
+    if first_frame_at is not None:
+        UI_TTFT.observe(first_frame_at - started)
+    UI_DURATION.observe(ended - started)
+    UI_FRAMES.observe(frames)
+    _export({
+        "ts": time.time(),
+        "method": "ui_reply",
+        "ttft": None if first_frame_at is None else first_frame_at - started,
+        "duration": ended - started,
+        "frames": frames,
+    })
+
+
+def export_prometheus():
+    """返回Prometheus文本格式的全部指标"""
+    return registry.to_prometheus()
+
+
+def export_json():
+    """返回JSON格式的全部指标"""
+    return json.dumps(registry.to_dict(), ensure_ascii=False)
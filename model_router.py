@@ -0,0 +1,395 @@
+"""
+多后端模型路由
+
+在多个OpenAI兼容端点（如自建的vLLM/llama.cpp服务与公共API）之间分配请求：
+    - 后端注册表：每个后端有自己的客户端、模型、权重和可服务的请求类型
+    - 按请求类型选模型：简短追问（followup）可以交给小而快的模型，完整辨证分析（analysis）交给大模型
+    - 实时健康与延迟跟踪：首token耗时的指数加权移动平均（EWMA），连续失败后暂时摘除
+    - 选择策略：least_latency（EWMA最低优先，按探索比例偶尔先试其他后端，使过时的EWMA得以更新）
+      或 weighted（按权重随机）
+    - 故障转移：同一请求的重试和对冲请求依次使用下一个候选后端
+
+环境变量:
+    TCM_BACKENDS: 后端列表（JSON字符串或 .json 文件路径），未设置时只使用 OPENAI_API_BASE 上的默认后端
+        [{"name": "local", "base_url": "http://127.0.0.1:8000/v1", "model": "qwen2.5-7b-instruct",
+          "api_key_env": "LOCAL_API_KEY", "kinds": ["followup"], "weight": 2},
+         {"name": "openai", "model": "gpt-4o-mini"}]
+    TCM_ROUTER_STRATEGY: least_latency（默认）或 weighted
+    TCM_ROUTER_EWMA_ALPHA: EWMA平滑系数，默认0.3
+    TCM_ROUTER_FAILURE_THRESHOLD: 连续失败多少次后摘除，默认3
+    TCM_ROUTER_COOLDOWN: 摘除后多少秒再重新尝试，默认30
+    TCM_ROUTER_EXPLORE_RATE: least_latency 策略下先试非最快后端的请求比例，默认0.05（0为不探索）
+    TCM_FOLLOWUP_MAX_CHARS: 不超过该字数的追问视为简短追问，默认80
+"""
+import json
+import os
+import random
+import threading
+import time
+
+import config
+import metrics
+import resilience
+
+KINDS = ("analysis", "followup")
+
+DEFAULT_MODEL = "gpt-4o-mini"
+DEFAULT_EWMA_ALPHA = 0.3
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_COOLDOWN = 30.0
+DEFAULT_EXPLORE_RATE = 0.05
+DEFAULT_FOLLOWUP_MAX_CHARS = 80
+
+
+class Backend:
+    """一个OpenAI兼容后端"""
+
+    def __init__(self, name, client, model=DEFAULT_MODEL, weight=1.0, kinds=KINDS):
+        """
+        参数:
+            name: 后端名称（用于日志和指标）
+            client: OpenAI 或 AsyncOpenAI 客户端
+            model: 在该后端上使用的模型
+            weight: weighted 策略下的权重
+            kinds: 可以服务的请求类型
+        """
+        self.name = name
+        self.client = client
+        self.model = model
+        self.weight = float(weight)
+        self.kinds = tuple(kinds)
+        self.ewma_ttft = None
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def healthy(self, now):
+        return now >= self.unhealthy_until
+
+
+class RoutePlan:
+    """一次请求的候选后端顺序，每次尝试（重试或对冲）取下一个"""
+
+    def __init__(self, router, kind, backends, tracker=None):
+        self.router = router
+        self.kind = kind
+        self.backends = backends
+        self.tracker = tracker
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self):
+        return self.backends[0]
+
+    def next_backend(self):
+        with self._lock:
+            backend = self.backends[self._next % len(self.backends)]
+            self._next += 1
+        return backend
+
+    def call(self, **kwargs):
+        """发起一次非流式请求（kwargs 为 chat.completions.create 的参数，不含model）"""
+        backend = self.next_backend()
+        try:
+            response = backend.client.chat.completions.create(model=backend.model, **kwargs)
+        except Exception as e:
+            self.router.record_failure(backend, e)
+            raise
+        self.router.record_success(backend, None)
+        if self.tracker is not None:
+            self.tracker.model = backend.model
+        return response
+
+    async def acall(self, **kwargs):
+        """call 的异步版本"""
+        backend = self.next_backend()
+        try:
+            response = await backend.client.chat.completions.create(model=backend.model, **kwargs)
+        except Exception as e:
+            self.router.record_failure(backend, e)
+            raise
+        self.router.record_success(backend, None)
+        if self.tracker is not None:
+            self.tracker.model = backend.model
+        return response
+
+    def open_stream(self, **kwargs):
+        """发起一次流式请求，返回记录首token耗时与失败的包装流"""
+        backend = self.next_backend()
+        started = time.monotonic()
+        try:
+            stream = backend.client.chat.completions.create(model=backend.model, **kwargs)
+        except Exception as e:
+            self.router.record_failure(backend, e)
+            raise
+        return _RoutedStream(self, backend, stream, started)
+
+    async def aopen_stream(self, **kwargs):
+        """open_stream 的异步版本"""
+        backend = self.next_backend()
+        started = time.monotonic()
+        try:
+            stream = await backend.client.chat.completions.create(model=backend.model, **kwargs)
+        except Exception as e:
+            self.router.record_failure(backend, e)
+            raise
+        return _AsyncRoutedStream(self, backend, stream, started)
+
+
+class _RoutedStream:
+    """包装openai的Stream：首个文本块到达时记录该后端的首token耗时"""
+
+    def __init__(self, plan, backend, stream, started):
+        self._plan = plan
+        self._backend = backend
+        self._stream = stream
+        self._started = started
+        self._first = True
+        self._closed = False
+
+    def _on_chunk(self, chunk):
+        if self._first and resilience._delta_text(chunk) is not None:
+            self._first = False
+            self._plan.router.record_success(self._backend, time.monotonic() - self._started)
+            if self._plan.tracker is not None:
+                self._plan.tracker.model = self._backend.model
+
+    def _on_error(self, error):
+        # 被取消的对冲请求不算失败
+        if not self._closed:
+            self._plan.router.record_failure(self._backend, error)
+
+    def _on_abort(self, error):
+        """首token超时或流中断时被放弃：记为该后端的失败，尚未收到首token时把等待时间计入EWMA"""
+        if self._closed:
+            return
+        self._closed = True
+        ttft = time.monotonic() - self._started if self._first else None
+        self._plan.router.record_failure(self._backend, error, ttft)
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                self._on_chunk(chunk)
+                yield chunk
+        except Exception as e:
+            self._on_error(e)
+            raise
+
+    def close(self):
+        self._closed = True
+        self._stream.close()
+
+    def abort(self, error):
+        """因超时放弃该请求（与对冲失败方、用户取消时的 close() 区分）"""
+        self._on_abort(error)
+        self._stream.close()
+
+
+class _AsyncRoutedStream(_RoutedStream):
+    """_RoutedStream 的异步版本"""
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                self._on_chunk(chunk)
+                yield chunk
+        except Exception as e:
+            self._on_error(e)
+            raise
+
+    async def close(self):
+        self._closed = True
+        await self._stream.close()
+
+    async def abort(self, error):
+        self._on_abort(error)
+        await self._stream.close()
+
+
+class ModelRouter:
+    """后端注册表与选择策略"""
+
+    def __init__(self, backends, strategy="least_latency", ewma_alpha=DEFAULT_EWMA_ALPHA,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD, cooldown=DEFAULT_COOLDOWN,
+                 followup_max_chars=DEFAULT_FOLLOWUP_MAX_CHARS, explore_rate=DEFAULT_EXPLORE_RATE):
+        """
+        参数:
+            backends: Backend 列表，第一个为默认后端
+            strategy: least_latency 或 weighted
+            ewma_alpha: 首token耗时EWMA的平滑系数
+            failure_threshold: 连续失败多少次后暂时摘除
+            cooldown: 摘除的秒数，之后重新参与选择
+            followup_max_chars: 不超过该字数的追问视为简短追问
+            explore_rate: least_latency 策略下把随机一个非最快的健康后端排在最前的请求比例
+        """
+        if not backends:
+            raise ValueError("至少需要配置一个后端")
+        if strategy not in ("least_latency", "weighted"):
+            raise ValueError(f"未知的路由策略: {strategy}")
+        self.backends = list(backends)
+        self.strategy = strategy
+        self.ewma_alpha = ewma_alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.followup_max_chars = followup_max_chars
+        self.explore_rate = explore_rate
+        self._lock = threading.Lock()
+
+    @property
+    def default(self):
+        return self.backends[0]
+
+    def classify_chat(self, history):
+        """
+        判断多轮对话请求的类型
+
+        已经有过回复、且最新一条用户消息较短时视为简短追问，其余按完整辨证分析处理
+        """
+        if not history or history[-1]["role"] != "user":
+            return "analysis"
+        answered = any(m["role"] == "assistant" for m in history[:-1])
+        if answered and len(history[-1]["content"]) <= self.followup_max_chars:
+            return "followup"
+        return "analysis"
+
+    def _candidates(self, kind):
+        """支持该类型的后端；没有后端声明支持该类型时为全部后端"""
+        return [b for b in self.backends if kind in b.kinds] or list(self.backends)
+
+    def model_key(self, kind):
+        """
+        该类型的请求可能由哪些模型生成回复
+
+        返回:
+            "类型:模型1,模型2"（模型名称排序去重），用于回复缓存键和预生成语料的版本戳：
+            无论本次由哪个后端生成，后端的模型配置变化后都不再复用旧的回复
+        """
+        return kind + ":" + ",".join(sorted({b.model for b in self._candidates(kind)}))
+
+    def plan(self, kind, tracker=None):
+        """
+        为一次请求排列候选后端
+
+        健康的后端按策略排序在前，被摘除的后端排在最后作为兜底；
+        没有后端声明支持该类型时使用全部后端。
+        """
+        now = time.monotonic()
+        probe = None
+        with self._lock:
+            candidates = self._candidates(kind)
+            healthy = [b for b in candidates if b.healthy(now)]
+            unhealthy = sorted((b for b in candidates if not b.healthy(now)), key=lambda b: b.unhealthy_until)
+            if self.strategy == "weighted":
+                # 按权重的无放回随机排序
+                healthy.sort(key=lambda b: random.random() ** (1.0 / max(b.weight, 1e-6)), reverse=True)
+            else:
+                # 还没有样本的后端优先，以便尽快获得延迟数据
+                healthy.sort(key=lambda b: (b.ewma_ttft is not None, b.ewma_ttft or 0.0, -b.weight))
+                # 只按EWMA排序时，一次慢请求后该后端再也不会被选中，EWMA停留在过时的值；
+                # 按比例先试一个其他后端，失败或超时仍会转到最快的后端
+                if len(healthy) > 1 and random.random() < self.explore_rate:
+                    probe = healthy.pop(random.randrange(1, len(healthy)))
+                    healthy.insert(0, probe)
+        if probe is not None:
+            metrics.ROUTER_EXPLORE.inc(backend=probe.name)
+        return RoutePlan(self, kind, healthy + unhealthy, tracker)
+
+    def record_success(self, backend, ttft):
+        with self._lock:
+            backend.requests += 1
+            backend.consecutive_failures = 0
+            backend.unhealthy_until = 0.0
+            if ttft is not None:
+                if backend.ewma_ttft is None:
+                    backend.ewma_ttft = ttft
+                else:
+                    backend.ewma_ttft = self.ewma_alpha * ttft + (1 - self.ewma_alpha) * backend.ewma_ttft
+        metrics.ROUTER_ATTEMPTS.inc(backend=backend.name, outcome="ok")
+        if ttft is not None:
+            metrics.ROUTER_TTFT.observe(ttft, backend=backend.name)
+
+    def record_failure(self, backend, error=None, ttft=None):
+        """
+        参数:
+            error: 失败原因，请求本身有误（如参数错误）时不计入后端健康
+            ttft: 首token超时时已等待的秒数，计入首token耗时EWMA（下限样本）
+        """
+        if error is not None and not resilience.translate_error(error).retryable:
+            return
+        with self._lock:
+            if ttft is not None:
+                backend.ewma_ttft = ttft if backend.ewma_ttft is None else (
+                    self.ewma_alpha * ttft + (1 - self.ewma_alpha) * backend.ewma_ttft)
+            backend.requests += 1
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures >= self.failure_threshold:
+                backend.unhealthy_until = time.monotonic() + self.cooldown
+        metrics.ROUTER_ATTEMPTS.inc(backend=backend.name, outcome="error")
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "name": b.name,
+                    "model": b.model,
+                    "kinds": list(b.kinds),
+                    "healthy": b.healthy(now),
+                    "ewma_ttft": b.ewma_ttft,
+                    "requests": b.requests,
+                    "failures": b.failures,
+                }
+                for b in self.backends
+            ]
+
+
+def _load_backend_config(raw):
+    raw = raw.strip()
+    if raw.endswith(".json") and os.path.exists(raw):
+        with open(raw, encoding="utf-8") as f:
+            return json.load(f)
+    return json.loads(raw)
+
+
+def router_from_env(client_factory, default_api_key):
+    """
+    根据环境变量创建路由器
+
+    参数:
+        client_factory: 函数 client_factory(api_key, base_url)，创建（或复用）该端点的客户端
+        default_api_key: 无参函数，返回默认的API密钥（只在后端没有单独配置密钥时调用）
+    """
+    raw = os.getenv("TCM_BACKENDS", "").strip()
+    if raw:
+        backends = []
+        for index, entry in enumerate(_load_backend_config(raw)):
+            if entry.get("api_key"):
+                api_key = entry["api_key"]
+            elif entry.get("api_key_env"):
+                api_key = os.getenv(entry["api_key_env"]) or "EMPTY"  # 自建服务通常不校验密钥
+            else:
+                api_key = default_api_key()
+            base_url = entry.get("base_url") or config.api_base()
+            backends.append(Backend(
+                entry.get("name") or f"backend{index}",
+                client_factory(api_key, base_url),
+                model=entry.get("model", DEFAULT_MODEL),
+                weight=entry.get("weight", 1.0),
+                kinds=entry.get("kinds", KINDS),
+            ))
+    else:
+        backends = [Backend("default", client_factory(default_api_key(), config.api_base()))]
+
+    return ModelRouter(
+        backends,
+        strategy=os.getenv("TCM_ROUTER_STRATEGY", "least_latency").strip().lower(),
+        ewma_alpha=float(os.getenv("TCM_ROUTER_EWMA_ALPHA", DEFAULT_EWMA_ALPHA)),
+        failure_threshold=int(os.getenv("TCM_ROUTER_FAILURE_THRESHOLD", DEFAULT_FAILURE_THRESHOLD)),
+        cooldown=float(os.getenv("TCM_ROUTER_COOLDOWN", DEFAULT_COOLDOWN)),
+        followup_max_chars=int(os.getenv("TCM_FOLLOWUP_MAX_CHARS", DEFAULT_FOLLOWUP_MAX_CHARS)),
+        explore_rate=float(os.getenv("TCM_ROUTER_EXPLORE_RATE", DEFAULT_EXPLORE_RATE)),
+    )
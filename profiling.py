@@ -0,0 +1,428 @@
+"""
+Streamlit脚本的逐次运行剖析
+
+Streamlit每次交互都会从头重新执行 app.py：重新输出CSS、在 chat_container 中用 st.markdown 重新渲染全部对话历史、
+重新构建各个选择框。开启剖析后记录每次运行（从脚本开始执行到结束，或被 st.rerun()、页面跳转中止）
+以及其中页面函数的耗时，按页面和对话历史长度（消息数分段）汇总；生成回复的时间单独计时，
+汇总表中另给出扣除生成回复后的渲染耗时。
+cprofile 模式下按比例抽取部分运行用 cProfile 采样，按页面合并后写成折叠栈文件
+（每行 "帧;帧;帧 微秒数"，可直接交给 flamegraph.pl、inferno 或 speedscope 生成火焰图）。
+
+输出文件（写入 TCM_PROFILE_DIR，最多每10秒写一次，进程退出时再写一次）:
+    reruns.jsonl           每次运行一条记录（追加）
+    rerun_summary.txt      汇总表：页面 × 消息数分段的运行次数、耗时分位数与各计时段（页面函数、历史渲染、生成回复）的平均耗时
+    rerun_summary.json     同上（JSON）
+    <页面>.prof            cProfile采样的合并统计（pstats格式，可用 snakeviz 查看）
+    <页面>.folded          由上面的统计还原的折叠栈
+
+用法:
+    TCM_PROFILE=on streamlit run app.py
+    TCM_PROFILE=cprofile TCM_PROFILE_SAMPLE=0.2 streamlit run app.py
+    python -m profiling --dir profiles          # 由 reruns.jsonl 重新生成并打印汇总表
+    flamegraph.pl profiles/chat.folded > chat.svg
+
+环境变量:
+    TCM_PROFILE: on 记录耗时；cprofile 另外用cProfile采样（默认 off，关闭时每次运行只多一次函数调用）
+    TCM_PROFILE_SAMPLE: cprofile 模式下被采样的运行比例，默认 0.1
+    TCM_PROFILE_DIR: 输出目录，默认 profiles
+"""
+import atexit
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+DEFAULT_DIR = "profiles"
+DEFAULT_SAMPLE = 0.1
+FLUSH_INTERVAL = 10.0
+
+# 每个 (页面, 消息数分段) 保留的最近运行数（用于计算分位数）
+MAX_SAMPLES = 2000
+
+# 对话历史消息数的分段下界
+HISTORY_BUCKETS = (0, 1, 5, 10, 20, 50, 100)
+
+# 计时段名称：页面函数、生成回复（汇总时从运行耗时中扣除）
+PAGE_SECTION = "page"
+REPLY_SECTION = "reply"
+
+# 折叠栈的最大深度，更深的调用合并到截断处
+MAX_STACK_DEPTH = 96
+# 累计耗时不到总耗时该比例的调用路径不再展开（控制路径数量）
+MIN_STACK_FRACTION = 0.0005
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def history_bucket(messages):
+    """消息数所在的分段，如 "0"、"1-4"、"100+" """
+    for lower, upper in zip(HISTORY_BUCKETS, HISTORY_BUCKETS[1:]):
+        if messages < upper:
+            return str(lower) if upper - lower == 1 else f"{lower}-{upper - 1}"
+    return f"{HISTORY_BUCKETS[-1]}+"
+
+
+def _bucket_order(label):
+    return int(label.rstrip("+").split("-")[0])
+
+
+def _percentile(sorted_values, q):
+    index = min(int(q * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+# ==================== 折叠栈 ====================
+
+def _frame_name(func):
+    filename, line, name = func
+    if filename == "~":
+        # 内置函数，如 <built-in method time.sleep>
+        return name.strip("<>")
+    return f"{os.path.basename(filename)}:{name}:{line}"
+
+
+def folded_stacks(stats):
+    """
+    把 cProfile 的统计还原为折叠栈
+
+    cProfile 只记录 调用者→被调用者 的边，不记录完整调用栈。从没有调用者的根函数出发向下展开，
+    某条边的耗时按当前路径占被调用函数全部耗时的比例分摊（与 flameprof 等工具的做法相同），
+    递归调用在再次出现时截断，累计耗时不到总耗时 MIN_STACK_FRACTION 的路径不再展开。
+
+    参数:
+        stats: pstats.Stats
+
+    返回:
+        {"帧;帧;帧": 微秒数}
+    """
+    raw = stats.stats
+    callees = {}
+    for func, (_, _, _, _, callers) in raw.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[func] = edge
+
+    result = {}
+    roots = [func for func, (_, _, _, _, callers) in raw.items() if not callers]
+    min_time = sum(raw[func][3] for func in roots) * MIN_STACK_FRACTION
+
+    def walk(func, path, own_time, cumulative):
+        # own_time / cumulative: 当前路径下该函数的自身耗时与累计耗时（秒）
+        path = path + (_frame_name(func),)
+        if own_time > 0:
+            key = ";".join(path)
+            result[key] = result.get(key, 0) + own_time * 1e6
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        total_cumulative = raw[func][3]
+        if total_cumulative <= 0:
+            return
+        scale = cumulative / total_cumulative
+        for callee, (_, _, edge_tt, edge_ct) in callees.get(func, {}).items():
+            if callee in visiting or edge_ct * scale < min_time:
+                continue
+            visiting.add(callee)
+            walk(callee, path, edge_tt * scale, edge_ct * scale)
+            visiting.discard(callee)
+
+    for func in roots:
+        visiting = {func}
+        walk(func, (), raw[func][2], raw[func][3])
+    return {key: int(value) for key, value in result.items() if int(value) > 0}
+
+
+def write_folded(path, stacks):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for key, value in sorted(stacks.items()):
+            f.write(f"{key} {value}\n")
+    os.replace(tmp_path, path)
+
+
+# ==================== 汇总 ====================
+
+class _Series:
+    """一个 (页面, 消息数分段) 的耗时样本"""
+
+    __slots__ = ("runs", "interrupted", "total", "render", "sections")
+
+    def __init__(self):
+        self.runs = 0
+        self.interrupted = 0
+        self.total = deque(maxlen=MAX_SAMPLES)
+        self.render = deque(maxlen=MAX_SAMPLES)
+        self.sections = {}
+
+    def add(self, record):
+        self.runs += 1
+        self.interrupted += record["outcome"] != "ok"
+        self.total.append(record["total_ms"])
+        self.render.append(record["render_ms"])
+        for name, ms in record["sections"].items():
+            count, total = self.sections.get(name, (0, 0.0))
+            self.sections[name] = (count + 1, total + ms)
+
+    def summary(self):
+        total = sorted(self.total)
+        render = sorted(self.render)
+        return {
+            "runs": self.runs,
+            "interrupted": self.interrupted,
+            "mean_ms": sum(total) / len(total),
+            "p50_ms": _percentile(total, 0.50),
+            "p95_ms": _percentile(total, 0.95),
+            "max_ms": total[-1],
+            "render_p50_ms": _percentile(render, 0.50),
+            "render_p95_ms": _percentile(render, 0.95),
+            "sections_mean_ms": {name: ms / count for name, (count, ms) in sorted(self.sections.items())},
+        }
+
+
+def _rows(series):
+    return [dict(page=page, history=history, **series[page, history].summary())
+            for page, history in sorted(series, key=lambda key: (key[0], _bucket_order(key[1])))]
+
+
+def summarize(records):
+    """按 (页面, 消息数分段) 汇总运行记录，返回按页面、分段排序的行列表"""
+    series = {}
+    for record in records:
+        series.setdefault((record["page"], record["history"]), _Series()).add(record)
+    return _rows(series)
+
+
+def format_table(rows):
+    """汇总表的文本形式"""
+    lines = [f"{'页面':<14}{'消息数':>5}{'次数':>5}{'中止':>4}{'平均':>7}{'p50':>9}{'p95':>9}{'最大':>7}"
+             f"{'渲染p50':>7}{'渲染p95':>7}  各计时段平均"]
+    for row in rows:
+        sections = "  ".join(f"{name}={ms:.1f}" for name, ms in row["sections_mean_ms"].items())
+        lines.append(f"{row['page']:<16}{row['history']:>8}{row['runs']:>7}{row['interrupted']:>6}"
+                     f"{row['mean_ms']:>9.1f}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}{row['max_ms']:>9.1f}"
+                     f"{row['render_p50_ms']:>9.1f}{row['render_p95_ms']:>9.1f}  {sections}")
+    lines.append("（耗时单位 ms；渲染 = 运行耗时扣除生成回复的时间；中止 = 被 st.rerun() 或页面跳转提前结束的运行）")
+    return "\n".join(lines)
+
+
+class RerunProfiler:
+    """进程内所有会话共享的剖析数据（线程安全，Streamlit每个会话的脚本在各自的线程中运行）"""
+
+    def __init__(self, directory=DEFAULT_DIR, sample=0.0, flush_interval=FLUSH_INTERVAL):
+        """
+        参数:
+            directory: 输出目录
+            sample: 用 cProfile 采样的运行比例，0为只计时
+            flush_interval: 两次写文件之间的最短间隔（秒）
+        """
+        self.directory = directory
+        self.sample = sample
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._series = {}
+        self._pending = []
+        self._stats = {}
+        self._stats_dirty = set()
+        self._last_flush = time.monotonic()
+
+    def start(self):
+        """开始记录一次运行"""
+        profile = None
+        if self.sample > 0 and random.random() < self.sample:
+            import cProfile
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ 同一时刻只能有一个剖析器，另一个会话的运行正在被采样
+                profile = None
+        return Rerun(self, profile)
+
+    def record(self, record, profile=None):
+        """记录一次结束的运行，到达写入间隔时写文件"""
+        stats = None
+        if profile is not None:
+            import pstats
+            stats = pstats.Stats(profile)
+        with self._lock:
+            self._series.setdefault((record["page"], record["history"]), _Series()).add(record)
+            self._pending.append(record)
+            if stats is not None:
+                page = record["page"]
+                if page in self._stats:
+                    self._stats[page].add(stats)
+                else:
+                    self._stats[page] = stats
+                self._stats_dirty.add(page)
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def summary(self):
+        with self._lock:
+            return _rows(self._series)
+
+    def flush(self):
+        """写入运行记录、汇总表与折叠栈"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            dirty, self._stats_dirty = self._stats_dirty, set()
+            self._last_flush = time.monotonic()
+            if not pending and not dirty:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            # 合并统计在锁内导出，避免与其他线程的 add() 同时进行
+            stacks = {}
+            for page in dirty:
+                self._stats[page].dump_stats(os.path.join(self.directory, f"{page}.prof"))
+                stacks[page] = folded_stacks(self._stats[page])
+            rows = _rows(self._series)
+
+        with open(os.path.join(self.directory, "reruns.jsonl"), "a", encoding="utf-8") as f:
+            for record in pending:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        with open(os.path.join(self.directory, "rerun_summary.json"), "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+        with open(os.path.join(self.directory, "rerun_summary.txt"), "w", encoding="utf-8") as f:
+            f.write(format_table(rows) + "\n")
+        for page, page_stacks in stacks.items():
+            write_folded(os.path.join(self.directory, f"{page}.folded"), page_stacks)
+
+
+class Rerun:
+    """一次脚本运行的计时"""
+
+    def __init__(self, profiler, profile=None):
+        self._profiler = profiler
+        self._profile = profile
+        self._started = time.perf_counter()
+        self._sections = {}
+
+    @contextlib.contextmanager
+    def section(self, name):
+        """为运行中的一段计时（同名计时段累加）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sections[name] = self._sections.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+    @contextlib.contextmanager
+    def page(self, page, messages):
+        """
+        执行页面函数：为页面函数计时，结束（包括被 st.rerun() 中止）时记录整次运行
+
+        参数:
+            page: 页面名称
+            messages: 无参函数，返回当前会话的消息数（只在开启剖析时调用）
+        """
+        outcome = "ok"
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            outcome = "error"
+            raise
+        except BaseException:
+            # st.rerun()、页面跳转或用户新的操作中止了本次运行
+            outcome = "interrupted"
+            raise
+        finally:
+            ended = time.perf_counter()
+            if self._profile is not None:
+                self._profile.disable()
+            sections = dict(self._sections)
+            sections[PAGE_SECTION] = (ended - started) * 1000
+            total = (ended - self._started) * 1000
+            self._profiler.record({
+                "ts": time.time(),
+                "page": page,
+                "history": history_bucket(messages()),
+                "outcome": outcome,
+                "sampled": self._profile is not None,
+                "total_ms": total,
+                "render_ms": total - sections.get(REPLY_SECTION, 0.0),
+                "sections": sections,
+            }, self._profile)
+
+
+class _NullRerun:
+    """未开启剖析时使用，所有计时都是空操作"""
+
+    def section(self, name):
+        return _NULL_CONTEXT
+
+    def page(self, page, messages):
+        return _NULL_CONTEXT
+
+
+_NULL_RERUN = _NullRerun()
+
+
+# ==================== 配置 ====================
+
+def profile_mode():
+    """off / on / cprofile"""
+    mode = os.getenv("TCM_PROFILE", "off").strip().lower()
+    if mode in ("1", "true"):
+        return "on"
+    return mode if mode in ("on", "cprofile") else "off"
+
+
+def profiler_from_env():
+    """根据环境变量创建剖析器，未开启时返回None"""
+    mode = profile_mode()
+    if mode == "off":
+        return None
+    sample = float(os.getenv("TCM_PROFILE_SAMPLE", DEFAULT_SAMPLE)) if mode == "cprofile" else 0.0
+    return RerunProfiler(os.getenv("TCM_PROFILE_DIR", DEFAULT_DIR), sample)
+
+
+# 进程级共享的剖析器
+_profiler = None
+_profiler_loaded = False
+_profiler_lock = threading.Lock()
+
+
+def get_profiler():
+    """获取进程内共享的剖析器（线程安全，首次调用时创建；未开启时返回None）"""
+    global _profiler, _profiler_loaded
+    if not _profiler_loaded:
+        with _profiler_lock:
+            if not _profiler_loaded:
+                _profiler = profiler_from_env()
+                if _profiler is not None:
+                    atexit.register(_profiler.flush)
+                _profiler_loaded = True
+    return _profiler
+
+
+def start_rerun():
+    """
+    在脚本开头调用，开始记录本次运行
+
+    返回:
+        Rerun；未开启剖析时返回空操作对象，接口相同
+    """
+    profiler = get_profiler()
+    return _NULL_RERUN if profiler is None else profiler.start()
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="由运行记录生成汇总表")
+    parser.add_argument("--dir", default=os.getenv("TCM_PROFILE_DIR", DEFAULT_DIR), help="剖析输出目录")
+    args = parser.parse_args(argv)
+
+    path = os.path.join(args.dir, "reruns.jsonl")
+    if not os.path.exists(path):
+        print(f"{path} 不存在")
+        return
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    print(format_table(summarize(records)))
+
+
+if __name__ == "__main__":
+    main()
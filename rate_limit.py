@@ -0,0 +1,69 @@
+"""
+令牌桶限流
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """线程安全的令牌桶"""
+
+    def __init__(self, rate, capacity=None):
+        """
+        参数:
+            rate: 每秒补充的令牌数
+            capacity: 桶容量（允许的突发量），默认等于 rate（至少为1）
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """立即尝试取出令牌，成功返回True"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def consume(self, tokens):
+        """扣除在别处消耗的令牌（例如其他副本放行的请求）；可以扣成负数，之后补充的令牌先抵扣欠下的部分"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= tokens
+
+    def wait_time(self, tokens=1):
+        """距离能取出 tokens 个令牌还需等待的秒数"""
+        with self._lock:
+            self._refill(time.monotonic())
+            missing = tokens - self._tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate > 0 else float("inf")
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        阻塞直到取出令牌
+
+        返回:
+            是否成功（超过 timeout 秒仍未取到时返回False）
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.try_acquire(tokens):
+                return True
+            wait = self.wait_time(tokens)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or wait > remaining:
+                    return False
+            time.sleep(min(max(wait, 0.001), 1.0))
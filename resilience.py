@@ -0,0 +1,569 @@
+"""
+上游LLM调用的容错层
+
+- 分阶段超时：连接超时、首token超时、流中断（两次数据之间）超时
+- 指数退避重试，等满服务端返回的 Retry-After（超过退避上限时不再重试）
+- 可选的对冲请求：首token等待时间超过历史分位数时并行发起第二个请求，谁先出字用谁
+- 类型化异常，调用方可以区分限流、超时、连接失败等情况
+
+重试只发生在向调用方输出第一个文本块之前，避免重复输出。
+"""
+import asyncio
+import email.utils
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+
+import cancellation
+
+# ==================== 异常类型 ====================
+
+class LLMError(Exception):
+    """调用LLM API失败（消息格式与旧版保持一致，界面可直接展示）"""
+
+    retryable = False
+
+    def __init__(self, detail, retry_after=None):
+        super().__init__(f"调用LLM API时出错: {detail}")
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class LLMTimeoutError(LLMError):
+    """连接、首token或流中断超时"""
+
+    retryable = True
+
+
+class LLMConnectionError(LLMError):
+    """网络连接失败或被重置"""
+
+    retryable = True
+
+
+class LLMRateLimitError(LLMError):
+    """上游限流（429）"""
+
+    retryable = True
+
+
+class LLMServerError(LLMError):
+    """上游服务端错误（5xx）"""
+
+    retryable = True
+
+
+class LLMRequestError(LLMError):
+    """请求本身有误（认证失败、参数错误等），重试无意义"""
+
+
+def _parse_retry_after(response):
+    """解析 Retry-After / retry-after-ms 响应头，返回秒数"""
+    if response is None:
+        return None
+    headers = response.headers
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # 也可以是HTTP日期；格式不合法时忽略该响应头，不影响错误本身的转换
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed is None:
+        return None
+    return max(parsed.timestamp() - time.time(), 0.0)
+
+
+def translate_error(exc):
+    """把openai/httpx异常转换为类型化的LLMError"""
+    if isinstance(exc, LLMError):
+        return exc
+    # openai 导入较慢，出错时才需要其异常类型（此时必然已被客户端导入）
+    import openai
+    if isinstance(exc, (openai.APITimeoutError, httpx.TimeoutException)):
+        return LLMTimeoutError(str(exc) or "请求超时")
+    if isinstance(exc, openai.RateLimitError):
+        return LLMRateLimitError(str(exc), _parse_retry_after(exc.response))
+    if isinstance(exc, openai.APIStatusError):
+        retry_after = _parse_retry_after(exc.response)
+        if exc.status_code >= 500 or exc.status_code in (408, 409):
+            return LLMServerError(str(exc), retry_after)
+        return LLMRequestError(str(exc))
+    if isinstance(exc, (openai.APIConnectionError, httpx.TransportError)):
+        return LLMConnectionError(str(exc) or "连接失败")
+    return LLMError(str(exc))
+
+
+# ==================== 配置 ====================
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+
+class RetryPolicy:
+    """重试、超时与对冲配置"""
+
+    def __init__(self, max_attempts=3, backoff_base=0.5, backoff_max=8.0,
+                 connect_timeout=5.0, first_token_timeout=20.0, stall_timeout=30.0,
+                 request_timeout=90.0, hedge=False, hedge_percentile=0.95, hedge_min_samples=20):
+        """
+        参数:
+            max_attempts: 最多尝试次数（含首次）
+            backoff_base / backoff_max: 指数退避的基数与上限（秒）
+            connect_timeout: 建立连接超时（秒）
+            first_token_timeout: 从发起请求到收到第一个文本块的超时（秒）
+            stall_timeout: 流式输出中两次数据之间的最长间隔（秒）
+            request_timeout: 非流式请求的总超时（秒）
+            hedge: 是否启用对冲请求
+            hedge_percentile: 首token耗时超过该历史分位数时发起对冲请求
+            hedge_min_samples: 积累多少个样本后才启用对冲
+        """
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.connect_timeout = connect_timeout
+        self.first_token_timeout = first_token_timeout
+        self.stall_timeout = stall_timeout
+        self.request_timeout = request_timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+    @classmethod
+    def from_env(cls):
+        """从 TCM_RETRY_* / TCM_*_TIMEOUT / TCM_HEDGE* 环境变量读取配置"""
+        return cls(
+            max_attempts=int(_env_float("TCM_RETRY_MAX_ATTEMPTS", 3)),
+            backoff_base=_env_float("TCM_RETRY_BACKOFF_BASE", 0.5),
+            backoff_max=_env_float("TCM_RETRY_BACKOFF_MAX", 8.0),
+            connect_timeout=_env_float("TCM_CONNECT_TIMEOUT", 5.0),
+            first_token_timeout=_env_float("TCM_FIRST_TOKEN_TIMEOUT", 20.0),
+            stall_timeout=_env_float("TCM_STALL_TIMEOUT", 30.0),
+            request_timeout=_env_float("TCM_REQUEST_TIMEOUT", 90.0),
+            hedge=os.getenv("TCM_HEDGE", "off").strip().lower() in ("1", "on", "true"),
+            hedge_percentile=_env_float("TCM_HEDGE_PERCENTILE", 0.95),
+            hedge_min_samples=int(_env_float("TCM_HEDGE_MIN_SAMPLES", 20)),
+        )
+
+    def stream_timeout(self):
+        """流式请求的httpx超时：读超时即流中断超时"""
+        return httpx.Timeout(self.stall_timeout, connect=self.connect_timeout)
+
+    def request_timeout_config(self):
+        """非流式请求的httpx超时"""
+        return httpx.Timeout(self.request_timeout, connect=self.connect_timeout)
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        第 attempt 次失败后的等待时间（秒），服务端给出 Retry-After 时等满该时间
+
+        返回:
+            等待秒数；Retry-After 超过 backoff_max 时返回None，调用方不再重试
+            （提前重试只会再次被拒绝）
+        """
+        if retry_after is not None:
+            return retry_after if retry_after <= self.backoff_max else None
+        delay = min(self.backoff_base * (2 ** (attempt - 1)), self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+
+class LatencyTracker:
+    """记录最近的首token耗时，用于计算对冲阈值（线程安全）"""
+
+    def __init__(self, window=200):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q, min_samples=1):
+        """返回第q分位（0-1）的耗时，样本不足时返回None"""
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(int(q * len(ordered)), len(ordered) - 1)
+        return ordered[index]
+
+
+_default_tracker = LatencyTracker()
+
+
+def _delta_text(chunk):
+    """提取流式chunk中的文本，没有文本时返回None"""
+    if not chunk.choices:
+        return None
+    return chunk.choices[0].delta.content
+
+
+# ==================== 非流式调用 ====================
+
+def call_with_retry(call, policy):
+    """
+    带退避重试地执行一次非流式调用
+
+    参数:
+        call: 无参函数，发起一次上游请求
+        policy: RetryPolicy
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return call()
+        except Exception as e:
+            error = translate_error(e)
+            delay = policy.backoff(attempt, error.retry_after)
+            if not error.retryable or attempt >= policy.max_attempts or delay is None:
+                raise error from e
+            time.sleep(delay)
+
+
+async def acall_with_retry(call, policy):
+    """call_with_retry 的异步版本，call 返回协程"""
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return await call()
+        except Exception as e:
+            error = translate_error(e)
+            delay = policy.backoff(attempt, error.retry_after)
+            if not error.retryable or attempt >= policy.max_attempts or delay is None:
+                raise error from e
+            await asyncio.sleep(delay)
+
+
+# ==================== 流式调用（同步） ====================
+
+class _StreamAttempt:
+    """在后台线程中运行的一次流式请求，数据写入共享队列"""
+
+    def __init__(self, attempt_id, open_stream, events):
+        self.id = attempt_id
+        self.started = time.monotonic()
+        self._open_stream = open_stream
+        self._events = events
+        self._stream = None
+        self._abort_error = None
+        self._cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            stream = self._open_stream()
+            self._stream = stream
+            if self._cancelled.is_set():
+                _close_attempt_stream(stream, self._abort_error)
+                return
+            for chunk in stream:
+                if self._cancelled.is_set():
+                    break
+                self._events.put((self.id, "chunk", chunk))
+            else:
+                self._events.put((self.id, "done", None))
+        except Exception as e:
+            if not self._cancelled.is_set():
+                self._events.put((self.id, "error", e))
+
+    def cancel(self, error=None):
+        """
+        取消请求并尽快关闭上游连接
+
+        参数:
+            error: 因超时放弃时的原因；对冲失败方和调用方取消时为None
+        """
+        self._abort_error = error
+        self._cancelled.set()
+        stream = self._stream
+        if stream is not None:
+            try:
+                _close_attempt_stream(stream, error)
+            except Exception:
+                pass
+
+
+def _close_attempt_stream(stream, error):
+    """关闭一次请求的流；因超时放弃时优先调用流的 abort(error)（如路由器据此把超时记为后端失败）"""
+    abort = getattr(stream, "abort", None) if error is not None else None
+    if abort is not None:
+        abort(error)
+    else:
+        stream.close()
+
+
+def resilient_stream(open_stream, policy, tracker=None, on_chunk=None, cancel=None):
+    """
+    带超时、重试与对冲的流式文本生成器
+
+    参数:
+        open_stream: 无参函数，发起一次流式请求并返回openai的Stream对象
+        policy: RetryPolicy
+        tracker: 首token耗时统计，默认使用进程级共享实例
+        on_chunk: 可选回调，接收最终采用的请求的每个原始chunk（如usage统计）
+        cancel: 可选的 cancellation.Cancellation。生成器在其他线程中读取时，调用方无法直接关闭它，
+                触发该信号后生成器立即关闭HTTP响应并抛出 cancellation.StreamCancelled
+
+    返回:
+        生成器，逐步返回文本
+    """
+    tracker = tracker or _default_tracker
+    events = queue.Queue()
+    attempts = {}
+    failures = 0
+    next_id = 0
+    winner = None
+
+    def start():
+        nonlocal next_id
+        next_id += 1
+        attempts[next_id] = _StreamAttempt(next_id, open_stream, events)
+
+    def cancel_all(keep=None, error=None):
+        for attempt_id, attempt in list(attempts.items()):
+            if attempt_id != keep:
+                attempt.cancel(error)
+                del attempts[attempt_id]
+
+    def wake():
+        # 取消信号写入事件队列，正在等待数据的生成器立即醒来
+        events.put((None, "cancel", None))
+
+    if cancel is not None:
+        if cancel.is_set():
+            raise cancellation.StreamCancelled()
+        cancel.add_callback(wake)
+
+    try:
+        start()
+        while True:
+            now = time.monotonic()
+            if winner is None:
+                oldest = min(a.started for a in attempts.values())
+                wait = oldest + policy.first_token_timeout - now
+                hedge_after = None
+                if policy.hedge and len(attempts) == 1:
+                    hedge_after = tracker.percentile(policy.hedge_percentile, policy.hedge_min_samples)
+                if hedge_after is not None:
+                    wait = min(wait, oldest + hedge_after - now)
+            else:
+                wait = policy.stall_timeout
+
+            try:
+                attempt_id, kind, payload = events.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if winner is not None:
+                    error = LLMTimeoutError(f"流式输出超过{policy.stall_timeout:g}秒没有新数据")
+                    cancel_all(error=error)
+                    raise error
+                now = time.monotonic()
+                oldest = min(a.started for a in attempts.values())
+                if now - oldest < policy.first_token_timeout:
+                    # 首token等待超过分位数阈值，发起对冲请求
+                    start()
+                    continue
+                error = LLMTimeoutError(f"等待首个token超过{policy.first_token_timeout:g}秒")
+                cancel_all(error=error)
+                failures += 1
+                if failures >= policy.max_attempts:
+                    raise error
+                time.sleep(policy.backoff(failures))
+                start()
+                continue
+
+            if kind == "cancel":
+                raise cancellation.StreamCancelled()
+            # 已被取消的请求遗留的事件
+            if attempt_id not in attempts:
+                continue
+
+            if kind == "chunk":
+                if on_chunk is not None and winner == attempt_id:
+                    on_chunk(payload)
+                text = _delta_text(payload)
+                if text is None:
+                    continue
+                if winner is None:
+                    winner = attempt_id
+                    tracker.record(time.monotonic() - attempts[attempt_id].started)
+                    cancel_all(keep=winner)
+                    if on_chunk is not None:
+                        on_chunk(payload)
+                yield text
+            elif kind == "done":
+                if winner is None and len(attempts) > 1:
+                    # 对冲请求中一个已结束但没有输出文本，以另一个为准
+                    del attempts[attempt_id]
+                    continue
+                return
+            else:
+                error = translate_error(payload)
+                del attempts[attempt_id]
+                if winner is not None:
+                    raise error from payload
+                if attempts:
+                    # 对冲中的另一个请求仍在进行
+                    continue
+                failures += 1
+                delay = policy.backoff(failures, error.retry_after)
+                if not error.retryable or failures >= policy.max_attempts or delay is None:
+                    raise error from payload
+                time.sleep(delay)
+                start()
+    finally:
+        if cancel is not None:
+            cancel.remove_callback(wake)
+        cancel_all()
+
+
+# ==================== 流式调用（异步） ====================
+
+async def aresilient_stream(open_stream, policy, tracker=None, on_chunk=None):
+    """
+    resilient_stream 的异步版本
+
+    参数:
+        open_stream: 无参协程函数，返回openai的AsyncStream对象
+    """
+    tracker = tracker or _default_tracker
+    events = asyncio.Queue()
+    tasks = {}
+    started = {}
+    streams = {}
+    failures = 0
+    next_id = 0
+    winner = None
+
+    async def run(attempt_id):
+        try:
+            stream = await open_stream()
+            streams[attempt_id] = stream
+            async for chunk in stream:
+                await events.put((attempt_id, "chunk", chunk))
+            await events.put((attempt_id, "done", None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await events.put((attempt_id, "error", e))
+
+    def start():
+        nonlocal next_id
+        next_id += 1
+        started[next_id] = time.monotonic()
+        tasks[next_id] = asyncio.ensure_future(run(next_id))
+
+    async def cancel_all(keep=None, error=None):
+        for attempt_id in list(tasks):
+            if attempt_id == keep:
+                continue
+            tasks.pop(attempt_id).cancel()
+            started.pop(attempt_id, None)
+            stream = streams.pop(attempt_id, None)
+            if stream is not None:
+                abort = getattr(stream, "abort", None) if error is not None else None
+                try:
+                    if abort is not None:
+                        await abort(error)
+                    else:
+                        await stream.close()
+                except Exception:
+                    pass
+
+    try:
+        start()
+        while True:
+            now = time.monotonic()
+            if winner is None:
+                oldest = min(started.values())
+                wait = oldest + policy.first_token_timeout - now
+                hedge_after = None
+                if policy.hedge and len(tasks) == 1:
+                    hedge_after = tracker.percentile(policy.hedge_percentile, policy.hedge_min_samples)
+                if hedge_after is not None:
+                    wait = min(wait, oldest + hedge_after - now)
+            else:
+                wait = policy.stall_timeout
+
+            try:
+                attempt_id, kind, payload = await asyncio.wait_for(events.get(), max(wait, 0))
+            except asyncio.TimeoutError:
+                if winner is not None:
+                    error = LLMTimeoutError(f"流式输出超过{policy.stall_timeout:g}秒没有新数据")
+                    await cancel_all(error=error)
+                    raise error
+                now = time.monotonic()
+                if now - min(started.values()) < policy.first_token_timeout:
+                    start()
+                    continue
+                error = LLMTimeoutError(f"等待首个token超过{policy.first_token_timeout:g}秒")
+                await cancel_all(error=error)
+                failures += 1
+                if failures >= policy.max_attempts:
+                    raise error
+                await asyncio.sleep(policy.backoff(failures))
+                start()
+                continue
+
+            if attempt_id not in tasks:
+                continue
+
+            if kind == "chunk":
+                if on_chunk is not None and winner == attempt_id:
+                    on_chunk(payload)
+                text = _delta_text(payload)
+                if text is None:
+                    continue
+                if winner is None:
+                    winner = attempt_id
+                    tracker.record(time.monotonic() - started[attempt_id])
+                    await cancel_all(keep=winner)
+                    if on_chunk is not None:
+                        on_chunk(payload)
+                yield text
+            elif kind == "done":
+                if winner is None and len(tasks) > 1:
+                    tasks.pop(attempt_id)
+                    started.pop(attempt_id, None)
+                    continue
+                return
+            else:
+                error = translate_error(payload)
+                tasks.pop(attempt_id)
+                started.pop(attempt_id, None)
+                if winner is not None:
+                    raise error from payload
+                if tasks:
+                    continue
+                failures += 1
+                delay = policy.backoff(failures, error.retry_after)
+                if not error.retryable or failures >= policy.max_attempts or delay is None:
+                    raise error from payload
+                await asyncio.sleep(delay)
+                start()
+    finally:
+        await cancel_all()
@@ -0,0 +1,265 @@
+"""
+回复缓存
+
+快速选择症状与首轮提问高度重复，相同的 (模型, 系统提示词, 对话历史, 年龄段, 性别)
+直接复用已生成的回复，跳过一次API调用。支持TTL过期与LRU淘汰，
+后端可选内存（默认）、本地SQLite文件，或多个副本共享的 shared_state。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 24 * 3600
+DEFAULT_MAX_ENTRIES = 1000
+
+# 年龄段划分（上界, 标签），与养生建议常见的人群划分一致
+AGE_BUCKETS = [
+    (6, "0-6岁"),
+    (17, "7-17岁"),
+    (29, "18-29岁"),
+    (44, "30-44岁"),
+    (59, "45-59岁"),
+    (74, "60-74岁"),
+]
+
+
+def age_bucket(age):
+    """把具体年龄归入年龄段，未提供时返回"未提供\""""
+    if age is None or age == "未提供":
+        return "未提供"
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        return str(age)
+    for upper, label in AGE_BUCKETS:
+        if age <= upper:
+            return label
+    return "75岁以上"
+
+
+def _normalize_text(text):
+    """去掉首尾空白并合并连续空白，避免无意义的差异导致未命中"""
+    return " ".join(text.split())
+
+
+def make_key(model, system_prompt, messages, age, gender):
+    """
+    生成缓存键
+
+    参数:
+        model: 模型名称（分析器传入 ModelRouter.model_key，即该类型请求可能使用的所有模型）
+        system_prompt: 系统提示词模板或其指纹，只参与哈希
+        messages: 对话历史 [{"role": ..., "content": ...}]
+        age: 年龄（会被归入年龄段）
+        gender: 性别
+
+    返回:
+        十六进制字符串
+    """
+    payload = {
+        "model": model,
+        "system": hashlib.sha256(system_prompt.encode("utf-8")).hexdigest(),
+        "history": [[m["role"], _normalize_text(m["content"])] for m in messages],
+        "age": age_bucket(age),
+        "gender": gender,
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """进程内LRU缓存后端"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteBackend:
+    """本地SQLite缓存后端，可在多个进程间共享，重启后仍然有效"""
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_response_cache_access ON response_cache(last_access)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute(
+                "UPDATE response_cache SET last_access = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            return value
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl, now),
+            )
+            # 先清理过期条目，再按最近访问时间淘汰超出上限的条目
+            self._conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (now,))
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                "SELECT key FROM response_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache")
+            self._conn.commit()
+
+
+class SharedBackend:
+    """
+    跨副本共享的缓存后端（shared_state）：本地LRU作为一级缓存，未命中时读一次共享后端；
+    写入只记入共享状态的待写缓冲，由后台线程批量写入，不增加回复结束时的延迟。
+    共享后端中的条目按TTL过期，条目数上限只作用于本地一级缓存
+    """
+
+    KEY_PREFIX = "cache:"
+
+    def __init__(self, state, max_entries=DEFAULT_MAX_ENTRIES):
+        self.state = state
+        self.local = MemoryBackend(max_entries)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        stored = self.state.get(self.KEY_PREFIX + key)
+        if stored is None:
+            return None
+        # 共享后端中的值带有过期时间，本地一级缓存沿用剩余的TTL
+        expires_at, _, value = stored.partition("|")
+        remaining = float(expires_at) - time.time()
+        if remaining <= 0:
+            return None
+        self.local.set(key, value, remaining)
+        return value
+
+    def set(self, key, value, ttl):
+        self.local.set(key, value, ttl)
+        self.state.set(self.KEY_PREFIX + key, f"{time.time() + ttl:.3f}|{value}", ttl)
+
+    def clear(self):
+        """只清空本地一级缓存，共享后端中的条目到期后自然失效"""
+        self.local.clear()
+
+
+class ResponseCache:
+    """带命中统计的回复缓存"""
+
+    def __init__(self, backend=None, ttl=DEFAULT_TTL):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if value:
+            self.backend.set(key, value, self.ttl)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+def replay(text, chunk_size=20):
+    """把缓存的完整回复重新切成文本块，与流式接口保持一致"""
+    for start in range(0, len(text), chunk_size):
+        yield text[start:start + chunk_size]
+
+
+def cache_from_env():
+    """
+    根据环境变量创建缓存
+
+    TCM_CACHE_BACKEND: memory（默认）/ sqlite / shared（需要同时设置 TCM_STATE_BACKEND）/ off
+    TCM_CACHE_PATH: SQLite文件路径，默认 response_cache.sqlite3
+    TCM_CACHE_TTL: 过期时间（秒）
+    TCM_CACHE_MAX_ENTRIES: 最大条目数
+    """
+    backend_name = os.getenv("TCM_CACHE_BACKEND", "memory").strip().lower()
+    if backend_name in ("off", "none", "0", "false"):
+        return None
+
+    max_entries = int(os.getenv("TCM_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+    ttl = float(os.getenv("TCM_CACHE_TTL", DEFAULT_TTL))
+
+    state = None
+    if backend_name == "shared":
+        import shared_state
+        state = shared_state.get_state()
+
+    if backend_name == "sqlite":
+        backend = SQLiteBackend(os.getenv("TCM_CACHE_PATH", "response_cache.sqlite3"), max_entries)
+    elif state is not None:
+        backend = SharedBackend(state, max_entries)
+    else:
+        backend = MemoryBackend(max_entries)
+
+    return ResponseCache(backend, ttl)
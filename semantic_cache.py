@@ -0,0 +1,262 @@
+"""
+语义近似回复缓存
+
+精确缓存无法命中同一症状的不同说法（如"最近总是失眠"与"晚上睡不着觉，多梦"）。
+本模块把首轮提问规范化后做字符n-gram哈希向量化，存入NumPy矩阵，
+按余弦相似度检索；相似度超过阈值且用户信息分组相同时直接复用已生成的回复。
+
+改变建议适用人群或紧急程度的限定词（孕期、经期、发热、婴幼儿、儿童、老人、危险信号）不参与相似度，
+必须完全一致才能复用："孕妇失眠怎么办"不会命中"失眠怎么办"的回复。
+提问按标点和连接词拆成分句，只要有一个分句的症状不在缓存条目的提问中（同组相关症状除外），
+就视为新增了症状，不复用："头痛头晕、视物模糊"不会命中"头痛头晕"的回复。
+阈值用 benchmarks/semantic_cases.py 中的同义/不同义提问对校准。
+
+环境变量:
+    TCM_SEMANTIC_CACHE: on 启用（默认关闭）
+    TCM_SEMANTIC_THRESHOLD: 相似度阈值，默认0.55
+    TCM_SEMANTIC_MAX_ENTRIES: 最多保存的条目数，默认2000
+"""
+import os
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+import metrics
+import triage
+
+DEFAULT_THRESHOLD = 0.55
+DEFAULT_MAX_ENTRIES = 2000
+DEFAULT_DIM = 1024
+
+# 常见症状的口语说法归一为同一个词，提高字符n-gram的召回
+# （较长的说法排在前面，避免被较短的说法先替换掉一部分）
+SYNONYMS = [
+    (("睡不着觉", "睡不着", "睡不好", "入睡困难", "难以入睡", "失眠症"), "失眠"),
+    (("做梦多", "老做梦", "梦多"), "多梦"),
+    (("没精神", "没力气", "提不起劲", "很累", "容易累", "疲惫", "疲倦"), "乏力"),
+    (("肚子胀气", "胃胀气", "肚子胀", "胃胀", "胀气"), "腹胀"),
+    (("头疼",), "头痛"),
+    (("头昏", "眩晕"), "头晕"),
+    (("心烦", "烦躁", "焦躁"), "焦虑"),
+    (("腰疼", "腰痛"), "腰酸"),
+    (("关节疼",), "关节痛"),
+    (("吃不下饭", "吃不下", "没胃口", "食欲差"), "食欲不振"),
+    (("怀孕后", "怀孕期间", "怀孕", "孕妇"), "孕期"),
+]
+
+# 不影响语义的口语修饰词和提问方式
+FILLERS = ("最近", "总是", "老是", "经常", "一直", "有点", "有些", "比较", "感觉", "觉得", "晚上", "夜里",
+           "怎么办", "怎么调理", "如何调理", "该怎么", "请问", "我", "总", "了", "的")
+
+# 限定词：出现任何一组时，只能复用限定词完全相同的提问的回复（按组比较，组内说法视为相同）
+QUALIFIERS = (
+    ("pregnancy", ("孕", "哺乳", "产后", "月子")),
+    ("menstrual", ("经期", "月经", "例假", "痛经")),
+    ("fever", ("发烧", "发热", "高烧", "低烧")),
+    ("infant", ("婴儿", "婴幼儿", "宝宝", "新生儿", "幼儿")),
+    ("child", ("孩子", "小孩", "儿童", "儿子", "女儿", "青少年")),
+    ("elderly", ("老人", "老年", "爷爷", "奶奶", "外公", "外婆")),
+)
+
+# 相关症状组：缓存提问包含组内任一症状时，新提问中同组的其它症状不算新增症状
+RELATED_SYMPTOMS = (
+    ("失眠", "多梦", "早醒", "易醒"),
+)
+
+_PUNCTUATION = re.compile(r"[\s，。、！？；：,.!?;:~～…“”\"'（）()\[\]【】]+")
+
+
+def normalize(text):
+    """规范化提问文本：归一同义说法、去掉修饰词和标点"""
+    text = text.lower()
+    for variants, canonical in SYNONYMS:
+        for variant in variants:
+            text = text.replace(variant, canonical)
+    for filler in FILLERS:
+        text = text.replace(filler, "")
+    return _PUNCTUATION.sub("", text)
+
+
+_CLAUSE_BREAKS = re.compile(r"[\s，。、！？；：,.!?;:~～…“”\"'（）()\[\]【】]+|伴有|伴随|还有|并且|而且|以及|同时")
+
+
+def clauses(text):
+    """把提问按标点和连接词拆成分句，返回规范化后的非空分句列表"""
+    parts = (normalize(part) for part in _CLAUSE_BREAKS.split(text.lower()))
+    return [part for part in parts if part]
+
+
+def adds_symptoms(query_clauses, cached_text):
+    """
+    判断新提问是否包含缓存提问中没有的症状
+
+    参数:
+        query_clauses: clauses() 返回的新提问分句
+        cached_text: 缓存条目规范化后的提问
+
+    返回:
+        有分句不被缓存提问覆盖时返回True
+    """
+    for clause in query_clauses:
+        for group in RELATED_SYMPTOMS:
+            if any(term in cached_text for term in group):
+                for term in group:
+                    clause = clause.replace(term, "")
+        if clause and clause not in cached_text:
+            return True
+    return False
+
+
+def qualifiers(text):
+    """
+    提取提问中的限定词组
+
+    返回:
+        frozenset，包含限定词组名和危险信号类别（"red_flag:<类别>"）
+    """
+    text = text.lower()
+    found = {name for name, terms in QUALIFIERS if any(term in text for term in terms)}
+    found.update("red_flag:" + flag.key for flag in triage.RED_FLAGS if any(term in text for term in flag.terms))
+    return frozenset(found)
+
+
+class NGramEmbedder:
+    """字符n-gram哈希向量化（纯本地，无需模型文件）"""
+
+    def __init__(self, dim=DEFAULT_DIM, ngram_range=(1, 2)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    def embed(self, text):
+        """返回L2归一化的float32向量"""
+        vector = np.zeros(self.dim, dtype=np.float32)
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            # 越长的n-gram越能区分语义，权重越高
+            weight = float(n)
+            for i in range(len(text) - n + 1):
+                vector[zlib.crc32(text[i:i + n].encode("utf-8")) % self.dim] += weight
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+class SemanticCache:
+    """基于余弦相似度的近似回复缓存，容量满时淘汰最久未命中的条目"""
+
+    def __init__(self, embedder=None, threshold=DEFAULT_THRESHOLD, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        参数:
+            embedder: 向量化器（需提供 dim 属性和 embed(text) 方法），默认 NGramEmbedder
+            threshold: 命中所需的最低余弦相似度
+            max_entries: 最多保存的条目数
+        """
+        self.embedder = embedder or NGramEmbedder()
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((max_entries, self.embedder.dim), dtype=np.float32)
+        self._profiles = np.full(max_entries, -1, dtype=np.int64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._values = [None] * max_entries
+        self._texts = [None] * max_entries
+        self._profile_ids = {}
+        self._slots = {}
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _profile_id(self, profile):
+        if profile not in self._profile_ids:
+            self._profile_ids[profile] = len(self._profile_ids)
+        return self._profile_ids[profile]
+
+    def lookup(self, text, profile):
+        """
+        查找相似提问的回复
+
+        参数:
+            text: 首轮用户提问
+            profile: 用户信息分组键（模型、提示词版本、年龄段、性别）
+
+        返回:
+            (回复文本, 相似度)，未命中时回复为None
+        """
+        started = time.perf_counter()
+        query = self.embedder.embed(normalize(text))
+        query_clauses = clauses(text)
+        # 限定词并入分组键，只在限定词完全相同的条目中比较相似度
+        group = (profile, qualifiers(text))
+        with self._lock:
+            profile_id = self._profile_ids.get(group)
+            value = None
+            score = 0.0
+            if profile_id is not None and self._size:
+                scores = self._vectors[:self._size] @ query
+                scores[self._profiles[:self._size] != profile_id] = -1.0
+                score = float(scores.max())
+                # 从相似度最高的候选开始，跳过新提问比它多出症状的条目
+                candidates = np.flatnonzero(scores >= self.threshold)
+                for slot in candidates[np.argsort(-scores[candidates])]:
+                    if not adds_symptoms(query_clauses, self._texts[slot]):
+                        value = self._values[slot]
+                        score = float(scores[slot])
+                        self._last_used[slot] = time.monotonic()
+                        break
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        metrics.SEMANTIC_LOOKUP.observe(time.perf_counter() - started)
+        metrics.SEMANTIC_REQUESTS.inc(result="hit" if value is not None else "miss")
+        return value, score
+
+    def add(self, text, profile, value):
+        """保存一条回复"""
+        if not value:
+            return
+        normalized = normalize(text)
+        vector = self.embedder.embed(normalized)
+        with self._lock:
+            profile_id = self._profile_id((profile, qualifiers(text)))
+            key = (profile_id, normalized)
+            # 同一分组下完全相同的提问直接覆盖
+            slot = self._slots.get(key)
+            if slot is None:
+                if self._size < self.max_entries:
+                    slot = self._size
+                    self._size += 1
+                else:
+                    slot = int(np.argmin(self._last_used))
+                    del self._slots[(int(self._profiles[slot]), self._texts[slot])]
+                self._slots[key] = slot
+            self._vectors[slot] = vector
+            self._profiles[slot] = profile_id
+            self._last_used[slot] = time.monotonic()
+            self._values[slot] = value
+            self._texts[slot] = normalized
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": self._size,
+            }
+
+
+def semantic_cache_from_env():
+    """根据环境变量创建语义缓存，未启用时返回None"""
+    if os.getenv("TCM_SEMANTIC_CACHE", "off").strip().lower() not in ("1", "on", "true"):
+        return None
+    return SemanticCache(
+        threshold=float(os.getenv("TCM_SEMANTIC_THRESHOLD", DEFAULT_THRESHOLD)),
+        max_entries=int(os.getenv("TCM_SEMANTIC_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+    )
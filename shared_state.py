@@ -0,0 +1,612 @@
+"""
+跨副本共享状态
+
+多个Streamlit副本部署在负载均衡之后时，进程内的回复缓存、限流令牌桶和用量统计各自独立：
+缓存要在每个副本上分别预热，全局限流实际放行副本数倍的请求，用量分散在各副本且重新部署后丢失。
+共享状态把这三类数据放到所有副本都能访问的后端：
+    - 回复缓存条目：response_cache.SharedBackend（TCM_CACHE_BACKEND=shared），
+      本地LRU作为一级缓存，未命中时读一次共享后端
+    - 令牌桶计数：SharedTokenBucket（准入控制的全局令牌桶），放行判断仍在本地完成，
+      各副本把自己消耗的令牌数累加到共享计数器，并从本地桶中扣除其他副本消耗的部分
+    - 用量累计：每次LLM调用结束后按模型累加请求数和token数（python -m shared_state usage 查看）
+
+写入不在请求路径上执行：set / incr 只记入本进程的待写缓冲（同一个键的多次写入合并），
+后台线程每隔 TCM_STATE_FLUSH_MS 毫秒把缓冲一次写入后端（SQLite一个事务、Redis一次流水线往返）。
+后端不可用时读取按未命中处理、计数增量保留到下一次写入，不影响回复。
+
+后端:
+    memory  进程内（同一进程中的多个分析器共享，也便于测试）
+    sqlite  本地SQLite文件（WAL模式），同一台机器上的多个进程共享
+    redis   Redis协议（RESP2）服务，多台机器共享；内置最小客户端，不依赖redis包，
+            本地可以用 python -m benchmarks.resp_server 代替
+
+用法:
+    python -m shared_state usage        # 查看各模型的累计用量
+
+环境变量:
+    TCM_STATE_BACKEND: off（默认）/ memory / sqlite / redis
+    TCM_STATE_PATH: SQLite文件路径，默认 shared_state.sqlite3
+    TCM_STATE_URL: Redis地址，默认 redis://127.0.0.1:6379/0（支持 redis://:密码@主机:端口/库）
+    TCM_STATE_PREFIX: 键前缀，默认 tcm:（多个部署共用一个Redis时用于区分）
+    TCM_STATE_FLUSH_MS: 批量写入间隔（毫秒），默认200
+    TCM_STATE_TIMEOUT: 单次访问后端的超时（秒），默认0.5
+"""
+import atexit
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import metrics
+from rate_limit import TokenBucket
+
+DEFAULT_PATH = "shared_state.sqlite3"
+DEFAULT_URL = "redis://127.0.0.1:6379/0"
+DEFAULT_PREFIX = "tcm:"
+DEFAULT_FLUSH_MS = 200
+DEFAULT_TIMEOUT = 0.5
+
+# 过期缓存条目的清理间隔（秒），Redis由服务端按PX过期
+SWEEP_INTERVAL = 60.0
+# 连接Redis失败后多久再重试（秒），期间的读取直接按未命中处理，不必每次都等待连接超时
+RECONNECT_INTERVAL = 1.0
+
+USAGE_KEY = "usage"
+USAGE_FIELDS = ("requests", "cache_hits", "errors", "prompt_tokens", "completion_tokens")
+
+
+class StateError(Exception):
+    """共享状态后端返回了错误"""
+
+
+# ==================== 后端 ====================
+#
+# 后端只需实现四个方法：
+#     get(key)                       -> 字符串，不存在或已过期时返回None
+#     apply(sets, incrs, hincrs)     -> 一次写入一批更新，返回 {计数器键: 更新后的累计值}
+#         sets:   {键: (值, 过期秒数)}
+#         incrs:  {计数器键: 增量}
+#         hincrs: {哈希键: {字段: 增量}}
+#     hgetall(key)                   -> {字段: 数值}
+#     close()
+
+class MemoryState:
+    """进程内后端"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}     # 键 -> (值, 过期时间)
+        self._counters = {}
+        self._hashes = {}
+        self._next_sweep = time.time() + SWEEP_INTERVAL
+
+    def get(self, key):
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def apply(self, sets, incrs, hincrs):
+        now = time.time()
+        with self._lock:
+            for key, (value, ttl) in sets.items():
+                self._values[key] = (value, now + ttl)
+            totals = {}
+            for key, delta in incrs.items():
+                totals[key] = self._counters[key] = self._counters.get(key, 0.0) + delta
+            for key, fields in hincrs.items():
+                target = self._hashes.setdefault(key, {})
+                for field, delta in fields.items():
+                    target[field] = target.get(field, 0.0) + delta
+            if now >= self._next_sweep:
+                self._values = {k: item for k, item in self._values.items() if item[1] >= now}
+                self._next_sweep = now + SWEEP_INTERVAL
+        return totals
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._hashes.get(key, {}))
+
+    def close(self):
+        pass
+
+
+class SQLiteState:
+    """
+    本地SQLite后端（WAL模式）：读取不会被其他进程的写入阻塞，
+    读和写各用一个连接，请求线程的读取也不必等待本进程的批量写入
+    """
+
+    def __init__(self, path=DEFAULT_PATH, timeout=DEFAULT_TIMEOUT):
+        self.path = path
+        self._read_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writer = self._connect(timeout)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        self._writer.execute(
+            "CREATE TABLE IF NOT EXISTS shared_values ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        # 普通计数器的 field 为空字符串
+        self._writer.execute(
+            "CREATE TABLE IF NOT EXISTS shared_counters ("
+            "key TEXT NOT NULL, field TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY (key, field))"
+        )
+        self._reader = self._connect(timeout)
+        self._next_sweep = 0.0
+
+    def _connect(self, timeout):
+        # isolation_level=None：由 apply() 显式控制事务
+        return sqlite3.connect(self.path, timeout=timeout, check_same_thread=False, isolation_level=None)
+
+    def get(self, key):
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT value, expires_at FROM shared_values WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def apply(self, sets, incrs, hincrs):
+        now = time.time()
+        counter_rows = [(key, "", delta) for key, delta in incrs.items()]
+        counter_rows += [(key, field, delta) for key, fields in hincrs.items() for field, delta in fields.items()]
+        with self._write_lock:
+            conn = self._writer
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO shared_values (key, value, expires_at) VALUES (?, ?, ?)",
+                    [(key, value, now + ttl) for key, (value, ttl) in sets.items()],
+                )
+                conn.executemany(
+                    "INSERT INTO shared_counters (key, field, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (key, field) DO UPDATE SET value = value + excluded.value",
+                    counter_rows,
+                )
+                totals = {
+                    key: conn.execute(
+                        "SELECT value FROM shared_counters WHERE key = ? AND field = ''", (key,)
+                    ).fetchone()[0]
+                    for key in incrs
+                }
+                if now >= self._next_sweep:
+                    conn.execute("DELETE FROM shared_values WHERE expires_at < ?", (now,))
+                    self._next_sweep = now + SWEEP_INTERVAL
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return totals
+
+    def hgetall(self, key):
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT field, value FROM shared_counters WHERE key = ?", (key,)
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._read_lock:
+            self._reader.close()
+        with self._write_lock:
+            self._writer.close()
+
+
+def _encode_command(args):
+    """把一条命令编码为RESP数组"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def _read_reply(f):
+    """读取一个RESP应答；错误应答以 StateError 对象返回，以便流水线继续读取后面的应答"""
+    line = f.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("共享状态服务关闭了连接")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode("utf-8")
+    if kind == b"-":
+        return StateError(rest.decode("utf-8", "replace"))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = f.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("共享状态服务关闭了连接")
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        return None if length < 0 else [_read_reply(f) for _ in range(length)]
+    raise StateError(f"无法解析的应答: {line[:80]!r}")
+
+
+class _RedisConnection:
+    """一个RESP连接（线程安全，按需连接，出错后丢弃连接，下次使用时重连）"""
+
+    def __init__(self, host, port, password, db, timeout):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._file = None
+        self._retry_at = 0.0
+
+    def _open(self):
+        if time.monotonic() < self._retry_at:
+            raise ConnectionError("共享状态服务暂时不可用")
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError:
+            self._retry_at = time.monotonic() + RECONNECT_INTERVAL
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = sock
+        self._file = sock.makefile("rb")
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            self._roundtrip(setup)
+
+    def _roundtrip(self, commands):
+        self._sock.sendall(b"".join(_encode_command(command) for command in commands))
+        replies = [_read_reply(self._file) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, StateError):
+                raise reply
+        return replies
+
+    def pipeline(self, commands):
+        """一次发送全部命令再依次读取应答（一次网络往返）"""
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._open()
+                return self._roundtrip(commands)
+            except (OSError, StateError):
+                # 流水线中途出错后连接上可能还有未读的应答，直接丢弃连接
+                self._discard()
+                raise
+
+    def _discard(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+        self._sock = None
+        self._file = None
+
+    def close(self):
+        with self._lock:
+            self._discard()
+
+
+class RedisState:
+    """
+    Redis协议后端：读和写各用一个连接，批量写入时全部命令走一次流水线；
+    缓存条目用 SET PX 由服务端过期，计数器用 INCRBYFLOAT / HINCRBYFLOAT 原子累加
+    """
+
+    def __init__(self, url=DEFAULT_URL, timeout=DEFAULT_TIMEOUT):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("redis", ""):
+            raise ValueError(f"不支持的共享状态地址: {url}")
+        args = (parsed.hostname or "127.0.0.1", parsed.port or 6379,
+                urllib.parse.unquote(parsed.password) if parsed.password else None,
+                int(parsed.path.lstrip("/") or 0), timeout)
+        self.url = url
+        self._reader = _RedisConnection(*args)
+        self._writer = _RedisConnection(*args)
+
+    def get(self, key):
+        value = self._reader.pipeline([("GET", key)])[0]
+        return None if value is None else value.decode("utf-8")
+
+    def apply(self, sets, incrs, hincrs):
+        commands = [("SET", key, value, "PX", max(int(ttl * 1000), 1)) for key, (value, ttl) in sets.items()]
+        commands += [("INCRBYFLOAT", key, repr(float(delta))) for key, delta in incrs.items()]
+        commands += [("HINCRBYFLOAT", key, field, repr(float(delta)))
+                     for key, fields in hincrs.items() for field, delta in fields.items()]
+        replies = self._writer.pipeline(commands)
+        return {key: float(reply) for key, reply in zip(incrs, replies[len(sets):])}
+
+    def hgetall(self, key):
+        reply = self._reader.pipeline([("HGETALL", key)])[0] or []
+        return {reply[i].decode("utf-8"): float(reply[i + 1]) for i in range(0, len(reply), 2)}
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+# ==================== 批量写入 ====================
+
+class SharedState:
+    """共享状态：读取直接访问后端，写入记入待写缓冲，由后台线程定期批量写入"""
+
+    def __init__(self, backend, prefix=DEFAULT_PREFIX, flush_interval=DEFAULT_FLUSH_MS / 1000):
+        """
+        参数:
+            backend: MemoryState / SQLiteState / RedisState
+            prefix: 键前缀
+            flush_interval: 批量写入间隔（秒）
+        """
+        self.backend = backend
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._sets = {}
+        self._incrs = {}
+        self._hincrs = {}
+        self._watchers = {}   # 计数器键 -> [回调]
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="shared-state-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ---------- 读取 ----------
+
+    def get(self, key):
+        """读取字符串值；后端出错时按未命中处理"""
+        key = self.prefix + key
+        with self._lock:
+            pending = self._sets.get(key)
+        if pending is not None:
+            return pending[0]
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            metrics.SHARED_STATE.inc(op="get", outcome="error")
+            return None
+        metrics.SHARED_STATE.inc(op="get", outcome="miss" if value is None else "hit")
+        return value
+
+    def hgetall(self, key):
+        """读取哈希计数器（包括本进程尚未写入的增量）"""
+        key = self.prefix + key
+        totals = self.backend.hgetall(key)
+        with self._lock:
+            for field, delta in self._hincrs.get(key, {}).items():
+                totals[field] = totals.get(field, 0.0) + delta
+        return totals
+
+    # ---------- 写入（只记入缓冲） ----------
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._sets[self.prefix + key] = (value, ttl)
+
+    def incr(self, key, amount=1):
+        key = self.prefix + key
+        with self._lock:
+            self._incrs[key] = self._incrs.get(key, 0.0) + amount
+
+    def hincr(self, key, field, amount=1):
+        key = self.prefix + key
+        with self._lock:
+            fields = self._hincrs.setdefault(key, {})
+            fields[field] = fields.get(field, 0.0) + amount
+
+    def watch(self, key, callback):
+        """
+        每次批量写入后调用 callback(total, own)：total 为计数器的最新累计值，
+        own 为其中本进程这一批写入的增量（没有增量时也会读取累计值）
+        """
+        with self._lock:
+            self._watchers.setdefault(self.prefix + key, []).append(callback)
+
+    # ---------- 批量写入 ----------
+
+    def flush(self):
+        """
+        把待写缓冲一次写入后端
+
+        返回:
+            是否成功；失败时计数增量保留到下一次写入，缓存条目丢弃（只是少了一次共享命中）
+        """
+        with self._flush_lock:
+            with self._lock:
+                sets, self._sets = self._sets, {}
+                incrs, self._incrs = self._incrs, {}
+                hincrs, self._hincrs = self._hincrs, {}
+                watchers = {key: list(callbacks) for key, callbacks in self._watchers.items()}
+            for key in watchers:
+                incrs.setdefault(key, 0.0)
+            if not (sets or incrs or hincrs):
+                return True
+
+            started = time.perf_counter()
+            try:
+                totals = self.backend.apply(sets, incrs, hincrs)
+            except Exception:
+                metrics.SHARED_STATE.inc(op="flush", outcome="error")
+                with self._lock:
+                    for key, delta in incrs.items():
+                        self._incrs[key] = self._incrs.get(key, 0.0) + delta
+                    for key, fields in hincrs.items():
+                        target = self._hincrs.setdefault(key, {})
+                        for field, delta in fields.items():
+                            target[field] = target.get(field, 0.0) + delta
+                return False
+            metrics.SHARED_STATE.inc(op="flush", outcome="ok")
+            metrics.SHARED_STATE_FLUSH.observe(time.perf_counter() - started)
+            metrics.SHARED_STATE_BATCH.observe(
+                len(sets) + len(incrs) + sum(len(fields) for fields in hincrs.values()))
+
+            for key, callbacks in watchers.items():
+                for callback in callbacks:
+                    callback(totals[key], incrs[key])
+            return True
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """停止后台线程，写入剩余的缓冲并关闭后端（重复调用无效果）"""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+        self.backend.close()
+
+    # ---------- 用量累计 ----------
+
+    def record_usage(self, record):
+        """metrics 的统计记录回调：按模型累加请求数、缓存命中、失败和token数"""
+        model = record.get("model")
+        if model is None:
+            return
+        self.hincr(USAGE_KEY, f"{model}:requests")
+        if record.get("cache_hit"):
+            self.hincr(USAGE_KEY, f"{model}:cache_hits")
+        else:
+            if record.get("prompt_tokens"):
+                self.hincr(USAGE_KEY, f"{model}:prompt_tokens", record["prompt_tokens"])
+            if record.get("completion_tokens"):
+                self.hincr(USAGE_KEY, f"{model}:completion_tokens", record["completion_tokens"])
+        if record.get("outcome") == "error":
+            self.hincr(USAGE_KEY, f"{model}:errors")
+
+    def usage_totals(self):
+        """
+        所有副本的累计用量
+
+        返回:
+            {模型: {"requests": ..., "cache_hits": ..., "errors": ..., "prompt_tokens": ..., "completion_tokens": ...}}
+        """
+        usage = {}
+        for field, value in self.hgetall(USAGE_KEY).items():
+            model, name = field.rsplit(":", 1)
+            usage.setdefault(model, dict.fromkeys(USAGE_FIELDS, 0))[name] = int(value)
+        return usage
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    多副本共享速率的令牌桶
+
+    每个副本按完整速率补充本地令牌，放行判断在本地完成（不访问后端）；
+    消耗的令牌数随批量写入累加到共享计数器，每次写入后从本地桶中扣除其他副本在这段时间内消耗的令牌。
+    所有副本合计的放行速率约为 rate，误差不超过一个写入间隔内各副本各自放行的数量。
+    """
+
+    def __init__(self, state, key, rate, capacity=None):
+        """
+        参数:
+            state: SharedState
+            key: 共享计数器的键（同一个键在每个进程中只应创建一个令牌桶）
+            rate / capacity: 同 TokenBucket
+        """
+        super().__init__(rate, capacity)
+        self.state = state
+        self.key = key
+        self._last_total = None
+        state.watch(key, self._on_flush)
+
+    def try_acquire(self, tokens=1):
+        if not super().try_acquire(tokens):
+            return False
+        self.state.incr(self.key, tokens)
+        return True
+
+    def _on_flush(self, total, own):
+        # 只在后台写入线程中调用
+        if self._last_total is not None:
+            others = total - self._last_total - own
+            if others > 0:
+                self.consume(others)
+        self._last_total = total
+
+
+# ==================== 进程级实例 ====================
+
+def state_from_env():
+    """根据环境变量创建共享状态，未启用时返回None"""
+    name = os.getenv("TCM_STATE_BACKEND", "off").strip().lower()
+    if name in ("", "off", "none", "0", "false"):
+        return None
+
+    timeout = float(os.getenv("TCM_STATE_TIMEOUT", DEFAULT_TIMEOUT))
+    if name == "sqlite":
+        backend = SQLiteState(os.getenv("TCM_STATE_PATH", DEFAULT_PATH), timeout)
+    elif name == "redis":
+        backend = RedisState(os.getenv("TCM_STATE_URL", DEFAULT_URL), timeout)
+    else:
+        backend = MemoryState()
+    return SharedState(backend, os.getenv("TCM_STATE_PREFIX", DEFAULT_PREFIX),
+                       float(os.getenv("TCM_STATE_FLUSH_MS", DEFAULT_FLUSH_MS)) / 1000)
+
+
+_state = None
+_state_loaded = False
+_state_lock = threading.Lock()
+
+
+def get_state():
+    """
+    获取进程内共享的 SharedState（线程安全，首次调用时创建；未启用时返回None）
+
+    首次创建时注册用量累计：此后每次LLM调用结束的统计记录都会累加到共享后端
+    """
+    global _state, _state_loaded
+    if not _state_loaded:
+        with _state_lock:
+            if not _state_loaded:
+                _state = state_from_env()
+                if _state is not None:
+                    metrics.add_sink(_state.record_usage)
+                _state_loaded = True
+    return _state
+
+
+def main(argv=None):
+    import argparse
+    import config
+
+    parser = argparse.ArgumentParser(description="跨副本共享状态")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("usage", help="查看各模型的累计用量")
+    parser.parse_args(argv)
+
+    config.load_env()
+    state = get_state()
+    if state is None:
+        print("未启用共享状态（设置 TCM_STATE_BACKEND）")
+        return
+    usage = state.usage_totals()
+    if not usage:
+        print("暂无用量记录")
+        return
+    print(f"{'模型':<28}{'请求':>8}{'缓存命中':>10}{'失败':>6}{'提示词token':>14}{'生成token':>12}")
+    for model, totals in sorted(usage.items()):
+        print(f"{model:<30}{totals['requests']:>8}{totals['cache_hits']:>10}{totals['errors']:>6}"
+              f"{totals['prompt_tokens']:>14}{totals['completion_tokens']:>12}")
+
+
+if __name__ == "__main__":
+    main()
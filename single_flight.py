@@ -0,0 +1,239 @@
+"""
+在途请求合并（single-flight）
+
+热门的快速选择按钮（如"失眠多梦、睡眠质量差"）被大量用户同时点击时，
+每次点击都会发起一次提示词完全相同的上游请求。本模块把同时在途的相同请求合并为一个上游流：
+    - 第一个请求（发起者）启动上游流，由后台线程/任务读取，写入共享的只追加文本块日志
+    - 后续的相同请求（合并者）订阅同一个日志，每个订阅者有自己的读取位置，
+      晚加入的订阅者先回放已收到的文本块，再继续接收新文本块
+    - 上游出错时所有订阅者收到同一个异常；所有订阅者都离开时取消上游请求（立即关闭HTTP响应），
+      并在同一把锁内把它移出在途表，之后的相同请求发起新的上游流，不会订阅到一个已取消的流
+    - 上游提前结束（被取消）时订阅者收到 cancellation.StreamCancelled，不会把不完整的回复当作完整回复
+上游结束后该请求即从在途表中移除，之后的相同请求由回复缓存负责。
+
+环境变量:
+    TCM_SINGLE_FLIGHT: off 关闭请求合并（默认开启）
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+
+import cancellation
+import metrics
+
+
+def flight_key(kind, messages):
+    """根据请求类型和完整消息列表计算合并键（提示词逐字节相同才会合并）"""
+    raw = json.dumps([kind, messages], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """一个在途的上游流"""
+
+    __slots__ = ("chunks", "done", "error", "subscribers", "cancelled", "cond", "task", "cancel")
+
+    def __init__(self, cond):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.cancelled = False
+        self.cond = cond
+        self.task = None
+        self.cancel = None
+
+
+class _Counts:
+    """发起与合并次数"""
+
+    def __init__(self):
+        self.originated = 0
+        self.coalesced = 0
+
+    def record(self, originated):
+        if originated:
+            self.originated += 1
+        else:
+            self.coalesced += 1
+        metrics.SINGLE_FLIGHT.inc(role="originated" if originated else "coalesced")
+
+    def stats(self, inflight):
+        return {"originated": self.originated, "coalesced": self.coalesced, "inflight": inflight}
+
+
+class SingleFlight(_Counts):
+    """线程版本，供 TCMAnalyzer 使用"""
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def stream(self, key, open_stream, cancel=None):
+        """
+        订阅 key 对应的上游流，不存在时发起
+
+        参数:
+            key: 合并键
+            open_stream: 无参函数，返回上游文本块迭代器（只在发起时调用）
+            cancel: 可选的 cancellation.Cancellation，由 open_stream 返回的上游流监听（只在发起时使用）。
+                    上游流在读取线程中运行，所有订阅者都离开时触发该信号，立即中止上游请求，
+                    而不是等下一个文本块到达
+
+        返回:
+            生成器，逐步返回文本块
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            originated = flight is None
+            if originated:
+                flight = self._flights[key] = _Flight(threading.Condition())
+                flight.cancel = cancel
+            flight.subscribers += 1
+            self.record(originated)
+
+        if originated:
+            threading.Thread(target=self._pump, args=(key, flight, open_stream), daemon=True).start()
+        return self._subscribe(key, flight)
+
+    def _pump(self, key, flight, open_stream):
+        upstream = None
+        try:
+            upstream = open_stream()
+            for text in upstream:
+                with flight.cond:
+                    if flight.cancelled:
+                        break
+                    flight.chunks.append(text)
+                    flight.cond.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            if upstream is not None and hasattr(upstream, "close"):
+                upstream.close()
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            with flight.cond:
+                if flight.cancelled and flight.error is None:
+                    flight.error = cancellation.StreamCancelled()
+                flight.done = True
+                flight.cond.notify_all()
+
+    def _subscribe(self, key, flight):
+        index = 0
+        try:
+            while True:
+                with flight.cond:
+                    while index >= len(flight.chunks) and not flight.done:
+                        flight.cond.wait()
+                    pending = flight.chunks[index:]
+                    index += len(pending)
+                    done = flight.done
+                yield from pending
+                if done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            # 与 stream() 中的加入使用同一把锁：判定为无人订阅后不会再有新的订阅者加入
+            with self._lock:
+                with flight.cond:
+                    flight.subscribers -= 1
+                    abandoned = flight.subscribers == 0 and not flight.done
+                    if abandoned:
+                        # 所有订阅者都已离开，取消上游请求
+                        flight.cancelled = True
+                if abandoned and self._flights.get(key) is flight:
+                    del self._flights[key]
+            if abandoned and flight.cancel is not None:
+                flight.cancel.cancel()
+
+    def stats(self):
+        with self._lock:
+            return super().stats(len(self._flights))
+
+
+class AsyncSingleFlight(_Counts):
+    """asyncio版本，供 AsyncTCMAnalyzer 使用（只在同一个事件循环中使用）"""
+
+    def __init__(self):
+        super().__init__()
+        self._flights = {}
+
+    def stream(self, key, open_stream):
+        """
+        参数:
+            open_stream: 无参函数，返回上游异步文本块迭代器
+
+        返回:
+            异步生成器，逐步返回文本块
+        """
+        flight = self._flights.get(key)
+        originated = flight is None
+        if originated:
+            flight = self._flights[key] = _Flight(asyncio.Condition())
+        flight.subscribers += 1
+        self.record(originated)
+
+        if originated:
+            flight.task = asyncio.get_running_loop().create_task(self._pump(key, flight, open_stream))
+        return self._subscribe(key, flight)
+
+    async def _pump(self, key, flight, open_stream):
+        upstream = open_stream()
+        try:
+            async for text in upstream:
+                async with flight.cond:
+                    flight.chunks.append(text)
+                    flight.cond.notify_all()
+        except asyncio.CancelledError:
+            # 被取消的上游流以异常结束，订阅者不会把已收到的部分当作完整回复
+            flight.error = cancellation.StreamCancelled()
+        except Exception as e:
+            flight.error = e
+        finally:
+            try:
+                await upstream.aclose()
+            except asyncio.CancelledError:
+                if flight.error is None:
+                    flight.error = cancellation.StreamCancelled()
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            async with flight.cond:
+                flight.done = True
+                flight.cond.notify_all()
+
+    async def _subscribe(self, key, flight):
+        index = 0
+        try:
+            while True:
+                async with flight.cond:
+                    await flight.cond.wait_for(lambda: index < len(flight.chunks) or flight.done)
+                    pending = flight.chunks[index:]
+                    index += len(pending)
+                    done = flight.done
+                for text in pending:
+                    yield text
+                if done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # 立即移出在途表，之后的相同请求发起新的上游流
+                flight.cancelled = True
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+
+    def stats(self):
+        return super().stats(len(self._flights))
+
+
+def single_flight_enabled():
+    return os.getenv("TCM_SINGLE_FLIGHT", "on").strip().lower() not in ("0", "off", "false")
@@ -0,0 +1,106 @@
+"""
+流式输出渲染器
+
+把模型返回的文本块缓存在列表中，按时间或字符预算批量刷新到Streamlit占位符，
+避免每个token都重新渲染整段markdown。
+"""
+import os
+import time
+
+CURSOR = "▌"
+
+# 默认刷新预算：每50毫秒或每累计200个字符刷新一次
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_FLUSH_CHARS = 200
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+
+class StreamRenderer:
+    """按预算节流的流式渲染器"""
+
+    def __init__(self, placeholder, flush_interval=None, flush_chars=None, typing_delay=None):
+        """
+        参数:
+            placeholder: Streamlit占位符（需支持 markdown 方法）
+            flush_interval: 两次刷新之间的最长间隔（秒），默认读取 TCM_STREAM_FLUSH_MS
+            flush_chars: 累计多少新字符后立即刷新，默认读取 TCM_STREAM_FLUSH_CHARS
+            typing_delay: 每个文本块后的打字效果延迟（秒），默认读取 TCM_TYPING_DELAY，为0即关闭
+        """
+        if flush_interval is None:
+            flush_interval = _env_float("TCM_STREAM_FLUSH_MS", DEFAULT_FLUSH_INTERVAL * 1000) / 1000
+        if flush_chars is None:
+            flush_chars = int(_env_float("TCM_STREAM_FLUSH_CHARS", DEFAULT_FLUSH_CHARS))
+        if typing_delay is None:
+            typing_delay = _env_float("TCM_TYPING_DELAY", 0.0)
+
+        self.placeholder = placeholder
+        self.flush_interval = flush_interval
+        self.flush_chars = flush_chars
+        self.typing_delay = typing_delay
+
+        self._parts = []
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+
+        # 统计信息
+        self.started = time.perf_counter()
+        self.first_frame_at = None
+        self.frames = 0
+        self.chunks = 0
+
+    @property
+    def text(self):
+        """当前已接收的完整文本"""
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def write(self, chunk):
+        """追加一个文本块，达到预算时刷新"""
+        if not chunk:
+            return
+        self._parts.append(chunk)
+        self._pending_chars += len(chunk)
+        self.chunks += 1
+
+        now = time.monotonic()
+        # 首个文本块立即显示，之后按预算刷新
+        if (self.frames == 0 or self._pending_chars >= self.flush_chars
+                or now - self._last_flush >= self.flush_interval):
+            self._flush(self.text + CURSOR)
+
+        if self.typing_delay > 0:
+            time.sleep(self.typing_delay)
+
+    def finish(self):
+        """输出最终结果（去掉光标），返回完整文本"""
+        full_text = self.text
+        self._flush(full_text)
+        return full_text
+
+    def _flush(self, content):
+        self.placeholder.markdown(content)
+        if self.first_frame_at is None:
+            self.first_frame_at = time.perf_counter()
+        self.frames += 1
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+
+    def stats(self):
+        """返回本次回复的渲染统计"""
+        return {"frames": self.frames, "chunks": self.chunks, "chars": len(self.text)}
+
+    def render(self, chunks):
+        """消费整个文本块迭代器并返回完整文本"""
+        for chunk in chunks:
+            self.write(chunk)
+        return self.finish()
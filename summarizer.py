@@ -0,0 +1,185 @@
+"""
+长对话滚动摘要
+
+多轮问诊中，较早的症状描述和大段结构化建议（食疗方、穴位等）每一轮都会被重新发送，
+占据了提示词的大部分。当某个会话尚未整理的较早轮次超过阈值时，
+把这些轮次与已有摘要合并为一份结构化的"病例摘要"（症状、证型判断、已给建议等），
+之后的请求只发送 病例摘要 + 最近几轮原文。
+
+摘要按会话缓存并增量更新：每次只把新增的较早轮次合并进已有摘要，不重新整理全部历史。
+只有在本次提供的历史中找到已整理到的位置时才复用摘要，会话ID本身不足以取得某个会话的病例摘要。
+整理在本轮回复之外进行（同步分析器使用后台线程，异步分析器使用事件循环任务），
+不会增加当前回复的等待时间，整理完成后从下一轮开始生效。
+
+环境变量:
+    TCM_SUMMARY: off 关闭滚动摘要（默认开启）
+    TCM_SUMMARY_TRIGGER_TOKENS: 未整理的较早轮次超过该token数时触发整理，默认1500
+    TCM_SUMMARY_KEEP_TURNS: 始终以原文发送的最近消息数，默认4
+    TCM_SUMMARY_MAX_TOKENS: 摘要的最大生成token数，默认400
+    TCM_SUMMARY_MAX_SESSIONS: 最多缓存摘要的会话数，默认1000
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+import prompts
+from context_window import count_message_tokens
+
+DEFAULT_TRIGGER_TOKENS = 1500
+DEFAULT_KEEP_TURNS = 4
+DEFAULT_MAX_TOKENS = 400
+DEFAULT_MAX_SESSIONS = 1000
+
+
+def _tail_digest(messages):
+    """最后两条消息的摘要值（问答成对计算，避免重复的简短回复被误认）"""
+    raw = "\x00".join(m["role"] + "\x01" + m["content"] for m in messages[-2:])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class CaseSummary:
+    """一个会话的病例摘要"""
+
+    __slots__ = ("text", "tail", "folded", "folding")
+
+    def __init__(self):
+        self.text = None      # 摘要文本，尚未整理时为None
+        self.tail = None      # 已整理的最后两条消息的摘要值，用于在新的历史中定位
+        self.folded = 0       # 已整理的消息数
+        self.folding = False  # 是否有整理任务在进行
+
+
+class FoldJob:
+    """一次增量整理任务：把 turns 合并进 previous"""
+
+    __slots__ = ("key", "previous", "turns", "tail")
+
+    def __init__(self, key, previous, turns, tail):
+        self.key = key
+        self.previous = previous
+        self.turns = turns
+        self.tail = tail
+
+
+class RollingSummarizer:
+    """按会话缓存、增量更新的病例摘要"""
+
+    def __init__(self, trigger_tokens=DEFAULT_TRIGGER_TOKENS, keep_turns=DEFAULT_KEEP_TURNS,
+                 max_tokens=DEFAULT_MAX_TOKENS, max_sessions=DEFAULT_MAX_SESSIONS, model="gpt-4o-mini"):
+        """
+        参数:
+            trigger_tokens: 未整理的较早轮次超过该token数时触发整理
+            keep_turns: 始终以原文发送的最近消息数
+            max_tokens: 摘要的最大生成token数
+            max_sessions: 最多缓存摘要的会话数，超出时淘汰最久未使用的会话
+            model: 用于计算token数的模型名称
+        """
+        self.trigger_tokens = trigger_tokens
+        self.keep_turns = keep_turns
+        self.max_tokens = max_tokens
+        self.max_sessions = max_sessions
+        self.model = model
+        self._lock = threading.Lock()
+        self._summaries = OrderedDict()
+
+    def _split_recent(self, pending):
+        """拆分出始终以原文发送的最近消息（保证从用户消息开始）"""
+        start = max(len(pending) - self.keep_turns, 0)
+        while start > 0 and pending[start]["role"] != "user":
+            start -= 1
+        return start
+
+    def prepare(self, key, history):
+        """
+        为一次请求准备上下文
+
+        参数:
+            key: 会话ID
+            history: 对话历史（按时间顺序，可以只是最近的一段）
+
+        返回:
+            (摘要文本或None, 需要原文发送的消息列表, FoldJob或None)
+            返回FoldJob时，调用方应在本轮回复之外调用模型整理，并把结果交给 complete()
+        """
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = CaseSummary()
+                while len(self._summaries) > self.max_sessions:
+                    self._summaries.popitem(last=False)
+            else:
+                self._summaries.move_to_end(key)
+
+            # 定位已整理到的位置；找不到时（历史窗口已经越过该位置，或历史并非来自该会话）
+            # 不复用已有摘要，全部作为新消息，下一次整理从头生成摘要
+            start = 0
+            previous = summary.text
+            if summary.tail is not None:
+                for index in range(len(history), 0, -1):
+                    if _tail_digest(history[max(index - 2, 0):index]) == summary.tail:
+                        start = index
+                        break
+                else:
+                    previous = None
+            pending = history[start:]
+
+            job = None
+            split = self._split_recent(pending)
+            older = pending[:split]
+            if older and not summary.folding:
+                tokens = sum(count_message_tokens(m, self.model) for m in older)
+                if tokens >= self.trigger_tokens:
+                    summary.folding = True
+                    job = FoldJob(key, previous, older, _tail_digest(older))
+
+            return previous, pending, job
+
+    def fold_messages(self, job):
+        """构建整理请求的消息列表"""
+        return prompts.case_summary_messages(job.previous, job.turns)
+
+    def complete(self, job, text):
+        """保存整理结果"""
+        with self._lock:
+            summary = self._summaries.get(job.key)
+            if summary is None:
+                return
+            summary.folding = False
+            text = (text or "").strip()
+            if not text:
+                return
+            summary.text = text
+            summary.tail = job.tail
+            summary.folded += len(job.turns)
+        metrics.SUMMARY_FOLDS.inc(outcome="ok")
+
+    def abort(self, job):
+        """整理失败时调用，下一轮会重新尝试"""
+        with self._lock:
+            summary = self._summaries.get(job.key)
+            if summary is not None:
+                summary.folding = False
+        metrics.SUMMARY_FOLDS.inc(outcome="error")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._summaries),
+                "summarized": sum(1 for s in self._summaries.values() if s.text),
+                "folding": sum(1 for s in self._summaries.values() if s.folding),
+            }
+
+
+def summarizer_from_env(model="gpt-4o-mini"):
+    """根据环境变量创建滚动摘要，关闭时返回None"""
+    if os.getenv("TCM_SUMMARY", "on").strip().lower() in ("0", "off", "false"):
+        return None
+    return RollingSummarizer(
+        trigger_tokens=int(os.getenv("TCM_SUMMARY_TRIGGER_TOKENS", DEFAULT_TRIGGER_TOKENS)),
+        keep_turns=int(os.getenv("TCM_SUMMARY_KEEP_TURNS", DEFAULT_KEEP_TURNS)),
+        max_tokens=int(os.getenv("TCM_SUMMARY_MAX_TOKENS", DEFAULT_MAX_TOKENS)),
+        max_sessions=int(os.getenv("TCM_SUMMARY_MAX_SESSIONS", DEFAULT_MAX_SESSIONS)),
+        model=model,
+    )
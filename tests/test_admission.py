@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+import admission
+
+
+def _controller(**kwargs):
+    options = dict(max_concurrent=1, max_queue=10, max_wait=5, global_rate=0, session_rate=0, poll_interval=0.01)
+    options.update(kwargs)
+    return admission.AdmissionController(**options)
+
+
+def test_grants_up_to_max_concurrent_then_queues():
+    controller = _controller(max_concurrent=2)
+    first, second, third = (controller.submit(s) for s in ("a", "b", "c"))
+    assert first.granted and second.granted
+    assert not third.granted
+    assert third.position() == 1
+    first.release()
+    assert third.granted
+    assert controller.stats() == {"active": 2, "queued": 0, "waiting_sessions": 0}
+
+
+def test_queue_rotates_between_sessions():
+    controller = _controller()
+    active = controller.submit("busy")
+    a1, a2, a3 = (controller.submit("a") for _ in range(3))
+    b1 = controller.submit("b")
+    # 会话 a 排了三条，会话 b 的第一条仍排在 a 的第二条之前
+    assert [a1.position(), b1.position(), a2.position(), a3.position()] == [1, 2, 3, 4]
+
+    active.release()
+    assert a1.granted and not b1.granted
+    a1.release()
+    assert b1.granted and not a2.granted
+    b1.release()
+    assert a2.granted and not a3.granted
+
+
+def test_session_rate_rejects_fast_sender():
+    controller = _controller(max_concurrent=10, session_rate=0.001, session_burst=2)
+    controller.submit("s").release()
+    controller.submit("s").release()
+    with pytest.raises(admission.AdmissionRejected) as info:
+        controller.submit("s")
+    assert info.value.reason == "session_rate"
+    assert info.value.retry_after > 0
+    # 其他会话不受影响
+    assert controller.submit("other").granted
+
+
+def test_full_queue_rejects():
+    controller = _controller(max_queue=1)
+    controller.submit("a")
+    controller.submit("b")
+    with pytest.raises(admission.AdmissionRejected) as info:
+        controller.submit("c")
+    assert info.value.reason == "queue_full"
+
+
+def test_wait_times_out_and_leaves_queue():
+    controller = _controller(max_wait=0.05)
+    controller.submit("a")
+    ticket = controller.submit("b")
+    with pytest.raises(admission.AdmissionRejected) as info:
+        ticket.wait()
+    assert info.value.reason == "timeout"
+    assert controller.stats()["queued"] == 0
+
+
+def test_wait_reports_position_changes():
+    controller = _controller()
+    active = controller.submit("a")
+    ticket = controller.submit("b")
+    positions = []
+
+    def on_position(position):
+        positions.append(position)
+        active.release()
+
+    ticket.wait(on_position)
+    assert ticket.granted
+    assert positions == [1]
+
+
+def test_released_queued_ticket_frees_its_place():
+    controller = _controller()
+    active = controller.submit("a")
+    waiting = controller.submit("b")
+    later = controller.submit("c")
+    waiting.release()
+    assert later.position() == 1
+    active.release()
+    assert later.granted
+    assert not waiting.granted
+
+
+def test_cancelled_async_wait_gives_up_its_place():
+    controller = _controller()
+
+    async def run():
+        active = controller.submit("a")
+        ticket = controller.submit("b")
+        task = asyncio.ensure_future(ticket.wait_async())
+        await asyncio.sleep(0.02)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert controller.stats()["queued"] == 0
+        active.release()
+
+    asyncio.run(run())
+    assert controller.stats() == {"active": 0, "queued": 0, "waiting_sessions": 0}
+
+
+def test_ticket_context_manager_releases_once():
+    controller = _controller()
+    with controller.acquire("a"):
+        assert controller.stats()["active"] == 1
+    assert controller.stats()["active"] == 0
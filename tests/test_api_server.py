@@ -0,0 +1,36 @@
+import pytest
+from starlette.testclient import TestClient
+
+import admission
+import api_server
+
+URGENT = {"messages": [{"role": "user", "content": "突然胸痛，喘不上气"}]}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("OPENAI_API_BASE", "http://127.0.0.1:9")
+    for name in ("TCM_CACHE_BACKEND", "TCM_SINGLE_FLIGHT", "TCM_SEMANTIC_CACHE", "TCM_SUMMARY"):
+        monkeypatch.setenv(name, "off")
+    # 每个调用方只允许一次请求
+    controller = admission.AdmissionController(global_rate=0, session_rate=0.001, session_burst=1)
+    monkeypatch.setattr(admission, "get_controller", lambda: controller)
+    with TestClient(api_server.app) as c:
+        yield c
+
+
+def test_changing_api_key_does_not_bypass_rate_limit(client):
+    first = client.post("/v1/chat", json=URGENT, headers={"X-API-Key": "a"})
+    assert first.status_code == 200
+    second = client.post("/v1/chat", json=URGENT, headers={"X-API-Key": "b"})
+    assert second.status_code == 429
+    assert second.json()["reason"] == "session_rate"
+    assert int(second.headers["Retry-After"]) >= 1
+    third = client.post("/v1/chat", json=URGENT, headers={"Authorization": "Bearer c"})
+    assert third.status_code == 429
+
+
+def test_invalid_body_is_not_admitted(client):
+    assert client.post("/v1/chat", json={"messages": []}).status_code == 400
+    assert client.post("/v1/chat", json=URGENT).status_code == 200
@@ -0,0 +1,41 @@
+import json
+
+import batch_analyze
+
+
+class FakeAnalyzer:
+    def analyze(self, symptoms, age, gender, duration):
+        if symptoms == "boom":
+            raise RuntimeError("上游失败")
+        return "分析：" + symptoms
+
+
+def _write_input(path, rows):
+    path.write_text("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows), encoding="utf-8")
+
+
+def test_run_batch_counts_and_resumes(tmp_path):
+    source = tmp_path / "intake.jsonl"
+    output = tmp_path / "results.jsonl"
+    _write_input(source, [{"id": "a", "symptoms": "失眠"}, {"id": "b", "symptoms": "boom"},
+                          {"id": "c", "symptoms": ""}])
+
+    summary = batch_analyze.run_batch(str(source), str(output), analyzer=FakeAnalyzer(), workers=2, rate=1000)
+    assert summary == {"ok": 1, "error": 1, "skipped": 1}
+
+    # 续跑时已成功的记录跳过，失败的记录重试
+    summary = batch_analyze.run_batch(str(source), str(output), analyzer=FakeAnalyzer(), workers=2, rate=1000)
+    assert summary == {"ok": 0, "error": 1, "skipped": 2}
+
+
+def test_writer_failures_are_counted(tmp_path, monkeypatch):
+    source = tmp_path / "intake.jsonl"
+    output = tmp_path / "results.jsonl"
+    _write_input(source, [{"id": str(i), "symptoms": "头痛"} for i in range(5)])
+
+    def fail(self, item):
+        raise OSError("磁盘已满")
+
+    monkeypatch.setattr(batch_analyze.ResultWriter, "write", fail)
+    summary = batch_analyze.run_batch(str(source), str(output), analyzer=FakeAnalyzer(), workers=3, rate=1000)
+    assert summary == {"ok": 0, "error": 5, "skipped": 0}
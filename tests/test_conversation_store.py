@@ -0,0 +1,81 @@
+import pytest
+
+import conversation_store
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = conversation_store.ConversationStore(
+        path=str(tmp_path / "conversations.sqlite3"), max_sessions=2, recent_turns=3,
+        flush_size=100, flush_interval=60)
+    yield store
+    store.close()
+
+
+def test_new_session_does_not_flush_or_query(store, monkeypatch):
+    store.append("old", "user", "失眠")
+
+    def fail(*args):
+        raise AssertionError("new_session 不应访问磁盘")
+
+    monkeypatch.setattr(store, "_load_locked", fail)
+    monkeypatch.setattr(store, "_flush_locked", fail)
+    session_id = store.new_session()
+    assert store.stats()["pending_writes"] == 1
+    monkeypatch.undo()
+    assert store.turn_count(session_id) == 0
+    assert store.recent(session_id) == []
+
+
+def test_new_session_respects_lru_limit(store):
+    ids = [store.new_session() for _ in range(3)]
+    assert store.stats()["sessions_in_memory"] == 2
+    # 淘汰的空会话仍可继续使用
+    store.append(ids[0], "user", "头痛")
+    assert store.recent(ids[0]) == [{"role": "user", "content": "头痛"}]
+
+
+def test_recent_keeps_last_turns_and_history_reads_disk(store):
+    session_id = store.new_session()
+    for i in range(5):
+        store.append(session_id, "user" if i % 2 == 0 else "assistant", str(i))
+    assert [m["content"] for m in store.recent(session_id)] == ["2", "3", "4"]
+    assert [m["content"] for m in store.history(session_id)] == ["0", "1", "2", "3", "4"]
+    assert store.turn_count(session_id) == 5
+
+
+def test_evicted_session_reloads_from_disk(store):
+    first = store.new_session()
+    store.append(first, "user", "腰酸")
+    store.append(store.new_session(), "user", "a")
+    store.append(store.new_session(), "user", "b")
+    assert store.stats()["sessions_in_memory"] == 2
+    assert store.recent(first) == [{"role": "user", "content": "腰酸"}]
+    turn = store.append(first, "assistant", "回复")
+    assert turn.seq == 1
+
+
+def test_reopen_restores_sessions(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    store = conversation_store.ConversationStore(path=path, flush_size=100, flush_interval=60)
+    session_id = store.new_session()
+    store.append(session_id, "user", "失眠多梦")
+    store.close()
+
+    store = conversation_store.ConversationStore(path=path, flush_size=100, flush_interval=60)
+    try:
+        assert store.recent(session_id) == [{"role": "user", "content": "失眠多梦"}]
+        assert store.turn_count(session_id) == 1
+    finally:
+        store.close()
+
+
+def test_delete_drops_pending_and_stored_turns(store):
+    session_id = store.new_session()
+    store.append(session_id, "user", "x")
+    store.flush()
+    store.append(session_id, "assistant", "y")
+    store.delete(session_id)
+    assert store.recent(session_id) == []
+    assert store.history(session_id) == []
+    assert store.stats()["pending_writes"] == 0
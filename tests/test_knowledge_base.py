@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+import knowledge_base
+from knowledge_base import Expander, KnowledgeItem
+
+
+class FakeKnowledgeBase:
+    def __init__(self, *items):
+        self._items = {item.id: item for item in items}
+
+    def get(self, item_id):
+        return self._items.get(item_id)
+
+
+RECIPE = KnowledgeItem("R01", "recipe", "酸枣仁粥", "养心安神", ("酸枣仁15克", "粳米100克"))
+ACUPOINT = KnowledgeItem("A02", "acupoint", "神门", "宁心安神", ("腕横纹尺侧端，按揉3分钟",))
+KB = FakeKnowledgeBase(RECIPE, ACUPOINT)
+
+REPLY = "可以试试[[R01]]，睡前按揉[[A02]]。[[Z99]]注意[作息]规律。"
+
+
+def _feed_all(chunks):
+    expander = Expander(KB)
+    return "".join(expander.feed(chunk) for chunk in chunks) + expander.flush()
+
+
+def test_expand_whole_text():
+    text = knowledge_base.expand(KB, REPLY)
+    assert RECIPE.render() in text
+    assert ACUPOINT.render() in text
+    assert "[[" not in text
+    assert text.endswith("注意[作息]规律。")
+
+
+@pytest.mark.parametrize("split", range(1, len(REPLY)))
+def test_marker_split_at_any_position(split):
+    assert _feed_all([REPLY[:split], REPLY[split:]]) == knowledge_base.expand(KB, REPLY)
+
+
+def test_marker_split_into_single_characters():
+    assert _feed_all(list(REPLY)) == knowledge_base.expand(KB, REPLY)
+
+
+def test_partial_marker_is_held_back_until_complete():
+    expander = Expander(KB)
+    assert expander.feed("试试[") == "试试"
+    assert expander.feed("[R0") == ""
+    assert expander.feed("1]]吧") == RECIPE.render() + "吧"
+
+
+def test_unclosed_brackets_are_released():
+    expander = Expander(KB)
+    # 超过编号长度仍未闭合的 [[ 不是引用，原样输出
+    assert expander.feed("[[这不是编号") == "[[这不是编号"
+    assert expander.feed("结尾[") == "结尾"
+    assert expander.flush() == "["
+
+
+def test_unknown_marker_is_dropped():
+    assert knowledge_base.expand(KB, "参考[[Q42]]。") == "参考。"
+
+
+def test_expand_stream_sync_and_async():
+    chunks = ["可以试试[[R", "01]]，睡前按揉[", "[A02]]", "。"]
+    expected = knowledge_base.expand(KB, "".join(chunks))
+    assert "".join(knowledge_base.expand_stream(KB, iter(chunks))) == expected
+
+    async def source():
+        for chunk in chunks:
+            yield chunk
+
+    async def collect():
+        return "".join([text async for text in knowledge_base.aexpand_stream(KB, source())])
+
+    assert asyncio.run(collect()) == expected
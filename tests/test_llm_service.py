@@ -0,0 +1,104 @@
+import asyncio
+
+import openai
+import pytest
+
+import async_llm_service
+import llm_service
+import metrics
+import model_router
+from context_window import ContextOverflow, ContextWindow
+from summarizer import RollingSummarizer
+
+HISTORY = [
+    {"role": "user", "content": "最近总是失眠，晚上很难入睡，早上醒得很早。" * 5},
+    {"role": "assistant", "content": "可以先调整作息，睡前避免使用手机，减少咖啡和浓茶。" * 5},
+    {"role": "user", "content": "还有点心慌，白天没精神，注意力不集中。" * 5},
+    {"role": "assistant", "content": "建议适当运动，饮食清淡，必要时到医院检查。" * 5},
+    {"role": "user", "content": "吃什么比较好"},
+]
+
+
+@pytest.fixture(autouse=True)
+def _env(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    for name in ("TCM_CACHE_BACKEND", "TCM_SINGLE_FLIGHT", "TCM_SEMANTIC_CACHE", "TCM_SUMMARY"):
+        monkeypatch.setenv(name, "off")
+
+
+def _summarizer():
+    return RollingSummarizer(trigger_tokens=1, keep_turns=1)
+
+
+def _router(client):
+    return model_router.ModelRouter([model_router.Backend("default", client)])
+
+
+def test_context_overflow_releases_fold_job():
+    summarizer = _summarizer()
+    analyzer = llm_service.TCMAnalyzer(
+        router=_router(openai.OpenAI(api_key="test-key", base_url="http://127.0.0.1:9")),
+        cache=None, semantic_cache=None, summarizer=summarizer,
+        context_window=ContextWindow(budget=20, min_latest=10))
+
+    with pytest.raises(ContextOverflow):
+        analyzer._prepare_chat(HISTORY, 30, "女", session_id="s1")
+    assert summarizer.stats()["folding"] == 0
+
+    # 窗口足够时同一会话仍会触发整理
+    analyzer.context_window = ContextWindow(budget=100000)
+    request = analyzer._prepare_chat(HISTORY, 30, "女", session_id="s1")
+    assert request.fold_job is not None
+
+
+class FakeCorpus:
+    """总是声称包含该提问、但版本戳不一致的预生成语料"""
+
+    def contains(self, text, age, gender):
+        return True
+
+    def lookup(self, text, age, gender, stamp):
+        return None
+
+
+def _triage_total():
+    return sum(metrics.TRIAGE.samples().values())
+
+
+def test_precomputed_lookup_does_not_count_triage(monkeypatch):
+    monkeypatch.setenv("TCM_TRIAGE", "on")
+    analyzer = llm_service.TCMAnalyzer(
+        router=_router(openai.OpenAI(api_key="test-key", base_url="http://127.0.0.1:9")),
+        cache=None, semantic_cache=None, summarizer=None)
+    analyzer.corpus = FakeCorpus()
+    messages = [{"role": "user", "content": "失眠多梦，心烦"}]
+
+    before = _triage_total()
+    assert analyzer.precomputed_reply(messages, 30, "女") is None
+    assert _triage_total() == before
+    analyzer._prepare_chat(messages, 30, "女")
+    assert _triage_total() == before + 1
+
+
+def test_async_cancel_during_prepare_releases_fold_job():
+    summarizer = _summarizer()
+    analyzer = async_llm_service.AsyncTCMAnalyzer(
+        router=_router(openai.AsyncOpenAI(api_key="test-key", base_url="http://127.0.0.1:9")),
+        cache=None, semantic_cache=None, summarizer=summarizer,
+        context_window=ContextWindow(budget=100000))
+
+    async def run():
+        task = asyncio.get_running_loop().create_task(
+            analyzer._offload_prepare_chat(HISTORY, 30, "女", "s1"))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # 等线程池中的构建完成、回调执行
+        for _ in range(100):
+            if summarizer.stats()["folding"] == 0:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert summarizer.stats()["folding"] == 0
@@ -0,0 +1,57 @@
+import model_router
+import resilience
+
+
+def _router(**kwargs):
+    backends = [model_router.Backend(name, client=None, model=name) for name in ("fast", "slow", "other")]
+    return model_router.ModelRouter(backends, **kwargs), backends
+
+
+def test_least_latency_prefers_lowest_ewma_without_exploration():
+    router, (fast, slow, other) = _router(explore_rate=0)
+    router.record_success(fast, 0.2)
+    router.record_success(slow, 5.0)
+    router.record_success(other, 1.0)
+    for _ in range(50):
+        assert [b.name for b in router.plan("analysis").backends] == ["fast", "other", "slow"]
+
+
+def test_exploration_probes_non_best_backends():
+    router, (fast, slow, other) = _router(explore_rate=0.5)
+    router.record_success(fast, 0.2)
+    router.record_success(slow, 5.0)
+    router.record_success(other, 1.0)
+    primaries = {router.plan("analysis").primary.name for _ in range(200)}
+    assert primaries == {"fast", "slow", "other"}
+    # 探索时最快的后端仍在候选中，作为重试的兜底
+    for _ in range(50):
+        assert sorted(b.name for b in router.plan("analysis").backends) == ["fast", "other", "slow"]
+
+
+def test_stale_ewma_recovers_after_probe():
+    router, (fast, slow, _) = _router(explore_rate=1.0, ewma_alpha=0.5)
+    router.backends = [fast, slow]
+    router.record_success(fast, 1.0)
+    router.record_success(slow, 10.0)
+    # 探索请求把慢后端排在最前，恢复后的首token耗时拉低其EWMA
+    plan = router.plan("analysis")
+    assert plan.primary is slow
+    for _ in range(5):
+        router.record_success(slow, 0.1)
+    router.explore_rate = 0
+    assert router.plan("analysis").primary is slow
+
+
+def test_unhealthy_backend_is_last_and_never_explored():
+    router, (fast, slow, other) = _router(explore_rate=1.0, failure_threshold=1)
+    router.record_failure(fast, resilience.LLMConnectionError("down"))
+    for _ in range(20):
+        assert router.plan("analysis").backends[-1] is fast
+
+
+def test_kinds_restrict_candidates():
+    small = model_router.Backend("small", None, "small", kinds=("followup",))
+    large = model_router.Backend("large", None, "large", kinds=("analysis",))
+    router = model_router.ModelRouter([large, small], explore_rate=0)
+    assert [b.name for b in router.plan("followup").backends] == ["small"]
+    assert router.model_key("analysis") == "analysis:large"
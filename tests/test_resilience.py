@@ -0,0 +1,50 @@
+import pytest
+
+import resilience
+
+
+def test_backoff_waits_full_retry_after():
+    policy = resilience.RetryPolicy(backoff_max=8.0)
+    assert policy.backoff(1, retry_after=5.0) == 5.0
+    assert policy.backoff(1, retry_after=8.0) == 8.0
+
+
+def test_backoff_gives_up_when_retry_after_exceeds_budget():
+    policy = resilience.RetryPolicy(backoff_max=8.0)
+    assert policy.backoff(1, retry_after=30.0) is None
+
+
+def test_backoff_without_retry_after_is_capped():
+    policy = resilience.RetryPolicy(backoff_base=0.5, backoff_max=1.0)
+    for attempt in range(1, 6):
+        assert 0 < policy.backoff(attempt) <= 1.0
+
+
+def test_call_with_retry_does_not_retry_before_retry_after(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(resilience.time, "sleep", sleeps.append)
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise resilience.LLMRateLimitError("限流", retry_after=60.0)
+
+    with pytest.raises(resilience.LLMRateLimitError):
+        resilience.call_with_retry(call, resilience.RetryPolicy(max_attempts=3, backoff_max=8.0))
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+def test_call_with_retry_sleeps_full_retry_after(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(resilience.time, "sleep", sleeps.append)
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) == 1:
+            raise resilience.LLMRateLimitError("限流", retry_after=3.0)
+        return "ok"
+
+    assert resilience.call_with_retry(call, resilience.RetryPolicy(backoff_max=8.0)) == "ok"
+    assert sleeps == [3.0]
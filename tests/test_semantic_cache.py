@@ -0,0 +1,56 @@
+import pytest
+
+import semantic_cache
+from benchmarks import semantic_cases
+
+PROFILE = semantic_cases.PROFILE
+
+
+@pytest.mark.parametrize("cached, query, expected", semantic_cases.CASES)
+def test_calibration_cases(cached, query, expected):
+    cache = semantic_cache.SemanticCache(max_entries=4)
+    cache.add(cached, PROFILE, "回复")
+    value, _ = cache.lookup(query, PROFILE)
+    assert (value is not None) == expected
+
+
+@pytest.mark.parametrize("cached, query", [
+    ("头痛头晕", "头痛头晕、视物模糊"),
+    ("腰酸背痛", "腰酸背痛、尿频"),
+    ("疲劳乏力、精神不振", "疲劳乏力、精神不振、体重下降"),
+])
+def test_added_symptom_misses_even_above_threshold(cached, query):
+    cache = semantic_cache.SemanticCache(max_entries=4)
+    cache.add(cached, PROFILE, "回复")
+    value, score = cache.lookup(query, PROFILE)
+    assert score >= cache.threshold
+    assert value is None
+
+
+def test_added_symptom_falls_back_to_entry_that_covers_it():
+    cache = semantic_cache.SemanticCache(max_entries=4)
+    cache.add("头痛头晕", PROFILE, "头痛头晕的回复")
+    cache.add("头痛头晕，视物模糊", PROFILE, "视物模糊的回复")
+    value, _ = cache.lookup("头痛头晕、视物模糊", PROFILE)
+    assert value == "视物模糊的回复"
+
+
+def test_dropped_symptom_still_hits():
+    cache = semantic_cache.SemanticCache(max_entries=4)
+    cache.add("失眠多梦怎么调理", PROFILE, "回复")
+    value, _ = cache.lookup("晚上睡不着怎么办", PROFILE)
+    assert value == "回复"
+
+
+def test_clauses_split_on_punctuation_and_connectors():
+    assert semantic_cache.clauses("头痛头晕、视物模糊") == ["头痛头晕", "视物模糊"]
+    assert semantic_cache.clauses("失眠，还有心慌") == ["失眠", "心慌"]
+    assert semantic_cache.clauses("最近总是失眠怎么办") == ["失眠"]
+
+
+def test_profile_and_qualifiers_separate_entries():
+    cache = semantic_cache.SemanticCache(max_entries=4)
+    cache.add("失眠怎么办", PROFILE, "回复")
+    assert cache.lookup("失眠怎么办", PROFILE[:2] + ("60岁以上", "男"))[0] is None
+    assert cache.lookup("孕妇失眠怎么办", PROFILE)[0] is None
+    assert cache.lookup("失眠怎么办", PROFILE)[0] == "回复"
@@ -0,0 +1,164 @@
+import asyncio
+import threading
+
+import pytest
+
+import cancellation
+import single_flight
+
+
+def _gated_stream(gate, chunks, opened):
+    def open_stream():
+        opened.append(1)
+
+        def generate():
+            for text in chunks:
+                gate.wait(5)
+                yield text
+        return generate()
+    return open_stream
+
+
+def test_flight_key_depends_on_kind_and_messages():
+    messages = [{"role": "user", "content": "失眠"}]
+    assert single_flight.flight_key("chat", messages) == single_flight.flight_key("chat", list(messages))
+    assert single_flight.flight_key("chat", messages) != single_flight.flight_key("analysis", messages)
+
+
+def test_concurrent_identical_requests_share_one_upstream():
+    flights = single_flight.SingleFlight()
+    gate = threading.Event()
+    opened = []
+    open_stream = _gated_stream(gate, ["a", "b", "c"], opened)
+
+    first = flights.stream("k", open_stream)
+    second = flights.stream("k", open_stream)
+    assert flights.stats() == {"originated": 1, "coalesced": 1, "inflight": 1}
+    gate.set()
+    assert "".join(first) == "abc"
+    assert "".join(second) == "abc"
+    assert opened == [1]
+    assert flights.stats()["inflight"] == 0
+
+
+def test_late_subscriber_replays_received_chunks():
+    flights = single_flight.SingleFlight()
+    release = threading.Event()
+    opened = []
+
+    def open_stream():
+        opened.append(1)
+
+        def generate():
+            yield "a"
+            release.wait(5)
+            yield "b"
+        return generate()
+
+    first = flights.stream("k", open_stream)
+    assert next(first) == "a"
+    late = flights.stream("k", open_stream)
+    release.set()
+    assert "".join(late) == "ab"
+    assert "".join(first) == "b"
+    assert opened == [1]
+
+
+def test_upstream_error_reaches_every_subscriber():
+    flights = single_flight.SingleFlight()
+    gate = threading.Event()
+
+    def open_stream():
+        def generate():
+            gate.wait(5)
+            yield "a"
+            raise RuntimeError("上游失败")
+        return generate()
+
+    subscribers = [flights.stream("k", open_stream) for _ in range(2)]
+    gate.set()
+    for subscriber in subscribers:
+        with pytest.raises(RuntimeError):
+            list(subscriber)
+
+
+def test_abandoned_flight_cancels_upstream_and_is_not_reused():
+    flights = single_flight.SingleFlight()
+    cancel = cancellation.Cancellation()
+    stopped = threading.Event()
+    cancel.add_callback(stopped.set)
+    opened = []
+
+    def open_stream():
+        opened.append(1)
+
+        def generate():
+            yield "a"
+            # 上游在取消信号触发前一直等待
+            stopped.wait(5)
+            yield "b"
+        return generate()
+
+    first = flights.stream("k", open_stream, cancel)
+    assert next(first) == "a"
+    first.close()
+    assert cancel.is_set()
+    assert flights.stats()["inflight"] == 0
+
+    # 之后的相同请求发起新的上游流
+    gate = threading.Event()
+    gate.set()
+    second = flights.stream("k", _gated_stream(gate, ["x"], opened))
+    assert "".join(second) == "x"
+    assert opened == [1, 1]
+
+
+def test_async_identical_requests_share_one_upstream():
+    opened = []
+
+    async def run():
+        flights = single_flight.AsyncSingleFlight()
+        gate = asyncio.Event()
+
+        def open_stream():
+            opened.append(1)
+
+            async def generate():
+                await gate.wait()
+                for text in ("a", "b"):
+                    yield text
+            return generate()
+
+        async def collect(stream):
+            return "".join([text async for text in stream])
+
+        tasks = [asyncio.ensure_future(collect(flights.stream("k", open_stream))) for _ in range(3)]
+        await asyncio.sleep(0)
+        gate.set()
+        results = await asyncio.gather(*tasks)
+        return results, flights.stats()
+
+    results, stats = asyncio.run(run())
+    assert results == ["ab", "ab", "ab"]
+    assert opened == [1]
+    assert stats == {"originated": 1, "coalesced": 2, "inflight": 0}
+
+
+def test_async_abandoned_flight_leaves_inflight_table():
+    async def run():
+        flights = single_flight.AsyncSingleFlight()
+        never = asyncio.Event()
+
+        def open_stream():
+            async def generate():
+                yield "a"
+                await never.wait()
+                yield "b"
+            return generate()
+
+        stream = flights.stream("k", open_stream)
+        assert await stream.__anext__() == "a"
+        await stream.aclose()
+        assert flights.stats()["inflight"] == 0
+
+    asyncio.run(run())
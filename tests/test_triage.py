@@ -0,0 +1,32 @@
+import pytest
+
+import triage
+from benchmarks import triage_cases
+
+
+def _flags(text):
+    return tuple(dict.fromkeys(flag.key for flag, _ in triage.triage(text).red_flags))
+
+
+@pytest.mark.parametrize("text,expected", triage_cases.CASES)
+def test_regression_cases(text, expected):
+    assert _flags(text) == expected
+
+
+@pytest.mark.parametrize("text", ["泡脚用40度左右的水可以吗", "泡脚水温40度合适吗", "洗澡水39度以上会不会太热"])
+def test_temperature_without_fever_word_is_not_urgent(text):
+    assert not triage.triage(text).urgent
+
+
+@pytest.mark.parametrize("text", ["发烧40度", "体温39度以上", "孩子烧到40度了"])
+def test_temperature_with_fever_word_is_urgent(text):
+    assert _flags(text) == ("fever",)
+
+
+@pytest.mark.parametrize("text", ["没有胸痛", "无明显胸痛", "没有明显的胸痛", "否认胸痛"])
+def test_negated_red_flag(text):
+    assert not triage.triage(text).urgent
+
+
+def test_negation_does_not_cross_clause():
+    assert _flags("没有发烧，胸痛") == ("cardiac",)
@@ -0,0 +1,309 @@
+"""
+本地分诊
+
+在调用模型之前，用症状词典对用户的最新消息做一次多模式匹配（Aho-Corasick自动机，
+耗时与输入长度成线性关系，与词典大小无关）：
+    - 危险信号（如胸痛、口角歪斜、呕血）：直接以模板回复建议就医，不调用模型
+    - 证型线索（如乏力、气短 → 气虚）：首轮提问线索明确时，改用更短的聚焦提示词和更低的 max_tokens
+
+词典同时收录中医说法和常见的西医/口语说法，在模块加载时编译一次。
+
+环境变量:
+    TCM_TRIAGE: off 关闭本地分诊（默认开启）
+    TCM_TRIAGE_MIN_HITS: 首要证型至少命中多少个不同的症状词才使用聚焦提示词，默认2
+    TCM_TRIAGE_FOCUSED_MAX_TOKENS: 聚焦回复的最大生成token数，默认800
+"""
+import os
+from collections import deque
+
+DEFAULT_MIN_HITS = 2
+DEFAULT_FOCUSED_MAX_TOKENS = 800
+
+# 否定词：紧挨在症状词之前时不算命中（如"没有胸痛"、"无明显胸痛"）。
+# 只看紧邻的整词，不在前面几个字里找单字：否则"无力"、"无缘无故"中的"无"会把后面的胸痛当成否定
+NEGATIONS = ("没有", "没", "无", "不是", "未", "否认")
+# 否定词与症状词之间允许出现的修饰词（不含标点，否定不会跨越逗号、句号）
+NEGATION_FILLERS = ("", "明显", "明显的", "出现", "出现过", "过", "什么", "任何")
+# 危险信号出现在预防类提问中（如"怎么预防中风"）时不算命中，只看同一分句
+PREVENTION_WORDS = ("预防", "防止", "避免")
+CLAUSE_BREAKS = frozenset("，,。.；;！!？?、\n")
+# 本身不足以判断的危险信号词：同一条消息中出现对应的上下文词时才算命中
+# （"40度"可能是体温，也可能是泡脚水温）
+FEVER_WORDS = ("发烧", "发热", "体温", "烧到")
+CONTEXT_REQUIRED = {
+    "40度": FEVER_WORDS,
+    "39度以上": FEVER_WORDS,
+}
+
+
+class AhoCorasick:
+    """多模式字符串匹配自动机"""
+
+    def __init__(self, patterns):
+        """
+        参数:
+            patterns: 可迭代的 (模式串, 附带数据)，同一模式串可以出现多次
+        """
+        goto = [{}]
+        outputs = [[]]
+        for word, payload in patterns:
+            if not word:
+                continue
+            state = 0
+            for ch in word:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    outputs.append([])
+                state = nxt
+            outputs[state].append((len(word), payload))
+
+        # 按广度优先计算失败链接，并把失败状态的转移合并进来（不含根节点的转移），
+        # 匹配时每个字符只需一到两次字典查找
+        fail = [0] * len(goto)
+        trans = [dict(g) for g in goto]
+        root = goto[0]
+        queue = deque(root.values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                outputs[nxt] = outputs[nxt] + outputs[fail[nxt]]
+                queue.append(nxt)
+            if fail[state]:
+                merged = dict(trans[fail[state]])
+                merged.update(goto[state])
+                trans[state] = merged
+
+        self._root = root
+        self._trans = trans
+        self._outputs = [tuple(o) for o in outputs]
+        self.states = len(goto)
+
+    def iter_matches(self, text):
+        """
+        逐个返回匹配结果
+
+        返回:
+            生成器，元素为 (起始位置, 结束位置, 附带数据)
+        """
+        trans, root, outputs = self._trans, self._root, self._outputs
+        state = 0
+        for end, ch in enumerate(text, 1):
+            state = trans[state].get(ch) or root.get(ch, 0)
+            if outputs[state]:
+                for length, payload in outputs[state]:
+                    yield end - length, end, payload
+
+
+# ==================== 症状词典 ====================
+
+class RedFlag:
+    """一类需要立即就医的危险信号"""
+
+    __slots__ = ("key", "title", "terms", "advice")
+
+    def __init__(self, key, title, terms, advice):
+        self.key = key
+        self.title = title
+        self.terms = terms
+        self.advice = advice
+
+
+RED_FLAGS = (
+    RedFlag("cardiac", "疑似心脏急症",
+            ("胸痛", "胸口痛", "胸口剧痛", "心前区疼痛", "心绞痛", "胸口压榨", "压榨样疼痛", "胸痛放射",
+             "左臂放射痛", "心梗", "心肌梗死", "chest pain"),
+            "胸痛（尤其是压榨样、伴出汗、放射到左臂或下颌）可能是心肌梗死等急症，请立即拨打 **120**，"
+            "保持安静休息，不要自行走动或驾车就医。"),
+    RedFlag("stroke", "疑似脑卒中",
+            ("口角歪斜", "嘴歪", "口眼歪斜", "半身不遂", "一侧肢体无力", "一边手脚无力", "半边身子麻",
+             "左边手脚无力", "右边手脚无力", "半边手脚无力", "一侧手脚无力", "偏瘫", "说话不清", "口齿不清",
+             "言语不清", "突然看不清", "中风了", "突然中风"),
+            "口角歪斜、一侧肢体无力或说话不清可能是脑卒中（中风），抢救以分钟计，请立即拨打 **120** 并记下发病时间。"),
+    RedFlag("breathing", "呼吸困难",
+            ("呼吸困难", "喘不上气", "喘不过气", "上不来气", "透不过气", "窒息", "喉头水肿", "嘴唇发紫",
+             "口唇发紫"),
+            "明显的呼吸困难或嘴唇发紫说明身体缺氧，请立即拨打 **120** 或前往急诊。"),
+    RedFlag("bleeding", "出血",
+            ("呕血", "吐血", "咯血", "咳血", "便血", "黑便", "柏油样便", "大出血", "大量出血", "血流不止",
+             "尿血", "孕期出血", "怀孕出血"),
+            "呕血、咯血、黑便或大量出血需要尽快明确原因，请立即前往医院急诊。"),
+    RedFlag("consciousness", "意识障碍",
+            ("昏迷", "晕厥", "昏倒", "晕倒", "意识不清", "神志不清", "全身抽搐", "四肢抽搐", "抽搐不止",
+             "惊厥", "高热惊厥", "叫不醒"),
+            "昏迷、晕厥或抽搐属于急症，请立即拨打 **120**，让患者侧卧并保持呼吸道通畅，不要往嘴里塞东西。"),
+    RedFlag("headache", "剧烈头痛",
+            ("剧烈头痛", "头痛欲裂", "爆炸样头痛", "一生中最严重的头痛", "头痛伴呕吐", "头痛伴颈部僵硬",
+             "头痛伴脖子发硬"),
+            "突然出现的剧烈头痛（尤其伴呕吐、颈部僵硬或意识改变）可能是颅内出血等急症，请立即就医。"),
+    RedFlag("abdomen", "急腹症",
+            ("剧烈腹痛", "腹痛剧烈", "肚子剧痛", "腹部剧痛", "板状腹", "腹痛难忍"),
+            "剧烈腹痛可能是阑尾炎、胰腺炎、宫外孕等急症，请尽快前往急诊，明确诊断前不要自行服用止痛药。"),
+    RedFlag("fever", "高热不退",
+            ("高烧不退", "高热不退", "发烧40", "烧到40", "40度", "39度以上"),
+            "持续高热需要查明原因，请尽快就医；婴幼儿、老人或伴有精神差、抽搐时请立即就诊。"),
+    RedFlag("allergy", "严重过敏",
+            ("过敏性休克", "全身起疹伴呼吸困难", "喉咙发紧", "嘴唇肿胀", "舌头肿胀"),
+            "口唇、舌头肿胀或喉咙发紧可能是严重过敏反应，请立即拨打 **120**。"),
+    RedFlag("self_harm", "心理危机",
+            ("自杀", "轻生", "不想活", "活着没意思", "结束生命", "想去死", "自残", "割腕"),
+            "您现在的感受很重要，请不要独自承受。请立即联系身边信任的人，或拨打心理援助热线 **12356**；"
+            "如有紧急危险，请拨打 **110** 或 **120**。"),
+)
+
+# 证型线索：症状词（含常见口语和西医说法）→ 证型，同一个词可以指向多个证型
+PATTERN_TERMS = {
+    "气虚": ("乏力", "疲劳", "疲倦", "没力气", "气短", "懒言", "自汗", "精神不振", "容易感冒", "动则汗出",
+           "说话没力气", "食欲不振", "胃口不好", "大便溏", "便溏"),
+    "血虚": ("面色苍白", "面色萎黄", "脸色发白", "头晕眼花", "心悸", "心慌", "月经量少", "经量少", "唇色淡",
+           "指甲淡白", "贫血", "手脚发麻", "多梦", "健忘"),
+    "阴虚": ("口干", "咽干", "盗汗", "夜间出汗", "五心烦热", "手脚心热", "手心发热", "潮热", "午后发热",
+           "失眠", "睡不着", "大便干", "便秘", "舌红少苔", "耳鸣"),
+    "阳虚": ("怕冷", "畏寒", "手脚冰凉", "手脚冰冷", "四肢不温", "腰膝冷", "腰膝酸软", "夜尿多", "尿频",
+           "大便稀", "腹泻", "精神萎靡", "喜热饮"),
+    "气滞": ("胸闷", "叹气", "胀痛", "胁痛", "两肋胀", "情绪低落", "焦虑", "心烦", "烦躁", "易怒", "抑郁",
+           "胃胀", "腹胀", "嗳气", "打嗝", "经前乳房胀"),
+    "血瘀": ("刺痛", "痛处固定", "痛经", "血块", "舌紫", "瘀斑", "面色晦暗", "色斑", "静脉曲张", "夜间痛甚"),
+    "痰湿": ("体胖", "肥胖", "痰多", "身体沉重", "身重", "困倦", "嗜睡", "舌苔厚", "苔腻", "大便黏", "头重",
+           "胸闷", "消化不良", "恶心"),
+    "湿热": ("口苦", "口臭", "长痘", "痤疮", "小便黄", "尿黄", "大便黏滞", "湿疹", "舌苔黄腻", "面部油腻",
+           "阴囊潮湿", "白带黄"),
+}
+
+
+def _build_matcher():
+    patterns = []
+    for flag in RED_FLAGS:
+        for term in flag.terms:
+            patterns.append((term.lower(), ("red_flag", flag)))
+    for pattern, terms in PATTERN_TERMS.items():
+        for term in terms:
+            patterns.append((term, ("pattern", pattern)))
+    return AhoCorasick(patterns)
+
+
+MATCHER = _build_matcher()
+
+
+# ==================== 分诊 ====================
+
+class TriageResult:
+    """一条用户消息的分诊结果"""
+
+    __slots__ = ("red_flags", "patterns")
+
+    def __init__(self, red_flags, patterns):
+        self.red_flags = red_flags    # [(RedFlag, 命中的词)]，按在消息中出现的顺序
+        self.patterns = patterns      # [(证型, [命中的词])]，按命中数从多到少
+
+    @property
+    def urgent(self):
+        return bool(self.red_flags)
+
+    @property
+    def top_hits(self):
+        """首要证型命中的不同症状词数"""
+        return len(self.patterns[0][1]) if self.patterns else 0
+
+    def reply(self):
+        """危险信号的模板回复"""
+        terms = "、".join(dict.fromkeys(term for _, term in self.red_flags))
+        lines = [f"⚠️ **您提到的“{terms}”需要尽快寻求专业帮助，不适合通过养生调理来处理。**", ""]
+        for flag in dict.fromkeys(flag for flag, _ in self.red_flags):
+            lines.append(f"- **{flag.title}**：{flag.advice}")
+        lines += [
+            "",
+            "就医前请尽量有人陪同，不要自行服用来源不明的药物。",
+            "",
+            "本助手只提供养生保健参考，无法判断和处理急症。待明确诊断、病情稳定后，"
+            "如需中医调养方面的建议，欢迎再来咨询。",
+        ]
+        return "\n".join(lines)
+
+    def pattern_hint(self, limit=2):
+        """聚焦提示词中的证型线索，如"气虚（乏力、气短）；血虚（心悸）\""""
+        return "；".join(f"{name}（{'、'.join(terms)}）" for name, terms in self.patterns[:limit])
+
+
+def _negated(text, start):
+    """症状词前紧挨着否定词（中间最多一个修饰词）"""
+    for filler in NEGATION_FILLERS:
+        end = start - len(filler)
+        if end <= 0 or text[end:start] != filler:
+            continue
+        if any(text.endswith(word, 0, end) for word in NEGATIONS):
+            return True
+    return False
+
+
+def _preventive(text, start):
+    """症状词所在分句（从上一个标点到症状词）是预防类提问"""
+    clause_start = start
+    while clause_start > 0 and text[clause_start - 1] not in CLAUSE_BREAKS:
+        clause_start -= 1
+    clause = text[clause_start:start]
+    return any(word in clause for word in PREVENTION_WORDS)
+
+
+def triage(text):
+    """
+    对一条用户消息做本地分诊
+
+    参数:
+        text: 用户消息
+
+    返回:
+        TriageResult
+    """
+    red_flags = []
+    pattern_terms = {}
+    lowered = text.lower()
+    for start, end, (kind, payload) in MATCHER.iter_matches(lowered):
+        if _negated(lowered, start):
+            continue
+        term = text[start:end]
+        if kind == "red_flag":
+            context = CONTEXT_REQUIRED.get(term)
+            if context is not None and not any(word in lowered for word in context):
+                continue
+            if not _preventive(lowered, start):
+                red_flags.append((payload, term))
+        else:
+            terms = pattern_terms.setdefault(payload, [])
+            if term not in terms:
+                terms.append(term)
+    patterns = sorted(pattern_terms.items(), key=lambda item: len(item[1]), reverse=True)
+    return TriageResult(red_flags, patterns)
+
+
+class TriagePolicy:
+    """分诊结果如何影响一次多轮对话请求"""
+
+    def __init__(self, min_hits=DEFAULT_MIN_HITS, focused_max_tokens=DEFAULT_FOCUSED_MAX_TOKENS):
+        """
+        参数:
+            min_hits: 首要证型至少命中多少个不同的症状词才使用聚焦提示词
+            focused_max_tokens: 聚焦回复的最大生成token数
+        """
+        self.min_hits = min_hits
+        self.focused_max_tokens = focused_max_tokens
+
+    def focused(self, result):
+        """是否使用聚焦提示词"""
+        return not result.urgent and result.top_hits >= self.min_hits
+
+
+def policy_from_env():
+    """根据环境变量创建分诊策略，关闭时返回None"""
+    if os.getenv("TCM_TRIAGE", "on").strip().lower() in ("0", "off", "false"):
+        return None
+    return TriagePolicy(
+        min_hits=int(os.getenv("TCM_TRIAGE_MIN_HITS", DEFAULT_MIN_HITS)),
+        focused_max_tokens=int(os.getenv("TCM_TRIAGE_FOCUSED_MAX_TOKENS", DEFAULT_FOCUSED_MAX_TOKENS)),
+    )
@@ -0,0 +1,110 @@
+"""
+界面静态资源
+
+Streamlit每次交互都会从头重新执行 app.py，放在脚本里的常量也会被重新构建。
+这些内容与会话无关，放在单独的模块中，每个进程只构建一次。
+"""
+
+# 全局CSS样式（每次重新执行脚本仍需输出，但字符串本身只构建一次）
+APP_CSS = """
+<style>
+    #MainMenu {visibility: hidden;}
+    footer {visibility: hidden;}
+    header {visibility: hidden;}
+
+    /* 移动端优化 */
+    html, body {
+        overflow-x: hidden;
+    }
+
+    .block-container {
+        padding-top: 1rem;
+        padding-bottom: 0rem;
+        max-width: 800px;
+    }
+
+    /* 优化按钮样式 */
+    .stButton button {
+        border-radius: 8px;
+        transition: all 0.3s ease;
+    }
+
+    .stButton button:hover {
+        transform: translateY(-2px);
+        box-shadow: 0 4px 12px rgba(0,0,0,0.15);
+    }
+
+    /* 优化聊天消息样式 */
+    .stChatMessage {
+        border-radius: 12px;
+        margin-bottom: 8px;
+    }
+
+    /* 优化输入框样式 - 移除sticky定位 */
+    .stChatInput {
+        border-radius: 12px;
+    }
+
+</style>
+"""
+
+WELCOME_HERO_HTML = """
+<div style="text-align: center; margin-top: 8vh;">
+    <h1 style="font-size: 48px; margin-bottom: 20px;
+               background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+               -webkit-background-clip: text;
+               -webkit-text-fill-color: transparent;
+               font-weight: 700;">
+        🌿 中医智能小助手
+    </h1>
+    <p style="font-size: 18px; color: #666; margin-bottom: 50px; line-height: 1.6;">
+        结合传统中医智慧与现代AI技术<br>为您提供个性化养生建议
+    </p>
+</div>
+"""
+
+# 功能特色 - 卡片式布局
+FEATURES_HTML = """
+<div style="text-align: center; margin: 40px auto; max-width: 600px;">
+    <div style="background: linear-gradient(135deg, #f5f7fa 0%, #c3cfe2 100%);
+                border-radius: 16px;
+                padding: 30px;
+                box-shadow: 0 8px 24px rgba(0,0,0,0.12);">
+        <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 20px; text-align: center;">
+            <div><span style="font-size: 24px;">🤖</span><br><strong>AI智能分析</strong></div>
+            <div><span style="font-size: 24px;">🎯</span><br><strong>精准辨证</strong></div>
+            <div><span style="font-size: 24px;">💊</span><br><strong>养生建议</strong></div>
+            <div><span style="font-size: 24px;">🔒</span><br><strong>隐私保护</strong></div>
+        </div>
+    </div>
+</div>
+"""
+
+FOOTER_HTML = """
+<div style="text-align: center; color: #999; font-size: 13px; margin-top: 60px;">
+    © 2025 中医智能小助手 v1.6 | Powered by Claude AI
+</div>
+"""
+
+WELCOME_MESSAGE = "您好！我是您的中医智能小助手 🌿\n\n我可以帮您从中医角度分析身体症状，提供个性化养生建议。\n\n请告诉我您的症状或健康问题："
+
+# 回复被中途停止（停止按钮、新对话、返回）时，已生成的部分加上该说明保存到对话记录
+STOPPED_NOTE = "\n\n*（已停止生成）*"
+
+# 年龄选项："未提供" + 1~120岁，下标即年龄
+AGE_OPTIONS = ("未提供",) + tuple(range(1, 121))
+
+GENDER_OPTIONS = ("不方便透露", "男", "女")
+
+# 常见症状快速选择：(按钮文字, 发送的症状文字)
+COMMON_ISSUES = tuple(
+    (label, label.split(' ', 1)[1] if ' ' in label else label)
+    for label in (
+        "😴 疲劳乏力、精神不振",
+        "🌙 失眠多梦、睡眠质量差",
+        "🍽️ 消化不良、胃胀腹胀",
+        "🤕 头痛头晕",
+        "😰 焦虑心烦、情绪低落",
+        "🦴 腰酸背痛、关节疼痛",
+    )
+)